@@ -1,13 +1,45 @@
 import os
+import re
+import base64
+import concurrent.futures
+import gzip
+import hashlib
+import hmac
 import json
 import logging
-from datetime import datetime, timezone, date
+import mimetypes
+import multiprocessing
+import queue
+import random
+import sqlite3
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from functools import wraps
+from datetime import datetime, timezone, date, timedelta
+from zoneinfo import ZoneInfo
 
-from flask import Flask, request, send_from_directory, jsonify
+# Отсчёт для метрик холодного старта — до импорта Flask и requests
+PROCESS_STARTED = time.monotonic()
+
+from flask import Flask, Response, g, request, send_from_directory, jsonify
 from flask_cors import CORS
 import requests
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import requests.adapters
+# gspread и oauth2client (~0.3 с импорта) грузятся при первой авторизации
+# Sheets: с бэкендом SQLite они нужны только для экспорта
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # ========= Logging =========
 logging.basicConfig(level=logging.INFO)
@@ -20,11 +52,21 @@ GOOGLE_CREDS_JSON = os.environ.get("GOOGLE_CREDS_JSON")
 WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
 PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "").rstrip("/")
 CRON_SECRET = os.environ.get("CRON_SECRET", "change_me")
+# sheets — по умолчанию, как раньше. Перед переходом на sqlite перенеси данные:
+# /trigger_reminder?mode=import (import_from_sheets)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sheets").strip().lower()
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "bot_hudey.db")
+# Ключ подписи callback_data; по умолчанию выводится из токена бота
+CALLBACK_SECRET = os.environ.get("CALLBACK_SECRET", "")
 
-if not all([BOT_TOKEN, SHEET_ID, GOOGLE_CREDS_JSON]):
-    raise ValueError("Missing required env vars: BOT_TOKEN, SHEET_ID, GOOGLE_CREDS_JSON")
+if not BOT_TOKEN:
+    raise ValueError("Missing required env var: BOT_TOKEN")
+if STORAGE_BACKEND == "sheets" and not all([SHEET_ID, GOOGLE_CREDS_JSON]):
+    raise ValueError("Missing required env vars for sheets backend: SHEET_ID, GOOGLE_CREDS_JSON")
 
-TELEGRAM_API = f"https://api.telegram.org/bot{BOT_TOKEN}"
+# Базовый URL Bot API можно подменить локальным фейковым сервером
+TELEGRAM_API_BASE = os.environ.get("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+TELEGRAM_API = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}"
 app = Flask(__name__)
 CORS(app)
 
@@ -35,12 +77,477 @@ def iso_now():
 def today_str():
     return date.today().isoformat()
 
-def tg_send(chat_id, text, reply_markup=None):
+# ========= Metrics =========
+# Счётчики и гистограммы в памяти процесса, отдаются в формате Prometheus
+# на /metrics. Меряем каждый вызов Sheets (лист + операция), Bot API
+# (метод + статус), каждый маршрут и тип апдейта. Гейджи (очередь,
+# распознавание, квоты) считаются в момент запроса /metrics.
+METRICS_SECRET = os.environ.get("METRICS_SECRET", "")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class SlidingWindow:
+    """Число событий за последние window секунд"""
+
+    def __init__(self, window=60.0):
+        self.window = window
+        self.events = deque()
+        self.lock = threading.Lock()
+
+    def _trim(self, now):
+        while self.events and now - self.events[0] > self.window:
+            self.events.popleft()
+
+    def add(self):
+        now = time.monotonic()
+        with self.lock:
+            self.events.append(now)
+            self._trim(now)
+
+    def count(self):
+        with self.lock:
+            self._trim(time.monotonic())
+            return len(self.events)
+
+class Metrics:
+    """Мини-реестр метрик: counter, histogram и гейджи-функции"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.help = {}
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    h[0][i] += 1
+                    break
+            h[1] += seconds
+            h[2] += 1
+
+    def gauge(self, name, text, fn):
+        """fn() -> [(labels dict, value)]"""
+        self.describe(name, "gauge", text)
+        self.gauges[name] = fn
+
+    @contextmanager
+    def timed(self, name, counter=None, **labels):
+        """Гистограмма name{labels} и (опционально) counter{labels, status}"""
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            yield
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+            if counter:
+                self.inc(counter, status=status, **labels)
+
+    @staticmethod
+    def _labels(pairs):
+        if not pairs:
+            return ""
+        body = ",".join(
+            '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in pairs
+        )
+        return "{" + body + "}"
+
+    def _head(self, out, name, seen):
+        if name in seen:
+            return
+        seen.add(name)
+        kind, text = self.help.get(name, ("untyped", ""))
+        out.append(f"# HELP {name} {text}")
+        out.append(f"# TYPE {name} {kind}")
+
+    def render(self):
+        out, seen = [], set()
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self.histograms.items())
+        for (name, labels), value in counters:
+            self._head(out, name, seen)
+            out.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (counts, total, n) in histograms:
+            self._head(out, name, seen)
+            acc = 0
+            for bound, c in zip(self.buckets, counts):
+                acc += c
+                out.append(f"{name}_bucket{self._labels(labels + (('le', repr(bound)),))} {acc}")
+            out.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {n}")
+            out.append(f"{name}_sum{self._labels(labels)} {total:.6f}")
+            out.append(f"{name}_count{self._labels(labels)} {n}")
+        for name, fn in sorted(self.gauges.items()):
+            try:
+                samples = fn()
+            except Exception as e:
+                logger.error(f"metrics gauge {name} error: {e}")
+                continue
+            self._head(out, name, seen)
+            for labels, value in samples:
+                out.append(f"{name}{self._labels(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+
+metrics.describe("sheets_request_seconds", "histogram", "Google Sheets API call latency")
+metrics.describe("sheets_requests_total", "counter", "Google Sheets API calls")
+metrics.describe("telegram_request_seconds", "histogram", "Telegram Bot API call latency")
+metrics.describe("telegram_requests_total", "counter", "Telegram Bot API responses by status")
+metrics.describe("telegram_retries_total", "counter", "Telegram Bot API retries")
+metrics.describe("http_request_seconds", "histogram", "HTTP request latency by route")
+metrics.describe("http_requests_total", "counter", "HTTP requests by route and status")
+metrics.describe("update_seconds", "histogram", "Telegram update processing time by type")
+metrics.describe("updates_total", "counter", "Telegram updates by type and result")
+
+# ========= Shared state =========
+# Под gunicorn с несколькими воркерами у каждого процесса свои глобалы. Чтобы
+# N воркеров не читали Sheets в N раз чаще и не портили данные друг другу:
+# - process_locks — межпроцессные локи: байт файла LOCK_PATH на ключ (fcntl),
+#   внутри процесса — RLock. На них стоят user_lock() и перестройка общих кэшей;
+# - shared_store — общий SQLite-файл SHARED_STATE_PATH: индексы строк, справочник
+#   users, снимки «сегодня», отметки напоминаний и счётчики поколений, по
+#   которым локальные кэши всех процессов узнают, что данные поменялись.
+# Без fcntl (Windows) локи работают только внутри процесса.
+SHARED_STATE_PATH = os.environ.get("SHARED_STATE_PATH", "shared_state.db")
+LOCK_PATH = os.environ.get("LOCK_PATH", "bot_hudey.lock")
+USER_LOCK_STRIPES = int(os.environ.get("USER_LOCK_STRIPES", "4096"))
+NAMED_LOCK_STRIPES = 256
+
+metrics.describe("lock_wait_seconds", "histogram", "Wait for a cross-process lock held by another worker")
+
+class ProcessLocks:
+    """Полосатые межпроцессные локи: ключ -> байт файла блокировок.
+
+    POSIX-лок принадлежит процессу, а не потоку, поэтому полосу внутри процесса
+    держит RLock, а файл блокируется только при внешнем входе. Пользовательские
+    и служебные ключи (named=True) лежат в разных диапазонах полос: служебный
+    лок берут внутри пользовательского, но не наоборот, — взаимной блокировки нет.
+    """
+
+    def __init__(self, path, stripes=USER_LOCK_STRIPES, named_stripes=NAMED_LOCK_STRIPES):
+        self.path = path
+        self.stripes = stripes
+        self.named_stripes = named_stripes
+        self.locks = [threading.RLock() for _ in range(stripes + named_stripes)]
+        self.depth = [0] * (stripes + named_stripes)
+        self.fd = None
+        self.pid = None
+        self.guard = threading.Lock()
+        self._held = threading.local()
+
+    def _file(self):
+        # После fork у дочернего процесса свой дескриптор (и свои POSIX-локи)
+        if self.pid != os.getpid():
+            with self.guard:
+                if self.pid != os.getpid():
+                    self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                    self.pid = os.getpid()
+        return self.fd
+
+    def stripe(self, key, named=False):
+        # crc32, а не hash(): номер полосы должен совпадать во всех процессах
+        h = zlib.crc32(str(key).encode("utf-8"))
+        return self.stripes + h % self.named_stripes if named else h % self.stripes
+
+    def held(self):
+        """Держит ли текущий поток хоть один лок"""
+        return getattr(self._held, "count", 0) > 0
+
+    @contextmanager
+    def hold(self, key, named=False):
+        i = self.stripe(key, named)
+        with self.locks[i]:
+            if self.depth[i] == 0 and fcntl is not None:
+                started = time.perf_counter()
+                fcntl.lockf(self._file(), fcntl.LOCK_EX, 1, i)
+                metrics.observe("lock_wait_seconds", time.perf_counter() - started,
+                                kind="named" if named else "user")
+            self.depth[i] += 1
+            held = getattr(self._held, "count", 0)
+            self._held.count = held + 1
+            try:
+                yield
+            finally:
+                self._held.count = held
+                self.depth[i] -= 1
+                if self.depth[i] == 0 and fcntl is not None:
+                    fcntl.lockf(self._file(), fcntl.LOCK_UN, 1, i)
+
+process_locks = ProcessLocks(LOCK_PATH)
+
+class SharedStore:
+    """Общий для воркеров SQLite: (namespace, key) -> JSON и счётчики поколений"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        db = self.conn()
+        db.execute("CREATE TABLE IF NOT EXISTS kv (ns TEXT NOT NULL, key TEXT NOT NULL, "
+                   "value TEXT NOT NULL, PRIMARY KEY (ns, key)) WITHOUT ROWID")
+        db.execute("CREATE TABLE IF NOT EXISTS generations (key TEXT PRIMARY KEY, n INTEGER NOT NULL) WITHOUT ROWID")
+
+    def conn(self):
+        c = getattr(self._local, "conn", None)
+        if c is None or self._local.pid != os.getpid():
+            c = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = c
+            self._local.pid = os.getpid()
+        return c
+
+    def get(self, ns, key, default=None):
+        r = self.conn().execute("SELECT value FROM kv WHERE ns = ? AND key = ?", (ns, str(key))).fetchone()
+        return json.loads(r[0]) if r else default
+
+    def items(self, ns):
+        return [(k, json.loads(v)) for k, v in self.conn().execute("SELECT key, value FROM kv WHERE ns = ?", (ns,))]
+
+    def put(self, ns, key, value):
+        self.conn().execute("INSERT OR REPLACE INTO kv (ns, key, value) VALUES (?, ?, ?)",
+                            (ns, str(key), json.dumps(value, ensure_ascii=False)))
+
+    def put_new(self, ns, key, value):
+        """Кладёт значение, только если ключа ещё нет"""
+        self.conn().execute("INSERT OR IGNORE INTO kv (ns, key, value) VALUES (?, ?, ?)",
+                            (ns, str(key), json.dumps(value, ensure_ascii=False)))
+
+    def replace(self, ns, items):
+        """Заменяет весь namespace одной транзакцией"""
+        db = self.conn()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM kv WHERE ns = ?", (ns,))
+            db.executemany("INSERT INTO kv (ns, key, value) VALUES (?, ?, ?)",
+                           [(ns, str(k), json.dumps(v, ensure_ascii=False)) for k, v in items])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def claim(self, ns, key, value):
+        """Ставит value, если сейчас там другое значение; True — поставили мы"""
+        db = self.conn()
+        v = json.dumps(value, ensure_ascii=False)
+        if db.execute("INSERT OR IGNORE INTO kv (ns, key, value) VALUES (?, ?, ?)",
+                      (ns, str(key), v)).rowcount == 1:
+            return True
+        return db.execute("UPDATE kv SET value = ? WHERE ns = ? AND key = ? AND value != ?",
+                          (v, ns, str(key), v)).rowcount == 1
+
+    def delete_if(self, ns, key, value):
+        self.conn().execute("DELETE FROM kv WHERE ns = ? AND key = ? AND value = ?",
+                            (ns, str(key), json.dumps(value, ensure_ascii=False)))
+
+    def delete(self, ns, key=None):
+        if key is None:
+            self.conn().execute("DELETE FROM kv WHERE ns = ?", (ns,))
+        else:
+            self.conn().execute("DELETE FROM kv WHERE ns = ? AND key = ?", (ns, str(key)))
+
+    def generation(self, key):
+        r = self.conn().execute("SELECT n FROM generations WHERE key = ?", (key,)).fetchone()
+        return r[0] if r else 0
+
+    def bump(self, key):
+        """+1 к поколению key, возвращает новое значение"""
+        return self.conn().execute(
+            "INSERT INTO generations (key, n) VALUES (?, 1) "
+            "ON CONFLICT (key) DO UPDATE SET n = n + 1 RETURNING n", (key,)
+        ).fetchall()[0][0]  # до конца: иначе неявная транзакция не закрыта
+
+_shared_store = None
+_shared_store_lock = threading.Lock()
+
+def get_shared_store():
+    global _shared_store
+    if _shared_store is None:
+        with _shared_store_lock:
+            if _shared_store is None:
+                _shared_store = SharedStore(SHARED_STATE_PATH)
+    return _shared_store
+
+# ========= Telegram client =========
+# Общая Session с пулом keep-alive соединений, token bucket на весь бот
+# (~30 сообщений/с) и на каждый чат, повторы с учётом retry_after на 429.
+TG_GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE = float(os.environ.get("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = int(os.environ.get("TG_CHAT_BURST", "3"))
+TG_MAX_RETRIES = int(os.environ.get("TG_MAX_RETRIES", "3"))
+TG_BACKOFF = float(os.environ.get("TG_BACKOFF", "0.5"))
+TG_MAX_RETRY_AFTER = float(os.environ.get("TG_MAX_RETRY_AFTER", "10"))
+TG_POOL_SIZE = int(os.environ.get("TG_POOL_SIZE", "20"))
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _take(self):
+        """Берёт токен; возвращает 0 или сколько секунд ждать"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def peek(self):
+        """Сколько токенов доступно сейчас"""
+        with self.lock:
+            return min(self.capacity, self.tokens + (time.monotonic() - self.updated) * self.rate)
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self._take()
+            if wait == 0.0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+class TelegramClient:
+    """Клиент Bot API: пул соединений, лимиты и повторы"""
+
+    # Методы, на которые распространяется лимит «сообщений в чат»
+    CHAT_LIMITED = {"sendMessage", "sendPhoto", "sendVideo", "sendDocument", "editMessageText"}
+
+    def __init__(self, api_url, global_rate=TG_GLOBAL_RATE, chat_rate=TG_CHAT_RATE,
+                 chat_burst=TG_CHAT_BURST, max_retries=TG_MAX_RETRIES, backoff=TG_BACKOFF,
+                 max_retry_after=TG_MAX_RETRY_AFTER, pool_size=TG_POOL_SIZE):
+        self.api_url = api_url
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.global_bucket = TokenBucket(global_rate, max(1, int(global_rate)))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = OrderedDict()
+        self.chat_lock = threading.Lock()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_retry_after = max_retry_after
+
+    def _chat_bucket(self, chat_id):
+        key = str(chat_id)
+        with self.chat_lock:
+            bucket = self.chat_buckets.pop(key, None) or TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets[key] = bucket
+            while len(self.chat_buckets) > 10000:
+                self.chat_buckets.popitem(last=False)
+            return bucket
+
+    def request(self, method, payload=None, params=None, timeout=20):
+        """Вызов метода Bot API; возвращает последний requests.Response.
+
+        Сетевые ошибки и 5xx повторяются с экспоненциальной паузой, на 429
+        ждём retry_after (если он не больше TG_MAX_RETRY_AFTER).
+        """
+        chat_id = (payload or {}).get("chat_id")
+        url = f"{self.api_url}/{method}"
+        attempt = 0
+        while True:
+            self.global_bucket.acquire()
+            if chat_id is not None and method in self.CHAT_LIMITED:
+                self._chat_bucket(chat_id).acquire()
+            started = time.perf_counter()
+            try:
+                if params is not None:
+                    r = self.session.get(url, params=params, timeout=timeout)
+                else:
+                    r = self.session.post(url, json=payload, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.observe("telegram_request_seconds", time.perf_counter() - started, method=method)
+                metrics.inc("telegram_requests_total", method=method, status="network_error")
+                if attempt >= self.max_retries:
+                    raise
+                metrics.inc("telegram_retries_total", method=method, reason="network")
+                delay = self.backoff * (2 ** attempt)
+                logger.warning(f"telegram {method} network error: {e}, retry in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            metrics.observe("telegram_request_seconds", time.perf_counter() - started, method=method)
+            metrics.inc("telegram_requests_total", method=method, status=str(r.status_code))
+
+            if r.status_code == 429 and attempt < self.max_retries:
+                try:
+                    retry_after = float(r.json().get("parameters", {}).get("retry_after", 1))
+                except Exception:
+                    retry_after = 1.0
+                if retry_after > self.max_retry_after:
+                    logger.warning(f"telegram {method}: 429, retry_after={retry_after}s is too long")
+                    return r
+                logger.warning(f"telegram {method}: 429, retry in {retry_after}s")
+                metrics.inc("telegram_retries_total", method=method, reason="429")
+                time.sleep(retry_after)
+                attempt += 1
+                continue
+
+            if r.status_code >= 500 and attempt < self.max_retries:
+                delay = self.backoff * (2 ** attempt)
+                logger.warning(f"telegram {method}: {r.status_code}, retry in {delay:.1f}s")
+                metrics.inc("telegram_retries_total", method=method, reason="5xx")
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            return r
+
+_tg_client = None
+_tg_client_lock = threading.Lock()
+
+def tg_client():
+    global _tg_client
+    if _tg_client is None:
+        with _tg_client_lock:
+            if _tg_client is None:
+                _tg_client = TelegramClient(TELEGRAM_API)
+    return _tg_client
+
+def message_payload(chat_id, text, reply_markup=None, reply_to=None):
+    payload = {"chat_id": chat_id, "text": text, "parse_mode": "Markdown"}
+    if reply_markup:
+        payload["reply_markup"] = reply_markup
+    if reply_to:
+        payload["reply_to_message_id"] = reply_to
+        payload["allow_sending_without_reply"] = True
+    return payload
+
+def tg_send(chat_id, text, reply_markup=None, reply_to=None):
+    flush_writes()  # ошибка записи должна дойти до обработчика, а не потеряться здесь
     try:
-        payload = {"chat_id": chat_id, "text": text, "parse_mode": "Markdown"}
-        if reply_markup:
-            payload["reply_markup"] = reply_markup
-        r = requests.post(f"{TELEGRAM_API}/sendMessage", json=payload, timeout=20)
+        payload = message_payload(chat_id, text, reply_markup, reply_to)
+        r = tg_client().request("sendMessage", payload, timeout=20)
         logger.info(f"tg_send: {r.status_code}")
         return r.json()
     except Exception as e:
@@ -48,9 +555,10 @@ def tg_send(chat_id, text, reply_markup=None):
         return None
 
 def tg_send_photo(chat_id, photo_url, caption=""):
+    flush_writes()
     try:
         payload = {"chat_id": chat_id, "photo": photo_url, "caption": caption}
-        r = requests.post(f"{TELEGRAM_API}/sendPhoto", json=payload, timeout=20)
+        r = tg_client().request("sendPhoto", payload, timeout=20)
         return r.json()
     except Exception as e:
         logger.error(f"tg_send_photo error: {e}")
@@ -58,22 +566,14 @@ def tg_send_photo(chat_id, photo_url, caption=""):
 
 def tg_answer_cb(cb_id):
     try:
-        requests.post(
-            f"{TELEGRAM_API}/answerCallbackQuery",
-            json={"callback_query_id": cb_id},
-            timeout=10
-        )
+        tg_client().request("answerCallbackQuery", {"callback_query_id": cb_id}, timeout=10)
     except Exception as e:
         logger.error(f"tg_answer_cb error: {e}")
 
 def tg_get_file_url(file_id):
-    r = requests.get(
-        f"{TELEGRAM_API}/getFile",
-        params={"file_id": file_id},
-        timeout=20
-    ).json()
+    r = tg_client().request("getFile", params={"file_id": file_id}, timeout=20).json()
     file_path = r["result"]["file_path"]
-    return f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
+    return f"{TELEGRAM_API_BASE}/file/bot{BOT_TOKEN}/{file_path}"
 
 def open_app_kb():
     webapp_url = f"{PUBLIC_BASE_URL}/web/index.html"
@@ -87,6 +587,176 @@ def open_app_kb():
 def cancel_kb():
     return {"inline_keyboard": [[{"text": "❌ Отмена", "callback_data": "cancel"}]]}
 
+# ========= Sheets client =========
+# Все вызовы gspread идут через sheets_call: отдельные token bucket на чтение
+# и запись по минутным квотам Sheets API (при нехватке — ждём, а не падаем),
+# повторы на 429/5xx с экспоненциальной паузой и джиттером, а одинаковые
+# одновременные чтения (например, get_all_values daily_log) делят один запрос.
+# Чтения под user_lock или служебным локом не склеиваются: чужой запрос мог
+# уйти до входа в лок и вернуть строки без последних записей.
+# Квоты Sheets API на пользователя: запросов в минуту
+SHEETS_READ_QUOTA = int(os.environ.get("SHEETS_READ_QUOTA", "60"))
+SHEETS_WRITE_QUOTA = int(os.environ.get("SHEETS_WRITE_QUOTA", "60"))
+SHEETS_BURST = int(os.environ.get("SHEETS_BURST", "15"))
+SHEETS_MAX_RETRIES = int(os.environ.get("SHEETS_MAX_RETRIES", "5"))
+SHEETS_BACKOFF = float(os.environ.get("SHEETS_BACKOFF", "1"))
+SHEETS_BACKOFF_MAX = float(os.environ.get("SHEETS_BACKOFF_MAX", "32"))
+SHEETS_READ_OPS = {"open_spreadsheet", "worksheet", "worksheets", "get_all_values", "get_all_records",
+                   "col_values", "row_values", "get", "batch_get", "acell", "cell", "get_values", "find"}
+
+class SingleFlight:
+    """Одинаковые одновременные вызовы выполняются один раз, остальные ждут результат"""
+
+    def __init__(self):
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self.lock:
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = concurrent.futures.Future()
+        if not leader:
+            metrics.inc("sheets_coalesced_total", op=key[1])
+            result = future.result()
+            # Свою копию строк: вызывающие иногда дополняют их на месте
+            if isinstance(result, list):
+                return [list(r) if isinstance(r, list) else r for r in result]
+            return result
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+sheets_buckets = {
+    "read": TokenBucket(SHEETS_READ_QUOTA / 60.0, max(1, min(SHEETS_BURST, SHEETS_READ_QUOTA))),
+    "write": TokenBucket(SHEETS_WRITE_QUOTA / 60.0, max(1, min(SHEETS_BURST, SHEETS_WRITE_QUOTA))),
+}
+sheets_quota_windows = {"read": SlidingWindow(), "write": SlidingWindow()}
+sheets_single_flight = SingleFlight()
+
+def sheets_retry_reason(e):
+    """429/5xx/сеть -> причина повтора, иначе None"""
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return "network"
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    if status == 429:
+        return "429"
+    if status is not None and status >= 500:
+        return "5xx"
+    return None
+
+def sheets_backoff(attempt):
+    """Экспоненциальная пауза с джиттером: половина фиксирована, половина случайна"""
+    delay = min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def _sheets_call(worksheet, op, fn, args, kwargs):
+    kind = "read" if op in SHEETS_READ_OPS else "write"
+    attempt = 0
+    while True:
+        started = time.monotonic()
+        sheets_buckets[kind].acquire()
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            metrics.inc("sheets_throttle_wait_seconds_total", round(waited, 3), kind=kind)
+        sheets_quota_windows[kind].add()
+        try:
+            with metrics.timed("sheets_request_seconds", counter="sheets_requests_total",
+                               worksheet=worksheet, op=op):
+                return fn(*args, **kwargs)
+        except Exception as e:
+            reason = sheets_retry_reason(e)
+            if reason is None or attempt >= SHEETS_MAX_RETRIES:
+                raise
+            delay = sheets_backoff(attempt)
+            logger.warning(f"sheets {op} {worksheet}: {reason}, retry {attempt + 1} in {delay:.1f}s")
+            metrics.inc("sheets_retries_total", op=op, reason=reason)
+            time.sleep(delay)
+            attempt += 1
+
+def sheets_call(worksheet, op, fn, *args, **kwargs):
+    """Вызов gspread: квота (token bucket), повторы на 429/5xx и склейка одинаковых чтений"""
+    if op in SHEETS_READ_OPS and not process_locks.held():
+        key = (worksheet, op, repr(args), repr(sorted(kwargs.items())))
+        return sheets_single_flight.do(key, lambda: _sheets_call(worksheet, op, fn, args, kwargs))
+    return _sheets_call(worksheet, op, fn, args, kwargs)
+
+class MeteredWorksheet:
+    """Прокси gspread.Worksheet: каждый метод идёт через sheets_call"""
+
+    def __init__(self, ws):
+        self._ws = ws
+
+    def __getattr__(self, item):
+        attr = getattr(self._ws, item)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            try:
+                return sheets_call(self._ws.title, item, attr, *args, **kwargs)
+            except Exception as e:
+                if not sheets_auth_error(e):
+                    raise
+                # Отозванный/протухший токен: авторизуемся заново и повторяем один раз
+                logger.warning(f"sheets {item} {self._ws.title}: 401, re-authorizing")
+                sheet_handles.reset()
+                fresh = sheet_handles.worksheet(self._ws.title)
+                return sheets_call(fresh.title, item, getattr(fresh, item), *args, **kwargs)
+        return call
+
+class MeteredSpreadsheet:
+    """Прокси gspread.Spreadsheet: листы отдаются обёрнутыми в MeteredWorksheet"""
+
+    def __init__(self, sh):
+        self._sh = sh
+
+    def __getattr__(self, item):
+        return getattr(self._sh, item)
+
+    def worksheet(self, name):
+        return MeteredWorksheet(sheets_call(name, "worksheet", self._sh.worksheet, name))
+
+    def add_worksheet(self, title, rows=1000, cols=20):
+        return MeteredWorksheet(sheets_call(title, "add_worksheet", self._sh.add_worksheet,
+                                            title=title, rows=rows, cols=cols))
+
+    def worksheets(self):
+        return [MeteredWorksheet(ws) for ws in sheets_call("*", "worksheets", self._sh.worksheets)]
+
+    def del_worksheet(self, ws):
+        return sheets_call(ws.title, "del_worksheet", self._sh.del_worksheet, getattr(ws, "_ws", ws))
+
+def sheets_quota_gauge():
+    return [
+        ({"kind": "read"}, sheets_quota_windows["read"].count()),
+        ({"kind": "write"}, sheets_quota_windows["write"].count()),
+    ]
+
+def sheets_quota_ratio_gauge():
+    return [
+        ({"kind": "read"}, round(sheets_quota_windows["read"].count() / max(1, SHEETS_READ_QUOTA), 3)),
+        ({"kind": "write"}, round(sheets_quota_windows["write"].count() / max(1, SHEETS_WRITE_QUOTA), 3)),
+    ]
+
+metrics.gauge("sheets_quota_used", "Sheets API calls in the last 60s", sheets_quota_gauge)
+metrics.gauge("sheets_quota_limit", "Sheets API per-minute quota",
+              lambda: [({"kind": "read"}, SHEETS_READ_QUOTA), ({"kind": "write"}, SHEETS_WRITE_QUOTA)])
+metrics.gauge("sheets_quota_usage_ratio", "Share of the per-minute Sheets quota used", sheets_quota_ratio_gauge)
+metrics.gauge("sheets_tokens_available", "Tokens left in the Sheets rate limiter",
+              lambda: [({"kind": k}, round(b.peek(), 2)) for k, b in sheets_buckets.items()])
+metrics.describe("sheets_retries_total", "counter", "Google Sheets calls retried after 429/5xx/network errors")
+metrics.describe("sheets_coalesced_total", "counter", "Reads served by an identical in-flight request")
+metrics.describe("sheets_throttle_wait_seconds_total", "counter", "Time spent waiting for Sheets quota tokens")
+
 # ========= Food recognition & estimation =========
 
 FOOD_RULES = {
@@ -102,12 +772,175 @@ FOOD_RULES = {
 
 SIZE_MULT = {"small": 0.8, "medium": 1.0, "large": 1.3}
 
-def recognize_food(photo_url):
-    """
-    TODO: заменить на реальный AI (Google Vision / GPT-4 Vision)
-    Пока возвращаем "неизвестно" с низкой уверенностью
-    """
-    return "неизвестно", 0.3
+# ========= Food recognition engine =========
+# Распознаватель подключаемый (RECOGNIZER): none — старая заглушка, local —
+# классификатор из food_model.py в пуле процессов. Результаты кэшируются по
+# file_unique_id, поэтому пересланное/повторное фото не распознаётся заново.
+# Не уложились в RECOGNIZER_TIMEOUT — отдаём «неизвестно» и показываем кнопки.
+RECOGNIZER = os.environ.get("RECOGNIZER", "local").strip().lower()
+RECOGNIZER_MODEL = os.environ.get("RECOGNIZER_MODEL", "food_model.json")
+RECOGNIZER_WORKERS = int(os.environ.get("RECOGNIZER_WORKERS", "2"))
+RECOGNIZER_TIMEOUT = float(os.environ.get("RECOGNIZER_TIMEOUT", "3"))
+RECOGNIZER_CACHE_SIZE = int(os.environ.get("RECOGNIZER_CACHE_SIZE", "5000"))
+UNRECOGNIZED = ("неизвестно", 0.3)
+
+class StubRecognizer:
+    """Ничего не распознаёт: всегда уточняем кнопками"""
+    name = "none"
+    needs_image = False
+
+    def submit(self, image_bytes):
+        f = concurrent.futures.Future()
+        f.set_result(UNRECOGNIZED)
+        return f
+
+class LocalRecognizer:
+    """food_model.py в пуле процессов (spawn: форк многопоточного процесса небезопасен)"""
+    name = "local"
+    needs_image = True
+
+    def __init__(self, model_path, workers=RECOGNIZER_WORKERS):
+        import food_model
+        food_model.load_model(model_path)  # битая модель — ошибка сразу, а не в воркере
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=food_model.init_worker,
+            initargs=(model_path,),
+        )
+        self.classify = food_model.classify_in_worker
+
+    def submit(self, image_bytes):
+        return self.pool.submit(self.classify, image_bytes)
+
+def make_recognizer():
+    if RECOGNIZER == "local":
+        try:
+            return LocalRecognizer(RECOGNIZER_MODEL)
+        except Exception as e:
+            logger.warning(f"Local recognizer unavailable ({e}), falling back to keyboards")
+    return StubRecognizer()
+
+class RecognitionService:
+    """Кэш по file_unique_id, склейка одновременных запросов, таймаут и счётчики"""
+
+    def __init__(self, recognizer, timeout=RECOGNIZER_TIMEOUT, cache_size=RECOGNIZER_CACHE_SIZE,
+                 max_pending=None):
+        self.recognizer = recognizer
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.max_pending = max_pending or RECOGNIZER_WORKERS * 4
+        self.cache = OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "cache_hits": 0, "joined": 0, "timeouts": 0,
+                      "errors": 0, "rejected": 0, "completed": 0,
+                      "latency_sum": 0.0, "latency_max": 0.0}
+
+    def _remember(self, key, result):
+        self.cache[key] = result
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _on_done(self, key, started, future):
+        elapsed = time.monotonic() - started
+        with self.lock:
+            self.inflight.pop(key, None)
+            if future.exception() is not None:
+                self.stats["errors"] += 1
+                return
+            self.stats["completed"] += 1
+            self.stats["latency_sum"] += elapsed
+            self.stats["latency_max"] = max(self.stats["latency_max"], elapsed)
+            if key:
+                self._remember(key, future.result())
+
+    def recognize(self, key, fetch_image):
+        """key — file_unique_id ('' — не кэшировать), fetch_image() -> bytes"""
+        with self.lock:
+            self.stats["requests"] += 1
+            if key and key in self.cache:
+                self.stats["cache_hits"] += 1
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            future = self.inflight.get(key) if key else None
+            if future is not None:
+                self.stats["joined"] += 1
+            elif len(self.inflight) >= self.max_pending:
+                self.stats["rejected"] += 1
+                return UNRECOGNIZED
+        deadline = time.monotonic() + self.timeout
+        if future is None:
+            try:
+                image = fetch_image() if self.recognizer.needs_image else b""
+                started = time.monotonic()
+                future = self.recognizer.submit(image)
+            except Exception as e:
+                logger.error(f"recognize error: {e}")
+                with self.lock:
+                    self.stats["errors"] += 1
+                return UNRECOGNIZED
+            if key:
+                with self.lock:
+                    self.inflight[key] = future
+            future.add_done_callback(lambda f, k=key, t=started: self._on_done(k, t, f))
+        try:
+            return future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except concurrent.futures.TimeoutError:
+            # Результат всё равно попадёт в кэш, когда воркер досчитает
+            with self.lock:
+                self.stats["timeouts"] += 1
+            logger.warning(f"recognize timeout for {key or 'photo'}")
+        except Exception as e:
+            logger.error(f"recognize failed: {e}")
+        return UNRECOGNIZED
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            cached, pending = len(self.cache), len(self.inflight)
+        lookups = stats["requests"] or 1
+        done = stats["completed"] or 1
+        return {
+            "engine": self.recognizer.name,
+            "cache_size": cached,
+            "pending": pending,
+            "hit_rate": round(stats["cache_hits"] / lookups, 3),
+            "latency_avg_ms": round(stats["latency_sum"] / done * 1000, 1),
+            "latency_max_ms": round(stats["latency_max"] * 1000, 1),
+            **{k: v for k, v in stats.items() if not k.startswith("latency")},
+        }
+
+_recognition = None
+_recognition_lock = threading.Lock()
+
+def get_recognition_service():
+    global _recognition
+    if _recognition is None:
+        with _recognition_lock:
+            if _recognition is None:
+                _recognition = RecognitionService(make_recognizer())
+                logger.info(f"Food recognizer: {_recognition.recognizer.name}")
+    return _recognition
+
+def recognizer_gauges():
+    if _recognition is None:
+        return []
+    snap = _recognition.snapshot()
+    return [({"stat": k}, snap[k]) for k in ("hit_rate", "pending", "cache_size", "timeouts",
+                                             "errors", "rejected", "latency_avg_ms")]
+
+metrics.gauge("food_recognizer", "Photo recognition cache and latency", recognizer_gauges)
+
+def download_photo(photo_url):
+    r = tg_client().session.get(photo_url, timeout=RECOGNIZER_TIMEOUT)
+    r.raise_for_status()
+    return r.content
+
+def recognize_food(photo_url, file_unique_id=""):
+    """(название из FOOD_RULES, уверенность 0..1); уверенность < 0.7 — уточняем кнопками"""
+    return get_recognition_service().recognize(file_unique_id, lambda: download_photo(photo_url))
 
 def get_food_questions(food_name):
     """Определяем, что спрашивать у пользователя"""
@@ -133,40 +966,151 @@ def calculate_kcal(food_name, size="medium", has_sauce=False, sauce_type=None):
     
     return kcal
 
-def make_food_kb(step):
-    """Создаём клавиатуру для уточнений"""
+# ========= Meal clarification callbacks =========
+# Весь ход уточнений едет в callback_data кнопок (лимит Telegram — 64 байта):
+# "m:<еда><соус><размер>:<ref>:<подпись>". ref — message_id фото пользователя
+# (base36): клавиатуры отправляются ответом на фото, и file_id берётся из
+# reply_to_message коллбэка. HMAC привязывает кнопку к пользователю, поэтому
+# обработка коллбэка не читает state.
+MEAL_CB_PREFIX = "m"
+CB_UNSET = "-"
+FOOD_CODES = {"h": "хот-дог", "b": "бургер", "s": "салат", "p": "пицца",
+              "w": "шаурма", "r": "роллы", "e": "яйцо", "u": "неизвестно"}
+SAUCE_CODES = {"y": "yes", "n": "no", "m": "майонез", "k": "кетчуп"}
+SIZE_CODES = {"s": "small", "m": "medium", "l": "large"}
+FOOD_CODE_OF = {v: k for k, v in FOOD_CODES.items()}
+SAUCE_CODE_OF = {v: k for k, v in SAUCE_CODES.items()}
+SIZE_CODE_OF = {v: k for k, v in SIZE_CODES.items()}
+CALLBACK_KEY = (CALLBACK_SECRET or hashlib.sha256(f"callback:{BOT_TOKEN}".encode()).hexdigest()).encode()
+
+def to_base36(n):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    out = ""
+    while True:
+        n, rem = divmod(n, 36)
+        out = digits[rem] + out
+        if not n:
+            return out
+
+def callback_sig(user_id, body):
+    """Подпись 12 символов (72 бита HMAC-SHA256)"""
+    mac = hmac.new(CALLBACK_KEY, f"{user_id}:{body}".encode("utf-8"), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(mac[:9]).decode("ascii")
+
+def encode_meal_cb(user_id, choice):
+    """{"food", "sauce", "size", "ref"} -> callback_data"""
+    codes = (FOOD_CODE_OF.get(choice.get("food"), CB_UNSET)
+             + SAUCE_CODE_OF.get(choice.get("sauce"), CB_UNSET)
+             + SIZE_CODE_OF.get(choice.get("size"), CB_UNSET))
+    body = f"{codes}:{to_base36(int(choice.get('ref') or 0))}"
+    data = f"{MEAL_CB_PREFIX}:{body}:{callback_sig(user_id, body)}"
+    assert len(data.encode("utf-8")) <= 64, data
+    return data
+
+def decode_meal_cb(user_id, data):
+    """callback_data -> choice или None (чужая/подделанная/битая кнопка)"""
+    parts = data.split(":")
+    if len(parts) != 4 or parts[0] != MEAL_CB_PREFIX or len(parts[1]) != 3:
+        return None
+    body = f"{parts[1]}:{parts[2]}"
+    if not hmac.compare_digest(parts[3], callback_sig(user_id, body)):
+        return None
+    food, sauce, size = parts[1]
+    try:
+        ref = int(parts[2], 36)
+    except ValueError:
+        return None
+    return {
+        "food": FOOD_CODES.get(food),
+        "sauce": SAUCE_CODES.get(sauce),
+        "size": SIZE_CODES.get(size),
+        "ref": ref,
+    }
+
+def make_food_kb(step, user_id, choice):
+    """Создаём клавиатуру для уточнений: каждая кнопка несёт уже сделанный выбор"""
+    def btn(text, **answer):
+        return {"text": text, "callback_data": encode_meal_cb(user_id, {**choice, **answer})}
+
     if step == "food_type":
         return {
             "inline_keyboard": [
-                [{"text": "🌭 Хот-дог", "callback_data": "food:хот-дог"},
-                 {"text": "🍔 Бургер", "callback_data": "food:бургер"}],
-                [{"text": "🥗 Салат", "callback_data": "food:салат"},
-                 {"text": "🍕 Пицца", "callback_data": "food:пицца"}],
-                [{"text": "🌯 Шаурма", "callback_data": "food:шаурма"},
-                 {"text": "🍣 Роллы", "callback_data": "food:роллы"}],
-                [{"text": "🥚 Яйцо", "callback_data": "food:яйцо"},
-                 {"text": "❓ Другое", "callback_data": "food:неизвестно"}],
+                [btn("🌭 Хот-дог", food="хот-дог"), btn("🍔 Бургер", food="бургер")],
+                [btn("🥗 Салат", food="салат"), btn("🍕 Пицца", food="пицца")],
+                [btn("🌯 Шаурма", food="шаурма"), btn("🍣 Роллы", food="роллы")],
+                [btn("🥚 Яйцо", food="яйцо"), btn("❓ Другое", food="неизвестно")],
             ]
         }
     elif step == "sauce":
         return {
             "inline_keyboard": [
-                [{"text": "✅ Был соус", "callback_data": "sauce:yes"}],
-                [{"text": "❌ Без соуса", "callback_data": "sauce:no"}],
-                [{"text": "🥄 Майонез", "callback_data": "sauce:майонез"},
-                 {"text": "🍅 Кетчуп", "callback_data": "sauce:кетчуп"}],
+                [btn("✅ Был соус", sauce="yes")],
+                [btn("❌ Без соуса", sauce="no")],
+                [btn("🥄 Майонез", sauce="майонез"), btn("🍅 Кетчуп", sauce="кетчуп")],
             ]
         }
     elif step == "size":
         return {
             "inline_keyboard": [
-                [{"text": "🍽 Маленькая", "callback_data": "size:small"},
-                 {"text": "🍽🍽 Средняя", "callback_data": "size:medium"},
-                 {"text": "🍽🍽🍽 Большая", "callback_data": "size:large"}],
+                [btn("🍽 Маленькая", size="small"),
+                 btn("🍽🍽 Средняя", size="medium"),
+                 btn("🍽🍽🍽 Большая", size="large")],
             ]
         }
     return {"inline_keyboard": []}
 
+def meal_photo_message(q, ref):
+    """Сообщение с фото (reply_to_message кнопок), если это именно ref; иначе None"""
+    reply = (q.get("message") or {}).get("reply_to_message") or {}
+    if not ref or reply.get("message_id") != ref or not reply.get("photo"):
+        return None
+    return reply
+
+def meal_photo_from_callback(q, ref):
+    """file_id и URL фото из reply_to_message сообщения с кнопками"""
+    reply = meal_photo_message(q, ref)
+    if reply is None:
+        return "", ""
+    file_id = reply["photo"][-1]["file_id"]
+    try:
+        return file_id, tg_get_file_url(file_id)
+    except Exception as e:
+        logger.error(f"meal_photo_from_callback error: {e}")
+        return file_id, ""
+
+def advance_meal(user_id, chat_id, choice, lead, resolve_photo):
+    """Следующий шаг уточнений: спрашиваем соус/размер или записываем еду.
+    resolve_photo() -> (file_id, photo_url) зовётся только при записи"""
+    food_name = choice["food"]
+    rule = get_food_questions(food_name)
+    if rule["ask_sauce"] and not choice.get("sauce"):
+        tg_send(chat_id, f"{lead}\nБыл соус или майонез?",
+                reply_markup=make_food_kb("sauce", user_id, choice), reply_to=choice.get("ref"))
+        return
+    if rule["ask_size"] and not choice.get("size"):
+        tg_send(chat_id, f"{lead}\nКакой размер порции?",
+                reply_markup=make_food_kb("size", user_id, choice), reply_to=choice.get("ref"))
+        return
+
+    sauce = choice.get("sauce")
+    file_id, photo_url = resolve_photo()
+    temp_data = {
+        "food_name": food_name,
+        "photo_url": photo_url,
+        "file_id": file_id,
+        "size": choice.get("size") or "medium",
+        "has_sauce": bool(sauce) and sauce != "no",
+        "sauce_type": sauce if sauce not in (None, "yes", "no") else None,
+    }
+    kcal = calculate_kcal(
+        food_name,
+        size=temp_data["size"],
+        has_sauce=temp_data["has_sauce"],
+        sauce_type=temp_data["sauce_type"]
+    )
+    finalize_meal(get_worksheet("meals"), get_worksheet("daily_log"), get_worksheet("users"),
+                  user_id, chat_id, temp_data, kcal)
+
 def finalize_meal(ws_meals, ws_daily, ws_users, user_id, chat_id, temp_data, kcal):
     """Финальное сохранение еды и обновление статистики"""
     food_name = temp_data.get("food_name", temp_data.get("food_guess", "неизвестно"))
@@ -180,30 +1124,32 @@ def finalize_meal(ws_meals, ws_daily, ws_users, user_id, chat_id, temp_data, kca
     if has_sauce:
         notes += f", соус: {sauce_type or 'да'}"
     
-    ws_meals.append_row([
-        iso_now(),
-        user_id,
-        "photo",
-        "",
-        food_name,
-        file_id,
-        photo_url,
-        str(kcal),
-        "0.8",
-        size,
-        sauce_type if has_sauce else "",
-        notes
-    ])
-    
     day = today_str()
-    targets = get_user_targets(ws_users, user_id) or {"kcal_target": 2100}
-    
-    # Пересчитываем статистику с учётом шагов
-    row = daily_find_or_create(ws_daily, user_id, day)
-    recalculate_daily_stats(ws_daily, ws_users, ws_meals, user_id, day, row)
     
-    # Получаем обновлённые значения
-    values = get_daily_row_values(ws_daily, row)
+    # Строка в meals и инкремент kcal_eaten — под одним локом, чтобы сверка
+    # (reconcile_kcal_eaten) не увидела одно без другого
+    with user_lock(user_id):
+        ws_meals.append_row([
+            iso_now(),
+            user_id,
+            "photo",
+            "",
+            food_name,
+            file_id,
+            photo_url,
+            str(kcal),
+            "0.8",
+            size,
+            sauce_type if has_sauce else "",
+            notes
+        ])
+        
+        # Прибавляем к kcal_eaten и пересчитываем статистику с учётом шагов
+        row = add_meal_kcal(ws_daily, user_id, day, kcal)
+        recalculate_daily_stats(ws_daily, ws_users, ws_meals, user_id, day, row)
+        
+        # Получаем обновлённые значения
+        values = get_daily_row_values(ws_daily, row)
     eaten = values[8] if len(values) > 8 else "0"
     left = values[9] if len(values) > 9 else "?"
     
@@ -216,105 +1162,308 @@ def finalize_meal(ws_meals, ws_daily, ws_users, user_id, chat_id, temp_data, kca
         reply_markup=open_app_kb()
     )
 
+# ========= Reminder schedule =========
+# Индекс напоминаний: минута суток по UTC -> пользователи. Строится одним
+# чтением листа users, обновляется при сохранении профиля и перестраивается,
+# когда у какой-то из таймзон сменилось смещение (переход на летнее время).
+SCHEDULE_TTL = int(os.environ.get("SCHEDULE_TTL", "3600"))
+REMINDER_KINDS = {"checkin": "checkin_time", "checkout": "checkout_time"}
+
+def parse_hhmm(value):
+    """'08:05' -> 485 (минуты от полуночи) или None"""
+    try:
+        h, m = str(value).strip().split(":")[:2]
+        h, m = int(h), int(m)
+        if 0 <= h < 24 and 0 <= m < 60:
+            return h * 60 + m
+    except Exception:
+        pass
+    return None
+
+def user_zone(timezone_name):
+    try:
+        return ZoneInfo(timezone_name)
+    except Exception:
+        return datetime.now().astimezone().tzinfo
+
+def utc_offset_minutes(tz, now=None):
+    now = now or datetime.now(timezone.utc)
+    return int(now.astimezone(tz).utcoffset().total_seconds() // 60)
+
+class ReminderSchedule:
+    """Кто когда получает чек-ин/чек-аут + журнал отправленного за локальный день.
+
+    Индекс свой в каждом процессе, но строится из общего справочника users,
+    а о сохранённых профилях процессы узнают по общему поколению "schedule".
+    Журнал отправленного — в shared_store: крон может попасть в любой воркер.
+    """
+
+    def __init__(self, ttl=SCHEDULE_TTL):
+        self.ttl = ttl
+        self.slots = {kind: {} for kind in REMINDER_KINDS}
+        self.placed = {}
+        self.profiles = {}
+        self.offsets = {}
+        self.built_at = 0.0
+        self.generation = None
+        self.lock = threading.Lock()
+
+    def _place(self, profile, now):
+        uid = profile["user_id"]
+        self._remove(uid)
+        tz = user_zone(profile["timezone"])
+        offset = utc_offset_minutes(tz, now)
+        self.offsets[profile["timezone"]] = offset
+        placed = []
+        for kind, field in REMINDER_KINDS.items():
+            local = parse_hhmm(profile[field])
+            if local is None:
+                logger.warning(f"Bad {field} for user {uid}: {profile[field]!r}")
+                continue
+            minute = (local - offset) % 1440
+            self.slots[kind].setdefault(minute, set()).add(uid)
+            placed.append((kind, minute))
+        self.placed[uid] = placed
+        self.profiles[uid] = profile
+
+    def _remove(self, uid):
+        for kind, minute in self.placed.pop(uid, []):
+            users = self.slots[kind].get(minute)
+            if users:
+                users.discard(uid)
+                if not users:
+                    del self.slots[kind][minute]
+        self.profiles.pop(uid, None)
+
+    def rebuild(self, ws_users, now=None):
+        self.generation = get_shared_store().generation("schedule")
+        rows = USER_DIRECTORIES["users"].rows(ws_users)
+        now = now or datetime.now(timezone.utc)
+        self.slots = {kind: {} for kind in REMINDER_KINDS}
+        self.placed = {}
+        self.profiles = {}
+        self.offsets = {}
+        for r in rows:
+            if len(r) < 13 or not r[0]:
+                continue
+            self._place(parse_user_profile(r), now)
+        self.built_at = time.monotonic()
+        logger.info(f"ReminderSchedule rebuilt: {len(self.profiles)} users, {len(self.offsets)} timezones")
+
+    def _offsets_changed(self, now):
+        for name, offset in self.offsets.items():
+            if utc_offset_minutes(user_zone(name), now) != offset:
+                logger.info(f"UTC offset changed for {name}, rebuilding schedule")
+                return True
+        return False
+
+    def update_user(self, profile):
+        """Профиль сохранён — переставляем пользователя в индексе (другие процессы перестроятся)"""
+        generation = get_shared_store().bump("schedule")
+        with self.lock:
+            if self.built_at:
+                self._place(profile, datetime.now(timezone.utc))
+                if self.generation == generation - 1:
+                    self.generation = generation
+
+    def invalidate(self):
+        get_shared_store().bump("schedule")
+        with self.lock:
+            self.built_at = 0.0
+
+    def _ensure_built(self, ws_users, now):
+        if (not self.built_at or time.monotonic() - self.built_at > self.ttl
+                or self.generation != get_shared_store().generation("schedule")
+                or self._offsets_changed(now)):
+            self.rebuild(ws_users, now)
+
+    def ensure_built(self, ws_users, now=None):
+        with self.lock:
+            self._ensure_built(ws_users, now or datetime.now(timezone.utc))
+
+    def due(self, ws_users, kind, now=None):
+        """Пользователи, у которых сейчас (±1 минута) время напоминания kind
+        и которым его ещё не отправляли в их локальный день: [(profile, local_date)]"""
+        now = now or datetime.now(timezone.utc)
+        with self.lock:
+            self._ensure_built(ws_users, now)
+            minute = now.hour * 60 + now.minute
+            uids = set()
+            for m in (minute - 1, minute, minute + 1):
+                uids |= self.slots[kind].get(m % 1440, set())
+            result = []
+            store = get_shared_store()
+            for uid in uids:
+                profile = self.profiles[uid]
+                local_date = now.astimezone(user_zone(profile["timezone"])).date().isoformat()
+                if store.get("reminder_sent", f"{kind}:{uid}") == local_date:
+                    continue
+                result.append((profile, local_date))
+            return result
+
+    def claim(self, kind, uid, local_date):
+        """Отмечает напоминание отправляемым; False — его уже отправил другой тик/воркер"""
+        return get_shared_store().claim("reminder_sent", f"{kind}:{uid}", local_date)
+
+    def release(self, kind, uid, local_date):
+        """Отправка не удалась — снимаем отметку, если она наша"""
+        get_shared_store().delete_if("reminder_sent", f"{kind}:{uid}", local_date)
+
+    def clear_sent(self):
+        get_shared_store().delete("reminder_sent")
+
+reminder_schedule = ReminderSchedule()
+
+# ========= Broadcast =========
+# Рассылка напоминаний: сначала рендерим все сообщения, потом отправляем пулом
+# из BROADCAST_WORKERS потоков — медленный ответ Telegram одному пользователю
+# больше не задерживает остальных. Лимиты Bot API соблюдает TelegramClient
+# (общий и по чату token bucket, retry_after на 429); здесь — повторные круги
+# для тех, кому не ушло из-за сети/5xx/долгого 429, и итог по каждому получателю.
+# Получателя сначала «захватываем» в журнале отправленного (shared_store), так
+# что пересекающиеся тики крона и разные воркеры не шлют одно и то же дважды.
+# 403 (бот заблокирован, аккаунт удалён) помечает пользователя неактивным:
+# рассылки его пропускают, пока он снова не напишет боту или не разблокирует его.
+BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", "8"))
+BROADCAST_TIMEOUT = float(os.environ.get("BROADCAST_TIMEOUT", "10"))
+BROADCAST_RETRIES = int(os.environ.get("BROADCAST_RETRIES", "2"))
+BROADCAST_BACKOFF = float(os.environ.get("BROADCAST_BACKOFF", "2"))
+BROADCAST_FAILURES_KEPT = 50
+
+metrics.describe("broadcast_messages_total", "counter", "Broadcast recipients by result")
+metrics.describe("broadcast_seconds", "histogram", "Broadcast duration from render to last delivery")
+
+def is_user_inactive(user_id):
+    return get_shared_store().get("inactive", str(user_id)) is not None
+
+def mark_user_inactive(user_id, reason):
+    get_shared_store().put("inactive", str(user_id), {"since": iso_now(), "reason": reason})
+    logger.info(f"User {user_id} marked inactive: {reason}")
+
+def mark_user_active(user_id):
+    store = get_shared_store()
+    if store.get("inactive", str(user_id)) is not None:
+        store.delete("inactive", str(user_id))
+        logger.info(f"User {user_id} is active again")
+
+def deliver(payload):
+    """Одна отправка рассылки -> (status, code, detail); status: sent/blocked/retry/failed"""
+    try:
+        r = tg_client().request("sendMessage", payload, timeout=BROADCAST_TIMEOUT)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        return "retry", None, str(e)
+    if r.status_code == 200:
+        return "sent", 200, ""
+    try:
+        detail = r.json().get("description", "")
+    except Exception:
+        detail = ""
+    if r.status_code == 403:
+        return "blocked", 403, detail
+    if r.status_code == 429 or r.status_code >= 500:
+        return "retry", r.status_code, detail
+    return "failed", r.status_code, detail
+
+def broadcast(kind, messages):
+    """[(profile, local_date, text)] -> отчёт с итогом по каждому получателю"""
+    started = time.monotonic()
+    results = {}
+    pending = []
+    for profile, local_date, text in messages:
+        uid = profile["user_id"]
+        if is_user_inactive(uid):
+            results[uid] = {"status": "skipped", "reason": "inactive"}
+        elif not reminder_schedule.claim(kind, uid, local_date):
+            results[uid] = {"status": "skipped", "reason": "already sent"}
+        else:
+            pending.append((uid, local_date, message_payload(uid, text, reply_markup=open_app_kb())))
+
+    attempt = 0
+    with concurrent.futures.ThreadPoolExecutor(BROADCAST_WORKERS, thread_name_prefix=f"broadcast-{kind}") as pool:
+        while pending:
+            outcomes = list(pool.map(lambda item: deliver(item[2]), pending))
+            retry = []
+            for item, (status, code, detail) in zip(pending, outcomes):
+                uid, local_date, _ = item
+                if status == "retry":
+                    if attempt < BROADCAST_RETRIES:
+                        retry.append(item)
+                        continue
+                    status = "failed"
+                results[uid] = {"status": status, "code": code, "detail": detail, "attempts": attempt + 1}
+                if status == "blocked":
+                    mark_user_inactive(uid, detail or "403")
+                elif status == "failed":
+                    # Снимаем захват: следующий тик крона (окно ±1 минута) попробует ещё раз
+                    reminder_schedule.release(kind, uid, local_date)
+            pending = retry
+            if pending:
+                attempt += 1
+                delay = BROADCAST_BACKOFF * (2 ** (attempt - 1))
+                logger.warning(f"broadcast {kind}: {len(pending)} to retry in {delay:.1f}s")
+                time.sleep(delay)
+
+    elapsed = time.monotonic() - started
+    counts = {}
+    for r in results.values():
+        counts[r["status"]] = counts.get(r["status"], 0) + 1
+        metrics.inc("broadcast_messages_total", kind=kind, status=r["status"])
+    metrics.observe("broadcast_seconds", elapsed, kind=kind)
+    summary = {
+        "kind": kind,
+        "at": iso_now(),
+        "seconds": round(elapsed, 3),
+        "total": len(results),
+        **counts,
+        "failures": [
+            {"user_id": uid, **r} for uid, r in results.items() if r["status"] in ("failed", "blocked")
+        ][:BROADCAST_FAILURES_KEPT],
+    }
+    get_shared_store().put("broadcast", kind, summary)
+    logger.info(f"broadcast {kind}: {counts} in {elapsed:.2f}s")
+    return {**summary, "results": results}
+
 # ========= Cron / Reminders =========
 
+def render_checkin(profile):
+    first_name = profile["first_name"] or "друг"
+    return f"🌅 Доброе утро, {first_name}! Время взвеситься.\n\nСтарик следит за тобой..."
+
 def run_checkin():
-    """Утренний чек-ин: взвесься"""
+    """Утренний чек-ин: взвесься. Возвращает отчёт рассылки (None при ошибке)"""
     logger.info("Running checkin reminder...")
     try:
         ws_users = get_worksheet("users")
-        rows = ws_users.get_all_values()
-        
-        for i in range(1, len(rows)):
-            r = rows[i]
-            if len(r) < 13:
-                continue
-            
-            user_id = r[0]
-            first_name = r[1] or "друг"
-            timezone_name = r[2] or "Europe/Moscow"
-            checkin_time = r[11] or "08:05"
-            
-            try:
-                from zoneinfo import ZoneInfo
-                user_now = datetime.now(ZoneInfo(timezone_name))
-            except:
-                user_now = datetime.now()
-            
-            current_time = user_now.strftime("%H:%M")
-            
-            current_minutes = int(current_time.split(":")[0]) * 60 + int(current_time.split(":")[1])
-            checkin_minutes = int(checkin_time.split(":")[0]) * 60 + int(checkin_time.split(":")[1])
-            
-            if abs(current_minutes - checkin_minutes) <= 1:
-                tg_send(
-                    user_id,
-                    f"🌅 Доброе утро, {first_name}! Время взвеситься.\n\nСтарик следит за тобой...",
-                    reply_markup=open_app_kb()
-                )
-                logger.info(f"Sent checkin to {user_id}")
+        due = reminder_schedule.due(ws_users, "checkin")
+        return broadcast("checkin", [(profile, local_date, render_checkin(profile))
+                                     for profile, local_date in due])
     except Exception as e:
         logger.error(f"run_checkin error: {e}")
+        return None
 
-def run_checkout():
-    """Вечерний отчёт"""
-    logger.info("Running checkout reminder...")
-    try:
-        ws_users = get_worksheet("users")
-        ws_daily = get_worksheet("daily_log")
-        rows = ws_users.get_all_values()
-        
-        for i in range(1, len(rows)):
-            r = rows[i]
-            if len(r) < 13:
-                continue
-            
-            user_id = r[0]
-            first_name = r[1] or "друг"
-            timezone_name = r[2] or "Europe/Moscow"
-            checkout_time = r[12] or "22:30"
-            kcal_target = 2100
-            if len(r) > 10 and r[10]:
-                try:
-                    kcal_target = int(float(r[10]))
-                except:
-                    pass
-            
-            try:
-                from zoneinfo import ZoneInfo
-                user_now = datetime.now(ZoneInfo(timezone_name))
-            except:
-                user_now = datetime.now()
-            
-            current_time = user_now.strftime("%H:%M")
-            
-            current_minutes = int(current_time.split(":")[0]) * 60 + int(current_time.split(":")[1])
-            checkout_minutes = int(checkout_time.split(":")[0]) * 60 + int(checkout_time.split(":")[1])
-            
-            if abs(current_minutes - checkout_minutes) <= 1:
-                day = today_str()
-                daily_rows = ws_daily.get_all_values()
-                
-                morning = "?"
-                evening = "?"
-                steps = "0"
-                kcal_eaten = "0"
-                
-                for dr in daily_rows[1:]:
-                    if len(dr) >= 2 and dr[0] == day and dr[1] == user_id:
-                        morning = dr[2] if len(dr) > 2 else "?"
-                        evening = dr[3] if len(dr) > 3 else "?"
-                        steps = dr[4] if len(dr) > 4 else "0"
-                        kcal_eaten = dr[8] if len(dr) > 8 else "0"
-                        break
-                
-                # Учитываем калории от шагов
-                steps_int = int(steps) if steps else 0
-                kcal_from_steps = int(steps_int * 0.04)
-                total_budget = kcal_target + kcal_from_steps
-                left = total_budget - int(float(kcal_eaten or 0))
-                
-                msg = f"""🌙 Вечерний отчёт, {first_name}
+def render_checkout(profile, dr):
+    """Текст вечернего отчёта по профилю и строке daily_log (или None)"""
+    first_name = profile["first_name"] or "друг"
+    kcal_target = profile["kcal_target"]
+    
+    morning = "?"
+    evening = "?"
+    steps = "0"
+    kcal_eaten = "0"
+    
+    if dr:
+        morning = dr[2] if len(dr) > 2 else "?"
+        evening = dr[3] if len(dr) > 3 else "?"
+        steps = dr[4] if len(dr) > 4 else "0"
+        kcal_eaten = dr[8] if len(dr) > 8 else "0"
+    
+    # Учитываем калории от шагов
+    steps_int = int(float(steps)) if steps else 0
+    kcal_from_steps = int(steps_int * 0.04)
+    total_budget = kcal_target + kcal_from_steps
+    left = total_budget - int(float(kcal_eaten or 0))
+    
+    return f"""🌙 Вечерний отчёт, {first_name}
 
 ⚖️ Вес: {morning} → {evening} кг
 🚶 Шаги: {steps} (+{kcal_from_steps} ккал)
@@ -322,73 +1471,1311 @@ def run_checkout():
 📊 Осталось: {left} ккал
 
 Старик доволен?"""
-                
-                tg_send(user_id, msg, reply_markup=open_app_kb())
-                logger.info(f"Sent checkout to {user_id}")
-    except Exception as e:
-        logger.error(f"run_checkout error: {e}")
 
-# ========= Google Sheets =========
-_sheet_client = None
+def build_checkout_reports(ws_daily, due):
+    """Один проход: строки daily_log за сегодня -> отчёты всем due-пользователям.
 
-def get_sheet():
-    global _sheet_client
-    try:
-        if _sheet_client is None:
-            creds_dict = json.loads(GOOGLE_CREDS_JSON)
-            scope = [
-                "https://www.googleapis.com/auth/spreadsheets",
-                "https://www.googleapis.com/auth/drive",
-            ]
-            creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-            _sheet_client = gspread.authorize(creds)
-            logger.info("Google Sheets authorized")
-        return _sheet_client.open_by_key(SHEET_ID)
-    except Exception as e:
-        logger.error(f"get_sheet error: {e}")
-        raise
+    Возвращает [(profile, local_date, text)].
+    """
+    day = today_str()
+    by_user = {}
+    for dr in ws_daily.daily_rows_for_day(day):
+        if len(dr) >= 2 and dr[1]:
+            by_user.setdefault(dr[1], dr)
+    
+    reports = []
+    for profile, local_date in due:
+        try:
+            text = render_checkout(profile, by_user.get(profile["user_id"]))
+        except Exception as e:
+            logger.error(f"render_checkout error for {profile['user_id']}: {e}")
+            continue
+        reports.append((profile, local_date, text))
+    return reports
 
-def get_worksheet(name):
-    """Получает лист с созданием при необходимости"""
+def run_checkout():
+    """Вечерний отчёт. Возвращает отчёт рассылки (None при ошибке)"""
+    logger.info("Running checkout reminder...")
     try:
-        sh = get_sheet()
+        ws_users = get_worksheet("users")
+        due = reminder_schedule.due(ws_users, "checkout")
+        if not due:
+            return broadcast("checkout", [])
+        
+        ws_daily = get_worksheet("daily_log")
+        reports = build_checkout_reports(ws_daily, due)
+        logger.info(f"Checkout: {len(reports)} reports for {len(due)} due users")
+        return broadcast("checkout", reports)
+    except Exception as e:
+        logger.error(f"run_checkout error: {e}")
+        return None
+
+# ========= Storage =========
+# Хелперы (users / meals / daily_log / state) работают с «таблицами» — объектами
+# с подмножеством API gspread.Worksheet плюс индексированными поисками
+# find_user_row / find_daily_row. Основное хранилище — локальный SQLite,
+# Google Sheets остаётся опциональным бэкендом (STORAGE_BACKEND=sheets)
+# и целью экспорта (/trigger_reminder?mode=export).
+
+SHEET_HEADERS = {
+    "users": ["user_id", "first_name", "timezone", "created_at",
+              "height_cm", "age", "start_weight_kg", "goal_weight_kg",
+              "goal_deadline", "activity_level", "kcal_target",
+              "checkin_time", "checkout_time"],
+    "meals": ["ts", "user_id", "source", "meal_type", "text",
+              "photo_file_id", "photo_url", "kcal_avg", "confidence",
+              "portion", "sauce", "notes"],
+    "daily_log": ["date", "user_id", "weight_morning_kg", "weight_evening_kg",
+                  "steps", "workout", "water_ml", "sleep_h", "kcal_eaten",
+                  "kcal_left", "mood", "untracked", "comment", "updated_at"],
+    "state": ["user_id", "pending_action", "pending_since", "last_prompt"],
+}
+
+# Индексы SQLite по базовому имени таблицы (партиции получают те же)
+SQLITE_INDEXES = {
+    "users": [("user_id",)],
+    "state": [("user_id",)],
+    "daily_log": [("date", "user_id"), ("user_id",)],
+    "meals": [("user_id", "ts"), ("ts",)],
+}
+
+# ========= Partitions =========
+# meals и daily_log хранятся помесячно: meals_2026_10, daily_log_2026_10.
+# Горячий путь работает с партицией текущего месяца, чтения по диапазону
+# дат открывают только нужные месяцы. Закрытые месяцы архивируются
+# (archive_closed_partitions) в сжатые файлы ARCHIVE_DIR/<партиция>.json.gz.
+PARTITIONED_TABLES = ("meals", "daily_log")
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+ARCHIVE_AFTER_MONTHS = int(os.environ.get("ARCHIVE_AFTER_MONTHS", "3"))
+
+def split_partition(name):
+    """'meals_2026_10' -> ('meals', '2026_10'), иначе (name, None)"""
+    m = re.match(r"^(meals|daily_log)_(\d{4}_\d{2})$", name)
+    if m:
+        return m.group(1), m.group(2)
+    return name, None
+
+def base_table_name(name):
+    return split_partition(name)[0]
+
+def period_of(day):
+    """'2026-10-17' -> '2026_10'"""
+    return day[:7].replace("-", "_")
+
+def partition_name(name, day):
+    return f"{name}_{period_of(day)}"
+
+def periods_between(start_day, end_day):
+    """Месяцы (YYYY_MM), которые задевает диапазон дат [start_day, end_day]"""
+    y, m = int(start_day[:4]), int(start_day[5:7])
+    end = (int(end_day[:4]), int(end_day[5:7]))
+    periods = []
+    while (y, m) <= end:
+        periods.append(f"{y:04d}_{m:02d}")
+        y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+    return periods
+
+def shift_period(period, months):
+    y, m = int(period[:4]), int(period[5:7])
+    total = y * 12 + (m - 1) + months
+    return f"{total // 12:04d}_{total % 12 + 1:02d}"
+
+def parse_a1(cell):
+    """'B5' -> (5, 2)"""
+    m = re.match(r"^([A-Z]+)(\d+)$", cell.strip().upper())
+    if not m:
+        raise ValueError(f"Bad A1 cell: {cell}")
+    col = 0
+    for ch in m.group(1):
+        col = col * 26 + (ord(ch) - 64)
+    return int(m.group(2)), col
+
+class SqliteTable:
+    """Таблица SQLite с интерфейсом листа: строка N листа = id + 1 (строка 1 — заголовки)"""
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+        self.title = name
+        self.columns = SHEET_HEADERS[base_table_name(name)]
+        self._cols_sql = ", ".join(f'"{c}"' for c in self.columns)
+
+    def _db(self):
+        return self.storage.conn()
+
+    def _row(self, values):
+        return ["" if v is None else str(v) for v in values]
+
+    def get_all_values(self):
+        cur = self._db().execute(f'SELECT {self._cols_sql} FROM "{self.name}" ORDER BY id')
+        return [list(self.columns)] + [self._row(r) for r in cur]
+
+    def col_values(self, col):
+        name = self.columns[col - 1]
+        cur = self._db().execute(f'SELECT "{name}" FROM "{self.name}" ORDER BY id')
+        values = [name] + ["" if r[0] is None else str(r[0]) for r in cur]
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def row_values(self, row):
+        cur = self._db().execute(f'SELECT {self._cols_sql} FROM "{self.name}" WHERE id = ?', (row - 1,))
+        r = cur.fetchone()
+        if r is None:
+            return []
+        values = self._row(r)
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def update_cell(self, row, col, value):
+        name = self.columns[col - 1]
+        self._db().execute(f'UPDATE "{self.name}" SET "{name}" = ? WHERE id = ?', (str(value), row - 1))
+
+    def _apply(self, db, range_name, values):
+        row, col = parse_a1(range_name.split("!")[-1].split(":")[0])
+        for dr, vals in enumerate(values):
+            sets = []
+            params = []
+            for dc, v in enumerate(vals):
+                if col + dc > len(self.columns):
+                    break
+                sets.append(f'"{self.columns[col + dc - 1]}" = ?')
+                params.append("" if v is None else str(v))
+            if sets:
+                params.append(row + dr - 1)
+                db.execute(f'UPDATE "{self.name}" SET {", ".join(sets)} WHERE id = ?', params)
+
+    def update(self, range_name, values, **kwargs):
+        with self.storage.transaction() as db:
+            self._apply(db, range_name, values)
+
+    def batch_update(self, data, **kwargs):
+        """Несколько диапазонов одной транзакцией (как Worksheet.batch_update)"""
+        with self.storage.transaction() as db:
+            for item in data:
+                self._apply(db, item["range"], item["values"])
+
+    def append_row(self, values):
+        """Добавляет строку, возвращает её номер (как в листе)"""
+        vals = self._row(values[:len(self.columns)])
+        vals += [""] * (len(self.columns) - len(vals))
+        placeholders = ", ".join("?" for _ in self.columns)
+        cur = self._db().execute(f'INSERT INTO "{self.name}" ({self._cols_sql}) VALUES ({placeholders})', vals)
+        return cur.lastrowid + 1
+
+    def append_rows(self, rows):
+        placeholders = ", ".join("?" for _ in self.columns)
+        data = []
+        for values in rows:
+            vals = self._row(values[:len(self.columns)])
+            data.append(vals + [""] * (len(self.columns) - len(vals)))
+        with self.storage.transaction() as db:
+            db.executemany(f'INSERT INTO "{self.name}" ({self._cols_sql}) VALUES ({placeholders})', data)
+
+    def find_user_row(self, user_id):
+        r = self._db().execute(
+            f'SELECT id FROM "{self.name}" WHERE user_id = ? ORDER BY id LIMIT 1', (str(user_id),)
+        ).fetchone()
+        return r[0] + 1 if r else None
+
+    def increment_cell(self, row, col, delta):
+        """Атомарно прибавляет delta к числовой ячейке, возвращает новое значение"""
+        name = self.columns[col - 1]
+        with self.storage.transaction() as db:
+            db.execute(
+                f'UPDATE "{self.name}" SET "{name}" = '
+                f'CAST(CAST(COALESCE(NULLIF("{name}", \'\'), \'0\') AS REAL) + ? AS INTEGER) WHERE id = ?',
+                (delta, row - 1)
+            )
+            r = db.execute(f'SELECT "{name}" FROM "{self.name}" WHERE id = ?', (row - 1,)).fetchone()
+        return int(r[0]) if r else 0
+
+    def rows_for_user(self, user_id):
+        cur = self._db().execute(
+            f'SELECT {self._cols_sql} FROM "{self.name}" WHERE user_id = ? ORDER BY id', (str(user_id),)
+        )
+        return [self._row(r) for r in cur]
+
+    def meals_for_day(self, day, user_id=None):
+        """Строки meals за день (ts начинается с day)"""
+        next_day = (date.fromisoformat(day) + timedelta(days=1)).isoformat()
+        sql = f'SELECT {self._cols_sql} FROM "{self.name}" WHERE ts >= ? AND ts < ?'
+        params = [day, next_day]
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            params.append(str(user_id))
+        return [self._row(r) for r in self._db().execute(sql + " ORDER BY id", params)]
+
+    def daily_rows_for_day(self, day):
+        cur = self._db().execute(
+            f'SELECT {self._cols_sql} FROM "{self.name}" WHERE date = ? ORDER BY id', (day,)
+        )
+        return [self._row(r) for r in cur]
+
+    def find_daily_row(self, day, user_id):
+        r = self._db().execute(
+            f'SELECT id FROM "{self.name}" WHERE date = ? AND user_id = ? ORDER BY id LIMIT 1',
+            (day, str(user_id))
+        ).fetchone()
+        return r[0] + 1 if r else None
+
+class SqliteStorage:
+    """Локальное хранилище: один файл SQLite в режиме WAL, соединение на поток"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._init_schema()
+
+    def conn(self):
+        # Соединение, открытое до fork (gunicorn --preload), в дочернем процессе не используем
+        c = getattr(self._local, "conn", None)
+        if c is None or self._local.pid != os.getpid():
+            c = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = c
+            self._local.pid = os.getpid()
+            self._local.depth = 0
+        return c
+
+    @contextmanager
+    def transaction(self):
+        db = self.conn()
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            db.execute("BEGIN IMMEDIATE")
+        self._local.depth = depth + 1
+        try:
+            yield db
+        except Exception:
+            self._local.depth = depth
+            if depth == 0:
+                db.execute("ROLLBACK")
+            raise
+        self._local.depth = depth
+        if depth == 0:
+            db.execute("COMMIT")
+
+    def _init_schema(self):
+        self._tables = set(self.list_tables())
+        for name in SHEET_HEADERS:
+            if name not in PARTITIONED_TABLES:
+                self._ensure(name)
+        logger.info(f"SQLite storage ready: {self.path}")
+
+    def _ensure(self, name):
+        """Создаёт таблицу (и индексы) при первом обращении"""
+        if name in self._tables:
+            return
+        base = base_table_name(name)
+        db = self.conn()
+        cols = ", ".join(f'"{c}" TEXT' for c in SHEET_HEADERS[base])
+        db.execute(f'CREATE TABLE IF NOT EXISTS "{name}" (id INTEGER PRIMARY KEY AUTOINCREMENT, {cols})')
+        for columns in SQLITE_INDEXES.get(base, []):
+            idx = f"idx_{name}_{'_'.join(columns)}"
+            db.execute(f'CREATE INDEX IF NOT EXISTS "{idx}" ON "{name}" ({", ".join(columns)})')
+        self._tables.add(name)
+
+    def list_tables(self):
+        cur = self.conn().execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        return [r[0] for r in cur if base_table_name(r[0]) in SHEET_HEADERS]
+
+    def has_table(self, name):
+        return name in self._tables
+
+    def drop_table(self, name):
+        self.conn().execute(f'DROP TABLE IF EXISTS "{name}"')
+        self._tables.discard(name)
+
+    def table(self, name):
+        self._ensure(name)
+        return SqliteTable(self, name)
+
+SHEETS_INDEX_TTL = int(os.environ.get("SHEETS_INDEX_TTL", "600"))
+
+class RowIndex:
+    """Индекс ключ -> номер строки листа, общий для всех воркеров (shared_store).
+
+    Строится одним get_all_values() под межпроцессным локом (строит один
+    воркер, остальные ждут и читают готовое), пополняется при append_row и
+    перестраивается по TTL или после invalidate() (лист могли править руками).
+    """
+
+    def __init__(self, name, key_func, ttl=SHEETS_INDEX_TTL):
+        self.ns = f"rows:{name}"
+        self.key_func = key_func
+        self.ttl = ttl
+
+    def _stale(self, store):
+        built_at = store.get("built", self.ns, 0.0)
+        return not built_at or time.time() - built_at > self.ttl
+
+    def rebuild(self, ws):
+        rows = ws.get_all_values()
+        index = {}
+        for i, row in enumerate(rows[1:], start=2):
+            key = self.key_func(row)
+            if key and key not in index:
+                index[key] = i
+        store = get_shared_store()
+        store.replace(self.ns, [(json.dumps(k, ensure_ascii=False), i) for k, i in index.items()])
+        store.put("built", self.ns, time.time())
+        logger.info(f"RowIndex rebuilt for {ws.title}: {len(index)} keys from {len(rows)} rows")
+
+    def get(self, ws, key):
+        store = get_shared_store()
+        if self._stale(store):
+            with process_locks.hold(self.ns, named=True):
+                if self._stale(store):
+                    self.rebuild(ws)
+        return store.get(self.ns, json.dumps(key, ensure_ascii=False))
+
+    def add(self, values, row):
+        key = self.key_func(values)
+        if not key:
+            return
+        # Под тем же локом, что и rebuild: иначе перестройка по старому снимку затрёт строку
+        store = get_shared_store()
+        with process_locks.hold(self.ns, named=True):
+            if not self._stale(store):
+                store.put_new(self.ns, json.dumps(key, ensure_ascii=False), row)
+
+    def invalidate(self):
+        get_shared_store().delete("built", self.ns)
+
+def daily_key(row):
+    """(date, user_id) строки daily_log"""
+    if len(row) < 2:
+        return None
+    row_day = str(row[0]).strip() if row[0] else ""
+    row_user = str(row[1]).strip() if row[1] else ""
+    if not row_day or not row_user:
+        return None
+    return (row_day, row_user)
+
+# Функции ключа по базовому имени; сами индексы — по имени листа (партиции)
+ROW_INDEX_KEYS = {
+    "daily_log": daily_key,
+}
+SHEETS_ROW_INDEXES = {}
+_row_indexes_lock = threading.Lock()
+
+def row_index_for(name):
+    """RowIndex листа name (None, если лист не индексируется)"""
+    key_func = ROW_INDEX_KEYS.get(base_table_name(name))
+    if key_func is None:
+        return None
+    with _row_indexes_lock:
+        idx = SHEETS_ROW_INDEXES.get(name)
+        if idx is None:
+            idx = SHEETS_ROW_INDEXES[name] = RowIndex(name, key_func)
+        return idx
+
+def invalidate_sheet_indexes():
+    """Сбрасывает индексы строк и кэш пользователей (после ручной правки таблицы)"""
+    for idx in list(SHEETS_ROW_INDEXES.values()):
+        idx.invalidate()
+    invalidate_user_cache()
+    reminder_schedule.invalidate()
+    weight_index.invalidate()
+    today_cache.clear()
+
+# ========= User directory cache =========
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", "300"))
+
+def parse_user_profile(vals):
+    """Разбирает строку листа users в профиль"""
+    vals = list(vals) + [""] * (13 - len(vals))
+    kcal_target = 2100
+    if vals[10]:
         try:
-            return sh.worksheet(name)
-        except gspread.WorksheetNotFound:
-            logger.warning(f"Worksheet '{name}' not found, creating...")
-            ws = sh.add_worksheet(title=name, rows=1000, cols=20)
-            if name == "users":
-                ws.append_row(["user_id", "first_name", "timezone", "created_at",
-                              "height_cm", "age", "start_weight_kg", "goal_weight_kg",
-                              "goal_deadline", "activity_level", "kcal_target", 
-                              "checkin_time", "checkout_time"])
-            elif name == "meals":
-                ws.append_row(["ts", "user_id", "source", "meal_type", "text",
-                              "photo_file_id", "photo_url", "kcal_avg", "confidence",
-                              "portion", "sauce", "notes"])
-            elif name == "daily_log":
-                ws.append_row(["date", "user_id", "weight_morning_kg", "weight_evening_kg",
-                              "steps", "workout", "water_ml", "sleep_h", "kcal_eaten",
-                              "kcal_left", "mood", "untracked", "comment", "updated_at"])
-            elif name == "state":
-                ws.append_row(["user_id", "pending_action", "pending_since", "last_prompt"])
+            kcal_target = int(float(vals[10]))
+        except:
+            pass
+    return {
+        "user_id": vals[0],
+        "first_name": vals[1],
+        "timezone": vals[2] or "Europe/Moscow",
+        "kcal_target": kcal_target,
+        "checkin_time": vals[11] or "08:05",
+        "checkout_time": vals[12] or "22:30",
+    }
+
+class UserDirectory:
+    """Кэш листа users/state: user_id -> (номер строки, значения строки).
+
+    Лежит в shared_store — один на все воркеры. Загружается одним
+    get_all_values() (под межпроцессным локом), живёт USER_CACHE_TTL секунд,
+    обновляется при записи (write-through) через put().
+    """
+
+    def __init__(self, name, ttl=USER_CACHE_TTL):
+        self.name = name
+        self.ns = f"dir:{name}"
+        self.ttl = ttl
+
+    def _stale(self, store):
+        loaded_at = store.get("built", self.ns, 0.0)
+        return not loaded_at or time.time() - loaded_at > self.ttl
+
+    def _load(self, ws):
+        rows = ws.get_all_values()
+        entries = {}
+        for i, row in enumerate(rows[1:], start=2):
+            uid = str(row[0]).strip() if row else ""
+            if uid and uid not in entries:
+                entries[uid] = [i, list(row)]
+        store = get_shared_store()
+        store.replace(self.ns, entries.items())
+        store.put("built", self.ns, time.time())
+        logger.info(f"UserDirectory loaded {self.name}: {len(entries)} users")
+
+    def _ensure(self, ws, store):
+        if self._stale(store):
+            with process_locks.hold(self.ns, named=True):
+                if self._stale(store):
+                    self._load(ws)
+
+    def lookup(self, ws, user_id):
+        """(row, values) или (None, None)"""
+        store = get_shared_store()
+        self._ensure(ws, store)
+        entry = store.get(self.ns, str(user_id))
+        return tuple(entry) if entry else (None, None)
+
+    def rows(self, ws):
+        """Значения всех строк по порядку листа (по одной на user_id)"""
+        store = get_shared_store()
+        self._ensure(ws, store)
+        return [values for row, values in sorted(v for k, v in store.items(self.ns))]
+
+    def refresh(self, ws):
+        with process_locks.hold(self.ns, named=True):
+            self._load(ws)
+
+    def put(self, user_id, row, values):
+        store = get_shared_store()
+        with process_locks.hold(self.ns, named=True):
+            if not self._stale(store):
+                store.put(self.ns, str(user_id), [row, list(values)])
+
+    def invalidate(self):
+        # Сбрасываем целиком: пропавшая запись не должна выглядеть как «нет пользователя»
+        store = get_shared_store()
+        with process_locks.hold(self.ns, named=True):
+            store.delete("built", self.ns)
+            store.delete(self.ns)
+
+USER_DIRECTORIES = {
+    "users": UserDirectory("users"),
+    "state": UserDirectory("state"),
+}
+
+def invalidate_user_cache():
+    """Хук явной инвалидации кэша пользователей/состояний"""
+    for directory in USER_DIRECTORIES.values():
+        directory.invalidate()
+
+# Строка, прочитанная find_daily_row для проверки индекса: лист -> (row, values).
+# Следующий row_values той же строки берёт её отсюда, а не из API; любой
+# другой вызов листа и выход из внешнего user_lock её забывают.
+_verified_rows = threading.local()
+
+def forget_verified_rows(name=None):
+    reads = getattr(_verified_rows, "reads", None)
+    if reads:
+        if name is None:
+            reads.clear()
+        else:
+            reads.pop(name, None)
+
+class SheetsTable:
+    """Обёртка над gspread.Worksheet: те же методы + поиски строк.
+    Лист берётся из sheet_handles при обращении, так что запрос платит
+    только за листы, которые действительно трогает"""
+
+    def __init__(self, name):
+        self.name = name
+
+    @property
+    def ws(self):
+        return MeteredWorksheet(sheet_handles.worksheet(self.name))
+
+    def __getattr__(self, item):
+        forget_verified_rows(self.name)
+        return getattr(self.ws, item)
+
+    def row_values(self, row):
+        reads = getattr(_verified_rows, "reads", {})
+        verified = reads.pop(self.name, None)
+        if verified and verified[0] == row:
+            return list(verified[1])
+        return self.ws.row_values(row)
+
+    def append_row(self, values):
+        """Добавляет строку, возвращает её номер"""
+        resp = self.ws.append_row(values)
+        try:
+            updated = resp["updates"]["updatedRange"]
+            row = parse_a1(updated.split("!")[-1].split(":")[0])[0]
+        except Exception:
+            row = len(self.ws.col_values(1))
+        idx = row_index_for(self.name)
+        if idx:
+            idx.add(values, row)
+        return row
+
+    def find_user_row(self, user_id):
+        col = self.ws.col_values(1)
+        for i, val in enumerate(col[1:], start=2):
+            if val == str(user_id):
+                return i
+        return None
+
+    def increment_cell(self, row, col, delta):
+        """Прибавляет delta к числовой ячейке (атомарность — через user_lock)"""
+        vals = self.row_values(row)
+        try:
+            current = int(float(vals[col - 1] or "0")) if len(vals) >= col else 0
+        except ValueError:
+            current = 0
+        total = current + delta
+        self.ws.update_cell(row, col, str(total))
+        return total
+
+    def rows_for_user(self, user_id):
+        return [r for r in self.ws.get_all_values()[1:] if len(r) > 1 and r[1] == str(user_id)]
+
+    def meals_for_day(self, day, user_id=None):
+        """Строки meals за день — одно чтение листа"""
+        return [
+            r for r in self.ws.get_all_values()[1:]
+            if len(r) > 1 and str(r[0]).startswith(day) and (user_id is None or r[1] == str(user_id))
+        ]
+
+    def daily_rows_for_day(self, day):
+        """Строки daily_log за день — одно чтение листа"""
+        return [r for r in self.ws.get_all_values()[1:] if r and str(r[0]).strip() == day]
+
+    def find_daily_row(self, day, user_id):
+        """Строка из RowIndex, сверенная с листом: если в ней уже другой
+        (date, user_id) — строки сдвинули руками, индекс строится заново"""
+        key = (day, str(user_id))
+        idx = row_index_for(self.name)
+        for attempt in range(2):
+            row = idx.get(self.ws, key)
+            if row is None:
+                return None
+            values = self.ws.row_values(row)
+            if daily_key(values) == key:
+                break
+            logger.warning(f"RowIndex {self.name}: row {row} is {daily_key(values)}, expected {key}")
+            idx.invalidate()
+        else:
+            return None
+        if not hasattr(_verified_rows, "reads"):
+            _verified_rows.reads = {}
+        _verified_rows.reads[self.name] = (row, values)
+        return row
+
+# ========= Sheet handles =========
+# Клиент gspread, Spreadsheet и Worksheet живут весь процесс: раньше каждый
+# get_worksheet() стоил open_by_key + worksheet() — два чтения метаданных.
+# При первом обращении таблица открывается, список листов читается одним
+# worksheets(), и тогда же (один раз) создаются недостающие листы с
+# заголовками. Лист, которого нет в кэше (например, партиция нового месяца,
+# созданная другим процессом), дочитывается или создаётся по промаху.
+# Токен сервисного аккаунта google-auth обновляет сам; если API всё же
+# ответил 401, кэш сбрасывается, клиент авторизуется заново, вызов повторяется.
+_sheet_client = None
+
+def authorize_sheets():
+    global _sheet_client
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+    creds_dict = json.loads(GOOGLE_CREDS_JSON)
+    scope = [
+        "https://www.googleapis.com/auth/spreadsheets",
+        "https://www.googleapis.com/auth/drive",
+    ]
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+    _sheet_client = gspread.authorize(creds)
+    logger.info("Google Sheets authorized")
+    return _sheet_client
+
+def sheets_auth_error(e):
+    return getattr(getattr(e, "response", None), "status_code", None) == 401
+
+class SheetHandles:
+    """Кэш Spreadsheet и Worksheet (сырых объектов gspread) между запросами"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.spreadsheet = None
+        self.worksheets = {}
+
+    def get_spreadsheet(self):
+        if self.spreadsheet is None:
+            with self.lock:
+                if self.spreadsheet is None:
+                    self._open()
+        return self.spreadsheet
+
+    def _open(self):
+        client = _sheet_client if _sheet_client is not None else authorize_sheets()
+        sh = sheets_call("*", "open_spreadsheet", client.open_by_key, SHEET_ID)
+        tabs = {ws.title: ws for ws in sheets_call("*", "worksheets", sh.worksheets)}
+        # Листы, нужные с первого запроса: справочники и партиции текущего месяца
+        day = today_str()
+        for name in SHEET_HEADERS:
+            title = partition_name(name, day) if name in PARTITIONED_TABLES else name
+            if title not in tabs:
+                tabs[title] = self._create(sh, title)
+        self.worksheets = tabs
+        self.spreadsheet = sh
+        logger.info(f"Spreadsheet opened: {len(tabs)} worksheets")
+
+    def _create(self, sh, name):
+        logger.warning(f"Worksheet '{name}' not found, creating...")
+        ws = sheets_call(name, "add_worksheet", sh.add_worksheet, title=name, rows=1000, cols=20)
+        if base_table_name(name) in SHEET_HEADERS:
+            sheets_call(name, "append_row", ws.append_row, SHEET_HEADERS[base_table_name(name)])
+        return ws
+
+    def worksheet(self, name):
+        """Сырой gspread.Worksheet: из кэша, по промаху — дочитать или создать"""
+        sh = self.get_spreadsheet()
+        ws = self.worksheets.get(name)
+        if ws is not None:
             return ws
+        import gspread
+        with self.lock:
+            ws = self.worksheets.get(name)
+            if ws is None:
+                try:
+                    ws = sheets_call(name, "worksheet", sh.worksheet, name)
+                except gspread.WorksheetNotFound:
+                    ws = self._create(sh, name)
+                self.worksheets[name] = ws
+        return ws
+
+    def titles(self):
+        """Перечитывает список листов (другие процессы могли создать новые)"""
+        sh = self.get_spreadsheet()
+        tabs = {ws.title: ws for ws in sheets_call("*", "worksheets", sh.worksheets)}
+        with self.lock:
+            self.worksheets = tabs
+        return list(tabs)
+
+    def forget(self, name):
+        with self.lock:
+            self.worksheets.pop(name, None)
+
+    def reset(self):
+        """Сброс всего кэша вместе с клиентом: следующий вызов авторизуется заново"""
+        global _sheet_client
+        with self.lock:
+            self.spreadsheet = None
+            self.worksheets = {}
+            _sheet_client = None
+
+sheet_handles = SheetHandles()
+
+def get_sheet():
+    try:
+        return MeteredSpreadsheet(sheet_handles.get_spreadsheet())
+    except Exception as e:
+        logger.error(f"get_sheet error: {e}")
+        raise
+
+def get_gspread_worksheet(name):
+    """Получает лист Google Sheets с созданием при необходимости"""
+    try:
+        return MeteredWorksheet(sheet_handles.worksheet(name))
     except Exception as e:
         logger.error(f"get_worksheet error: {e}")
         raise
 
+class SheetsStorage:
+    """Хранилище поверх Google Sheets (старое поведение)"""
+
+    def __init__(self):
+        # Список листов кэшируем: has_table() зовут на каждый месяц диапазона
+        self._titles = None
+        self._titles_at = 0.0
+
+    def table(self, name):
+        # Лист открывается при первом вызове метода, а не здесь
+        ws = SheetsTable(name)
+        if self._titles is not None:
+            self._titles.add(name)
+        return ws
+
+    def list_tables(self):
+        titles = [t for t in sheet_handles.titles() if base_table_name(t) in SHEET_HEADERS]
+        self._titles = set(titles)
+        self._titles_at = time.monotonic()
+        return titles
+
+    def has_table(self, name):
+        if self._titles is None or time.monotonic() - self._titles_at > SHEETS_INDEX_TTL:
+            self.list_tables()
+        return name in self._titles
+
+    def drop_table(self, name):
+        get_sheet().del_worksheet(sheet_handles.worksheet(name))
+        sheet_handles.forget(name)
+        if self._titles is not None:
+            self._titles.discard(name)
+
+_storage = None
+_storage_lock = threading.Lock()
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                if STORAGE_BACKEND == "sheets":
+                    _storage = SheetsStorage()
+                else:
+                    _storage = SqliteStorage(SQLITE_PATH)
+                logger.info(f"Storage backend: {STORAGE_BACKEND}")
+    return _storage
+
+def get_worksheet(name):
+    """Получает таблицу текущего хранилища (meals/daily_log — партиция текущего месяца)"""
+    if name in PARTITIONED_TABLES:
+        return get_partition(name)
+    return get_storage().table(name)
+
+_legacy_checked = False
+_legacy_lock = threading.Lock()
+
+def get_partition(name, day=None):
+    """Партиция таблицы name за месяц дня day (по умолчанию — сегодня)"""
+    global _legacy_checked
+    if not _legacy_checked:
+        with _legacy_lock:
+            if not _legacy_checked:
+                migrate_legacy_partitions()
+                _legacy_checked = True
+    return get_storage().table(partition_name(name, day or today_str()))
+
+def migrate_legacy_partitions():
+    """Раскладывает строки старых непартиционированных meals/daily_log по месяцам.
+
+    Один воркер за раз (межпроцессный лок), и повторный запуск после падения
+    не задваивает строки: в SQLite перенос и DROP — одна транзакция, в Google
+    Sheets лист сначала переименовывается в <name>_migrating, а в партицию
+    дописываются только строки, которых там ещё нет.
+    """
+    with process_locks.hold("migrate", named=True):
+        storage = get_storage()
+        for name in PARTITIONED_TABLES:
+            if isinstance(storage, SqliteStorage):
+                migrate_legacy_sqlite(storage, name)
+            else:
+                migrate_legacy_sheet(storage, name)
+        invalidate_sheet_indexes()
+
+def legacy_rows_by_period(rows):
+    by_period = {}
+    for r in rows:
+        if r and re.match(r"^\d{4}-\d{2}", str(r[0])):
+            by_period.setdefault(period_of(str(r[0])), []).append(r)
+    return by_period
+
+def migrate_legacy_sqlite(storage, name):
+    if name not in storage.list_tables():
+        return
+    try:
+        with storage.transaction():
+            rows = storage.table(name).get_all_values()[1:]
+            by_period = legacy_rows_by_period(rows)
+            for period, period_rows in sorted(by_period.items()):
+                storage.table(f"{name}_{period}").append_rows(period_rows)
+            storage.drop_table(name)
+    except Exception:
+        # CREATE/DROP откатились вместе с транзакцией — кэш имён таблиц тоже
+        storage._tables = set(storage.list_tables())
+        raise
+    logger.info(f"Migrated legacy {name}: {len(rows)} rows into {len(by_period)} partitions")
+
+def row_key(row):
+    """Строка листа для сравнения: без хвостовых пустых ячеек"""
+    values = [str(v) for v in row]
+    while values and values[-1] == "":
+        values.pop()
+    return tuple(values)
+
+def migrate_legacy_sheet(storage, name):
+    titles = sheet_handles.titles()
+    migrating = f"{name}_migrating"
+    if name in titles:
+        # Переименование — отметка «перенос начат»: после падения продолжим с него
+        MeteredWorksheet(sheet_handles.worksheet(name)).update_title(migrating)
+        sheet_handles.forget(name)
+    elif migrating not in titles:
+        return
+    sheet_handles.forget(migrating)
+    legacy = MeteredWorksheet(sheet_handles.worksheet(migrating))
+    rows = legacy.get_all_values()[1:]
+    by_period = legacy_rows_by_period(rows)
+    copied = 0
+    for period, period_rows in sorted(by_period.items()):
+        part = storage.table(f"{name}_{period}")
+        present = Counter(row_key(r) for r in part.get_all_values()[1:])
+        missing = []
+        for r in period_rows:
+            key = row_key(r)
+            if present[key]:
+                present[key] -= 1
+            else:
+                missing.append(r)
+        if missing:
+            part.append_rows(missing)
+            copied += len(missing)
+    # В таблице Google оставляем исходный лист под другим именем
+    legacy.update_title(f"{name}_migrated")
+    sheet_handles.forget(migrating)
+    logger.info(f"Migrated legacy {name}: {copied} of {len(rows)} rows into {len(by_period)} partitions")
+
+def archive_path(name):
+    return os.path.join(ARCHIVE_DIR, f"{name}.json.gz")
+
+def partition_rows_for_user(name, user_id, start_day, end_day):
+    """Строки пользователя за [start_day, end_day] (в SQLite — по индексу user_id)"""
+    storage = get_storage()
+    rows = []
+    for period in periods_between(start_day, end_day):
+        pname = f"{name}_{period}"
+        if storage.has_table(pname):
+            period_rows = storage.table(pname).rows_for_user(user_id)
+        elif os.path.exists(archive_path(pname)):
+            with gzip.open(archive_path(pname), "rt", encoding="utf-8") as f:
+                period_rows = [r for r in json.load(f)["rows"] if len(r) > 1 and r[1] == str(user_id)]
+        else:
+            continue
+        rows.extend(r for r in period_rows if r and start_day <= str(r[0])[:10] <= end_day)
+    return rows
+
+def archive_closed_partitions():
+    """Фоновый архиватор: партиции старше ARCHIVE_AFTER_MONTHS месяцев -> json.gz"""
+    try:
+        storage = get_storage()
+        if not isinstance(storage, SqliteStorage):
+            # В Google Sheets закрытые месяцы и так лежат отдельными листами
+            logger.info("archive_closed_partitions: sheets backend, skipping")
+            return 0
+        get_partition("daily_log")  # заодно мигрирует старые таблицы
+        cutoff = shift_period(period_of(today_str()), -(ARCHIVE_AFTER_MONTHS - 1))
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        archived = 0
+        for name in storage.list_tables():
+            base, period = split_partition(name)
+            if not period or period >= cutoff:
+                continue
+            rows = storage.table(name).get_all_values()
+            path = archive_path(name)
+            if os.path.exists(path):
+                with gzip.open(path, "rt", encoding="utf-8") as f:
+                    rows = rows + json.load(f)["rows"]
+            tmp = path + ".tmp"
+            with gzip.open(tmp, "wt", encoding="utf-8") as f:
+                json.dump({"table": name, "header": rows[0], "rows": rows[1:]}, f, ensure_ascii=False)
+            os.replace(tmp, path)
+            storage.drop_table(name)
+            archived += 1
+            logger.info(f"Archived {name}: {len(rows) - 1} rows -> {path}")
+        return archived
+    except Exception as e:
+        logger.error(f"archive_closed_partitions error: {e}")
+        return 0
+
+# Экспорт не затирает лист, если в SQLite заметно меньше строк (пустая база
+# после переезда, не тот файл): нужен явный force
+EXPORT_SHRINK_LIMIT = float(os.environ.get("EXPORT_SHRINK_LIMIT", "0.9"))
+
+def import_from_sheets():
+    """Разовый перенос Google Sheets -> SQLite перед переключением STORAGE_BACKEND=sqlite.
+
+    Пишет только в пустые таблицы, так что повторный вызов ничего не задваивает.
+    Возвращает {таблица: перенесено строк}.
+    """
+    global _legacy_checked
+    if not all([SHEET_ID, GOOGLE_CREDS_JSON]):
+        raise ValueError("Import requires SHEET_ID and GOOGLE_CREDS_JSON")
+    storage = get_storage()
+    if not isinstance(storage, SqliteStorage):
+        raise ValueError("Import requires STORAGE_BACKEND=sqlite")
+    imported = {}
+    for name in sheet_handles.titles():
+        if base_table_name(name) not in SHEET_HEADERS:
+            continue
+        table = storage.table(name)
+        if len(table.get_all_values()) > 1:
+            logger.info(f"import_from_sheets: {name} is not empty, skipped")
+            continue
+        values = get_gspread_worksheet(name).get_all_values()
+        if not values:
+            continue
+        # Колонки сопоставляем по заголовку: в листе их могли переставить руками
+        header = [str(h).strip() for h in values[0]]
+        pos = [header.index(c) if c in header else None for c in table.columns]
+        rows = [[r[i] if i is not None and i < len(r) else "" for i in pos]
+                for r in values[1:] if any(str(v).strip() for v in r)]
+        table.append_rows(rows)
+        imported[name] = len(rows)
+        logger.info(f"Imported {name}: {len(rows)} rows")
+    # Старые meals/daily_log из листа разложатся по партициям при следующем обращении
+    with _legacy_lock:
+        _legacy_checked = False
+    invalidate_sheet_indexes()
+    return imported
+
+def export_to_sheets(force=False):
+    """Выгружает все таблицы SQLite в Google Sheets (полная перезапись листов).
+
+    Если таблица пуста или меньше листа больше чем на EXPORT_SHRINK_LIMIT,
+    экспорт отказывается (ValueError) и ничего не трогает — без force=True.
+    """
+    if not all([SHEET_ID, GOOGLE_CREDS_JSON]):
+        raise ValueError("Export requires SHEET_ID and GOOGLE_CREDS_JSON")
+    storage = get_storage()
+    if not isinstance(storage, SqliteStorage):
+        logger.info("export_to_sheets: backend is already sheets, nothing to do")
+        return
+    plan = []
+    refused = []
+    for name in storage.list_tables():
+        rows = storage.table(name).get_all_values()
+        ws = get_gspread_worksheet(name)
+        sheet_rows = len(ws.get_all_values()) - 1
+        if sheet_rows > 0 and len(rows) - 1 < sheet_rows * EXPORT_SHRINK_LIMIT:
+            refused.append(f"{name} ({len(rows) - 1} < {sheet_rows})")
+        plan.append((name, ws, rows))
+    if refused and not force:
+        raise ValueError(f"Export would shrink sheets: {', '.join(refused)}")
+    for name, ws, rows in plan:
+        ws.clear()
+        ws.resize(rows=max(len(rows), 2))
+        ws.update(range_name="A1", values=rows)
+        logger.info(f"Exported {name}: {len(rows) - 1} rows")
+
+# ========= Conversation state =========
+# Состояние диалога (pending_action + JSON уточнений) живёт в памяти процесса.
+# Каждое изменение дописывается в журнал STATE_JOURNAL_PATH (JSON lines), при
+# старте журнал проигрывается заново, а когда он разрастается — сжимается до
+# снимка живых записей. Брошенные диалоги истекают через STATE_TTL секунд.
+# Журнал общий для воркеров: пишут в него под межпроцессным локом, а перед
+# каждым чтением процесс догоняет строки, дописанные другими (фото может
+# прийти в другой воркер, чем нажатие «записать еду»).
+# Лист state — только необязательное зеркало (STATE_MIRROR=1).
+STATE_JOURNAL_PATH = os.environ.get("STATE_JOURNAL_PATH", "state_journal.jsonl")
+STATE_TTL = int(os.environ.get("STATE_TTL", "3600"))
+STATE_MIRROR = os.environ.get("STATE_MIRROR", "0") == "1"
+
+class ConversationStore:
+    """user_id -> {"action", "data", "since"} + журнал для восстановления после падения"""
+
+    def __init__(self, path, ttl=STATE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.file_lock = f"journal:{os.path.abspath(path)}"
+        self.inode = None
+        self.offset = 0
+        self.journal_lines = 0
+        with self.lock, process_locks.hold(self.file_lock, named=True):
+            self._recover()
+
+    def _apply(self, rec):
+        if rec.get("a"):
+            self.entries[rec["u"]] = {"action": rec["a"], "data": rec.get("d", ""), "since": rec.get("t", 0)}
+        else:
+            self.entries.pop(rec["u"], None)
+
+    def _sync(self):
+        """Догоняет журнал: новые строки с self.offset, после сжатия (новый inode) — целиком"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return 0
+        if st.st_ino == self.inode and st.st_size <= self.offset:
+            return 0
+        with open(self.path, "rb") as f:
+            inode = os.fstat(f.fileno()).st_ino
+            if inode != self.inode:
+                self.entries = {}
+                self.inode = inode
+                self.offset = 0
+                self.journal_lines = 0
+            f.seek(self.offset)
+            chunk = f.read()
+        end = chunk.rfind(b"\n") + 1  # недописанный хвост дочитаем в следующий раз
+        applied = 0
+        for line in chunk[:end].splitlines():
+            try:
+                self._apply(json.loads(line))
+                applied += 1
+            except Exception:
+                # Недописанная при падении строка
+                logger.warning(f"ConversationStore: skip bad journal line {self.journal_lines + applied + 1}")
+        self.offset += end
+        self.journal_lines += applied
+        return applied
+
+    def _recover(self):
+        replayed = self._sync()
+        now = time.time()
+        self.entries = {u: e for u, e in self.entries.items() if now - e["since"] <= self.ttl}
+        self._compact()
+        logger.info(f"ConversationStore recovered {len(self.entries)} states from {replayed} records")
+
+    def _compact(self):
+        """Переписывает журнал снимком живых записей (под file_lock)"""
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for uid, e in self.entries.items():
+                f.write(json.dumps({"u": uid, "a": e["action"], "d": e["data"], "t": e["since"]}, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.path)
+        st = os.stat(self.path)
+        self.inode = st.st_ino
+        self.offset = st.st_size
+        self.journal_lines = len(self.entries)
+
+    def _write(self, rec):
+        """Применяет запись и дописывает её в журнал; зовётся под self.lock"""
+        with process_locks.hold(self.file_lock, named=True):
+            self._sync()
+            self._apply(rec)
+            with open(self.path, "ab") as f:
+                f.write((json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8"))
+                self.inode = os.fstat(f.fileno()).st_ino
+                self.offset = f.tell()
+            self.journal_lines += 1
+            if self.journal_lines > 2 * len(self.entries) + 1000:
+                self._compact()
+
+    def set(self, user_id, action, data=""):
+        rec = {"u": str(user_id), "a": action, "d": data or "", "t": time.time()}
+        with self.lock:
+            self._write(rec)
+
+    def get(self, user_id):
+        """(pending_action, data); истёкшее состояние считается пустым"""
+        uid = str(user_id)
+        with self.lock:
+            self._sync()
+            e = self.entries.get(uid)
+            if not e:
+                return "", ""
+            if time.time() - e["since"] > self.ttl:
+                self._write({"u": uid, "a": ""})
+                return "", ""
+            return e["action"], e["data"]
+
+    def clear(self, user_id):
+        """Сбрасывает состояние; False, если его и не было"""
+        uid = str(user_id)
+        with self.lock:
+            self._sync()
+            if uid not in self.entries:
+                return False
+            self._write({"u": uid, "a": ""})
+            return True
+
+_conversation_store = None
+_conversation_store_lock = threading.Lock()
+
+def get_conversation_store():
+    global _conversation_store
+    if _conversation_store is None:
+        with _conversation_store_lock:
+            if _conversation_store is None:
+                _conversation_store = ConversationStore(STATE_JOURNAL_PATH)
+    return _conversation_store
+
+# ========= Write buffer =========
+# Запись ячеек копится в буфере на время обработки запроса и уходит одним
+# batch_update на лист. Вне write_batch() каждая запись сразу отправляется
+# одним batch_update (вместо нескольких update_cell).
+# Буфер сбрасывается не позже, чем снимается user_lock (иначе запись в строку
+# daily_log перемешается с записями другого воркера) и чем уходит ответ
+# пользователю (tg_send): «Записал ✅» — только после того, как записали.
+
+# daily_log писали через update_cell (USER_ENTERED), остальные листы — через update (RAW)
+VALUE_INPUT_OPTIONS = {"daily_log": "USER_ENTERED"}
+
+_write_local = threading.local()
+
+class WriteFlushError(Exception):
+    """batch_update буфера не прошёл; записи мимо буфера (append_row, инкремент) уже сделаны"""
+
+class WriteBuffer:
+    """Отложенные записи: имя листа -> (лист, {(row, col): value})"""
+
+    def __init__(self):
+        self.pending = {}
+        self.callbacks = []
+
+    def set(self, ws, row, col, values):
+        _, cells = self.pending.setdefault(ws.name, (ws, {}))
+        for i, v in enumerate(values):
+            cells[(row, col + i)] = str(v)
+
+    def discard(self, ws, row, col):
+        if ws.name in self.pending:
+            self.pending[ws.name][1].pop((row, col), None)
+
+    def overlay(self, ws, row, values):
+        """Накладывает ещё не записанные значения на прочитанную строку"""
+        if ws.name not in self.pending:
+            return values
+        _, cells = self.pending[ws.name]
+        for (r, c), v in cells.items():
+            if r == row:
+                while len(values) < c:
+                    values.append("")
+                values[c - 1] = v
+        return values
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        callbacks, self.callbacks = self.callbacks, []
+        try:
+            for name, (ws, cells) in pending.items():
+                write_cells(ws, cells)
+        except Exception as e:
+            raise WriteFlushError(str(e)) from e
+        # Колбэки (сброс кэшей) — только после успешной записи
+        for cb in callbacks:
+            cb()
+
+def cells_to_ranges(cells):
+    """{(row, col): value} -> [{"range": "B5:D5", "values": [[...]]}] (соседние ячейки строки склеиваются)"""
+    data = []
+    run = None
+    for (row, col) in sorted(cells):
+        if run and run["row"] == row and run["end"] == col - 1:
+            run["values"].append(cells[(row, col)])
+            run["end"] = col
+        else:
+            run = {"row": row, "start": col, "end": col, "values": [cells[(row, col)]]}
+            data.append(run)
+    return [
+        {"range": f"{col_letter(r['start'])}{r['row']}:{col_letter(r['end'])}{r['row']}",
+         "values": [r["values"]]}
+        for r in data
+    ]
+
+def col_letter(col):
+    """1 -> A, 27 -> AA"""
+    letters = ""
+    while col > 0:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+def write_cells(ws, cells):
+    if not cells:
+        return
+    data = cells_to_ranges(cells)
+    option = VALUE_INPUT_OPTIONS.get(base_table_name(ws.name), "RAW")
+    logger.info(f"batch_update {ws.name}: {len(cells)} cells in {len(data)} ranges")
+    try:
+        ws.batch_update(data, value_input_option=option)
+    except Exception as e:
+        # Строки могли сдвинуться — не доверяем индексам и кэшу
+        logger.error(f"batch_update {ws.name} error: {e}")
+        invalidate_sheet_indexes()
+        raise
+
+def current_write_buffer():
+    return getattr(_write_local, "buffer", None)
+
+@contextmanager
+def write_batch():
+    """Копит записи в листы до выхода из блока (вложенные блоки — общий буфер)"""
+    outer = current_write_buffer()
+    if outer is not None:
+        yield outer
+        return
+    buf = WriteBuffer()
+    _write_local.buffer = buf
+    try:
+        yield buf
+    finally:
+        _write_local.buffer = None
+        buf.flush()
+
+def flush_writes():
+    """Отправляет накопленное сейчас; буфер остаётся открытым для следующих записей"""
+    buf = current_write_buffer()
+    if buf is not None:
+        buf.flush()
+
+def write_row(ws, row, col, values):
+    """Записывает values в строку row начиная с col (через буфер, если он открыт)"""
+    buf = current_write_buffer()
+    if buf is not None:
+        buf.set(ws, row, col, values)
+    else:
+        write_cells(ws, {(row, col + i): str(v) for i, v in enumerate(values)})
+
+def after_write(callback):
+    """Вызывает callback после записи буфера (или сразу, если буфера нет)"""
+    buf = current_write_buffer()
+    if buf is not None:
+        buf.callbacks.append(callback)
+    else:
+        callback()
+
+def write_batched(f):
+    """Декоратор роута: все записи в листы за запрос уходят одним batch_update"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        with write_batch():
+            return f(*args, **kwargs)
+    return wrapper
+
 # ========= Sheet helpers =========
 def find_row_by_user(ws, user_id):
     try:
-        col = ws.col_values(1)
-        for i, val in enumerate(col[1:], start=2):
-            if val == str(user_id):
-                return i
-        return None
+        directory = USER_DIRECTORIES.get(ws.name)
+        if directory:
+            return directory.lookup(ws, user_id)[0]
+        return ws.find_user_row(user_id)
     except Exception as e:
         logger.error(f"find_row_by_user error: {e}")
         return None
 
+def find_row_for_write(ws, user_id):
+    """Номер строки пользователя для перезаписи: строку из кэша сверяем с
+    колонкой A (лист могли править руками), при расхождении — перечитываем"""
+    directory = USER_DIRECTORIES.get(ws.name)
+    for attempt in range(2):
+        r = find_row_by_user(ws, user_id)
+        if not r or directory is None:
+            return r
+        values = ws.row_values(r)
+        if values and str(values[0]).strip() == str(user_id):
+            return r
+        logger.warning(f"{ws.name}: row {r} belongs to {values[:1]}, expected user {user_id}")
+        directory.invalidate()
+    return None
+
+def get_user_profile(ws_users, user_id):
+    """Профиль пользователя из кэша (None, если пользователя нет)"""
+    r, vals = USER_DIRECTORIES["users"].lookup(ws_users, user_id)
+    if not r:
+        return None
+    return parse_user_profile(vals)
+
 def upsert_user(ws_users, user_id, first_name, data):
     row = [
         user_id,
@@ -405,93 +2792,113 @@ def upsert_user(ws_users, user_id, first_name, data):
         str(data.get("checkin_time", "08:05")),
         str(data.get("checkout_time", "22:30")),
     ]
-    r = find_row_by_user(ws_users, user_id)
-    if r:
-        ws_users.update(range_name=f"A{r}:M{r}", values=[row])
-        logger.info(f"Updated user {user_id} at row {r}")
-    else:
-        ws_users.append_row(row)
-        logger.info(f"Created user {user_id}")
-
-def state_set(ws_state, user_id, pending_action, last_prompt=""):
-    r = find_row_by_user(ws_state, user_id)
-    now = iso_now()
-    row = [user_id, pending_action, now, last_prompt]
-    if r:
-        ws_state.update(range_name=f"A{r}:D{r}", values=[row])
-    else:
-        ws_state.append_row(row)
+    with user_lock(user_id):
+        r = find_row_for_write(ws_users, user_id)
+        try:
+            if r:
+                write_row(ws_users, r, 1, row)
+                logger.info(f"Updated user {user_id} at row {r}")
+            else:
+                r = ws_users.append_row(row)
+                logger.info(f"Created user {user_id}")
+        except Exception:
+            invalidate_user_cache()
+            raise
+        USER_DIRECTORIES["users"].put(user_id, r, [str(v) for v in row])
+    reminder_schedule.update_user(parse_user_profile([str(v) for v in row]))
+    today_cache.invalidate(user_id)
 
-def state_get(ws_state, user_id):
-    """Получаем pending_action из state"""
-    r = find_row_by_user(ws_state, user_id)
-    if not r:
-        logger.debug(f"state_get: no row for user {user_id}")
-        return ""
-    vals = ws_state.row_values(r)
-    if len(vals) > 1:
-        logger.debug(f"state_get: user {user_id}, action={vals[1]}")
-        return vals[1]
-    return ""
-
-def state_get_data(ws_state, user_id):
-    """Получаем last_prompt (JSON данные) из state"""
-    r = find_row_by_user(ws_state, user_id)
-    if not r:
-        return ""
-    vals = ws_state.row_values(r)
-    return vals[3] if len(vals) > 3 else ""
+def sheet_state_set(ws_state, user_id, pending_action, last_prompt=""):
+    """Зеркало состояния в лист state"""
+    row = [user_id, pending_action, iso_now(), last_prompt]
+    with user_lock(user_id):
+        r = find_row_for_write(ws_state, user_id)
+        try:
+            if r:
+                write_row(ws_state, r, 1, row)
+            else:
+                r = ws_state.append_row(row)
+        except Exception:
+            invalidate_user_cache()
+            raise
+        USER_DIRECTORIES["state"].put(user_id, r, [str(v) for v in row])
 
-def state_clear(ws_state, user_id):
-    r = find_row_by_user(ws_state, user_id)
+def sheet_state_clear(ws_state, user_id):
+    r, vals = USER_DIRECTORIES["state"].lookup(ws_state, user_id)
     if not r:
         return
-    ws_state.update(range_name=f"B{r}:D{r}", values=[[""]])
+    try:
+        write_row(ws_state, r, 2, [""])
+    except Exception:
+        invalidate_user_cache()
+        raise
+    vals = list(vals) + [""] * (2 - len(vals))
+    vals[1] = ""
+    USER_DIRECTORIES["state"].put(user_id, r, vals)
+
+def mirror_state(user_id, pending_action=None, last_prompt=""):
+    """STATE_MIRROR=1: повторяем изменение состояния в листе state (ошибки не роняют диалог)"""
+    if not STATE_MIRROR:
+        return
+    try:
+        ws_state = get_worksheet("state")
+        if pending_action:
+            sheet_state_set(ws_state, user_id, pending_action, last_prompt)
+        else:
+            sheet_state_clear(ws_state, user_id)
+    except Exception as e:
+        logger.error(f"mirror_state error: {e}")
+
+def state_set(user_id, pending_action, last_prompt=""):
+    get_conversation_store().set(user_id, pending_action, last_prompt)
+    mirror_state(user_id, pending_action, last_prompt)
+
+def state_get(user_id):
+    """Получаем pending_action"""
+    action = get_conversation_store().get(user_id)[0]
+    logger.debug(f"state_get: user {user_id}, action={action}")
+    return action
+
+def state_get_data(user_id):
+    """Получаем last_prompt (JSON данные)"""
+    return get_conversation_store().get(user_id)[1]
+
+def state_clear(user_id):
+    if get_conversation_store().clear(user_id):
+        mirror_state(user_id)
 
 def daily_find_or_create(ws_daily, user_id, day):
-    """Находит или создаёт строку для пользователя на конкретный день"""
+    """Находит или создаёт строку для пользователя на конкретный день.
+    Под user_lock: иначе два воркера одновременно создают две строки за день"""
     try:
-        rows = ws_daily.get_all_values()
-        logger.info(f"daily_find_or_create: day={day}, user={user_id}, total_rows={len(rows)}")
+        with user_lock(user_id):
+            r = ws_daily.find_daily_row(day, user_id)
+            if r:
+                logger.info(f"daily_find_or_create: day={day}, user={user_id}, found row {r}")
+                return r
         
-        # Ищем существующую запись (начиная со строки 2, пропускаем заголовки)
-        for i in range(1, len(rows)):
-            row = rows[i]
-            
-            # Пропускаем пустые или слишком короткие строки
-            if len(row) < 2:
-                continue
-            
-            row_day = str(row[0]).strip() if row[0] else ""
-            row_user = str(row[1]).strip() if row[1] else ""
-            
-            if row_day == day and row_user == str(user_id):
-                logger.info(f"Found existing row {i+1}")
-                return i + 1  # 1-based index для gspread
-        
-        # Не нашли — создаём новую строку с полными данными
-        new_row = [
-            day,           # A - date (1)
-            str(user_id),  # B - user_id (2)
-            "",            # C - weight_morning_kg (3)
-            "",            # D - weight_evening_kg (4)
-            "",            # E - steps (5)
-            "",            # F - workout (6)
-            "",            # G - water_ml (7)
-            "",            # H - sleep_h (8)
-            "0",           # I - kcal_eaten (9) - инициализируем 0!
-            "",            # J - kcal_left (10)
-            "",            # K - mood (11)
-            "",            # L - untracked (12)
-            "",            # M - comment (13)
-            iso_now()      # N - updated_at (14)
-        ]
-        
-        ws_daily.append_row(new_row)
-        new_row_num = len(rows) + 1
-        logger.info(f"Created new row {new_row_num}")
-        return new_row_num
+            # Не нашли — создаём новую строку с полными данными
+            new_row = [
+                day,           # A - date (1)
+                str(user_id),  # B - user_id (2)
+                "",            # C - weight_morning_kg (3)
+                "",            # D - weight_evening_kg (4)
+                "",            # E - steps (5)
+                "",            # F - workout (6)
+                "",            # G - water_ml (7)
+                "",            # H - sleep_h (8)
+                "0",           # I - kcal_eaten (9) - инициализируем 0!
+                "",            # J - kcal_left (10)
+                "",            # K - mood (11)
+                "",            # L - untracked (12)
+                "",            # M - comment (13)
+                iso_now()      # N - updated_at (14)
+            ]
         
+            new_row_num = ws_daily.append_row(new_row)
+            logger.info(f"Created new row {new_row_num}")
+            return new_row_num
+
     except Exception as e:
         logger.error(f"daily_find_or_create error: {e}")
         raise
@@ -506,20 +2913,25 @@ def daily_set(ws_daily, row, col, value):
         
         logger.info(f"daily_set: row={row}, col={col}, value='{value}'")
         
-        # Записываем значение
-        ws_daily.update_cell(row, col, str(value))
-        
-        # Обновляем updated_at (колонка 14 = N)
-        ws_daily.update_cell(row, 14, iso_now())
+        # Записываем значение и updated_at (колонка 14 = N) одним batch_update
+        with write_batch():
+            write_row(ws_daily, row, col, [str(value)])
+            write_row(ws_daily, row, 14, [iso_now()])
         
     except Exception as e:
         logger.error(f"daily_set error: row={row}, col={col}, value={value}, error: {e}")
+        idx = row_index_for(ws_daily.name)
+        if idx:
+            idx.invalidate()
         raise
 
 def get_daily_row_values(ws_daily, row):
     """Получает значения строки с проверкой длины"""
     try:
         values = ws_daily.row_values(row)
+        buf = current_write_buffer()
+        if buf is not None:
+            values = buf.overlay(ws_daily, row, values)
         # Дополняем до 14 колонок пустыми строками
         while len(values) < 14:
             values.append("")
@@ -528,34 +2940,36 @@ def get_daily_row_values(ws_daily, row):
         logger.error(f"get_daily_row_values error: row={row}, error: {e}")
         return [""] * 14
 
+def calc_kcal_left(kcal_target, steps, kcal_eaten):
+    """Остаток калорий: база + шаги (1000 шагов = 40 ккал) - съеденное"""
+    kcal_from_steps = int(steps * 0.04)
+    return max(0, kcal_target + kcal_from_steps - kcal_eaten)
+
 def recalculate_daily_stats(ws_daily, ws_users, ws_meals, user_id, day, row=None):
     """Пересчитывает kcal_left с учётом шагов и съеденного"""
     try:
-        if row is None:
-            row = daily_find_or_create(ws_daily, user_id, day)
-        
-        # Получаем текущие значения
-        values = get_daily_row_values(ws_daily, row)
-        
-        steps = int(values[4]) if values[4] else 0      # Колонка 5 (E) = steps
-        kcal_eaten = int(values[8]) if values[8] else 0  # Колонка 9 (I) = kcal_eaten
-        
-        # Получаем цель пользователя
-        targets = get_user_targets(ws_users, user_id) or {"kcal_target": 2100}
-        kcal_target = targets["kcal_target"]
-        
-        # Калории от шагов: 1000 шагов = 40 ккал
-        kcal_from_steps = int(steps * 0.04)
-        
-        # Общий бюджет = база + шаги
-        total_budget = kcal_target + kcal_from_steps
-        kcal_left = max(0, total_budget - kcal_eaten)
-        
-        logger.info(f"Recalculate: target={kcal_target}, steps={steps}, "
-                   f"from_steps={kcal_from_steps}, eaten={kcal_eaten}, left={kcal_left}")
-        
-        # Записываем kcal_left (колонка 10 = J)
-        daily_set(ws_daily, row, 10, str(kcal_left))
+        with user_lock(user_id):
+            if row is None:
+                row = daily_find_or_create(ws_daily, user_id, day)
+            
+            # Получаем текущие значения
+            values = get_daily_row_values(ws_daily, row)
+            
+            steps = int(values[4]) if values[4] else 0      # Колонка 5 (E) = steps
+            kcal_eaten = int(values[8]) if values[8] else 0  # Колонка 9 (I) = kcal_eaten
+            
+            # Получаем цель пользователя
+            targets = get_user_targets(ws_users, user_id) or {"kcal_target": 2100}
+            kcal_target = targets["kcal_target"]
+            
+            kcal_left = calc_kcal_left(kcal_target, steps, kcal_eaten)
+            
+            logger.info(f"Recalculate: target={kcal_target}, steps={steps}, "
+                       f"eaten={kcal_eaten}, left={kcal_left}")
+            
+            # Записываем kcal_left (колонка 10 = J)
+            daily_set(ws_daily, row, 10, str(kcal_left))
+        today_cache.invalidate(user_id)
         
     except Exception as e:
         logger.error(f"recalculate_daily_stats error: {e}")
@@ -575,67 +2989,717 @@ def calc_kcal_target(weight_kg, height_cm, age, activity, goal_weeks):
         if goal_weeks is not None and float(goal_weeks) <= 10:
             kcal_target = max(1500, int(tdee - tdee * 0.25))
 
-        return int(tdee), int(kcal_target), int(steps_target)
-    except Exception as e:
-        logger.error(f"calc_kcal_target error: {e}")
-        return 2500, 2100, 9000
+        return int(tdee), int(kcal_target), int(steps_target)
+    except Exception as e:
+        logger.error(f"calc_kcal_target error: {e}")
+        return 2500, 2100, 9000
+
+# ========= Meals estimation =========
+# Оценка калорий по тексту: словарь основ (FOOD_DICT_PATH) собирается в один
+# автомат Ахо — Корасик, так что поиск всех продуктов — один проход по тексту
+# независимо от размера словаря. Количество берётся из слов рядом с продуктом:
+# "2 яйца", "200 г гречки", "гречка 200г", "стакан молока", "большая пицца".
+FOOD_DICT_PATH = os.environ.get(
+    "FOOD_DICT_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "food_dict.tsv"))
+TEXT_KCAL_FALLBACK = 500
+
+NUMBER_WORDS = {
+    "один": 1, "одна": 1, "одно": 1, "одну": 1, "два": 2, "две": 2, "пара": 2, "пару": 2,
+    "три": 3, "четыре": 4, "пять": 5, "шесть": 6, "семь": 7, "восемь": 8, "девять": 9,
+    "десять": 10, "несколько": 3, "пол": 0.5, "половина": 0.5, "половину": 0.5,
+    "полтора": 1.5, "полторы": 1.5,
+}
+# Единицы: ("g", грамм в единице) или ("piece", None) / ("portion", None)
+UNIT_PREFIXES = [
+    ("килограмм", ("g", 1000)), ("кг", ("g", 1000)),
+    ("грамм", ("g", 1)), ("гр", ("g", 1)), ("г", ("g", 1)),
+    ("миллилитр", ("g", 1)), ("мл", ("g", 1)),
+    ("литр", ("g", 1000)), ("л", ("g", 1000)),
+    ("штук", ("piece", None)), ("шт", ("piece", None)),
+    ("кус", ("piece", None)), ("ломт", ("piece", None)), ("дольк", ("piece", None)),
+    ("порци", ("portion", None)), ("тарелк", ("g", 300)), ("миск", ("g", 300)),
+    ("стакан", ("g", 250)), ("чашк", ("g", 250)), ("кружк", ("g", 300)),
+    ("ложк", ("g", 15)), ("банк", ("g", 330)), ("бутылк", ("g", 500)),
+    ("горст", ("g", 30)),
+]
+# Единицы-сокращения, которые должны быть отдельным словом ("г", а не "гречка")
+SHORT_UNITS = {"кг", "гр", "г", "мл", "л", "шт"}
+PORTION_WORDS = {
+    "больш": 1.3, "огромн": 1.6, "двойн": 2.0, "маленьк": 0.8, "небольш": 0.8, "мини": 0.6,
+}
+CLAUSE_SPLIT_RE = re.compile(r"[,;+\n]|\s(?:и|с|со|плюс|а также)\s")
+TOKEN_RE = re.compile(r"\d+(?:[.,]\d+)?|[a-zа-я]+")
+TRAILING_QTY_RE = re.compile(r"\s*(\d+(?:[.,]\d+)?)\s*([а-я]+)")
+
+def normalize_food_text(text):
+    return (text or "").lower().replace("ё", "е")
+
+class PatternMatcher:
+    """Автомат Ахо — Корасик: все вхождения словаря за один проход по тексту"""
+
+    def __init__(self, patterns):
+        """patterns: {строка: значение}"""
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [None]      # (длина, значение) шаблона, кончающегося в узле
+        self.dict_link = [0]   # ближайший по fail-цепочке узел с out
+        for pattern, value in patterns.items():
+            node = 0
+            for ch in pattern:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(None)
+                    self.dict_link.append(0)
+                node = nxt
+            self.out[node] = (len(pattern), value)
+        self._build_links()
+
+    def _build_links(self):
+        queue_ = list(self.goto[0].values())
+        i = 0
+        while i < len(queue_):
+            node = queue_[i]
+            i += 1
+            for ch, nxt in self.goto[node].items():
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                fn = self.goto[f].get(ch, 0)
+                self.fail[nxt] = fn if fn != nxt else 0
+                self.dict_link[nxt] = fn if self.out[fn] else self.dict_link[fn]
+                queue_.append(nxt)
+
+    def __len__(self):
+        return sum(1 for o in self.out if o)
+
+    def finditer(self, text):
+        """-> (start, end, value) для всех вхождений"""
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            hit = node if self.out[node] else self.dict_link[node]
+            while hit:
+                length, value = self.out[hit]
+                yield i + 1 - length, i + 1, value
+                hit = self.dict_link[hit]
+
+def load_food_dict(path):
+    """food_dict.tsv -> {основа: {"kcal": на 100 г, "portion": г, "piece": г, "whole": bool}}"""
+    entries = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            cols = line.split("\t")
+            stem = normalize_food_text(cols[0].strip())
+            whole = stem.endswith("$")
+            stem = stem.rstrip("$")
+            portion = float(cols[2])
+            entries[stem] = {
+                "kcal": float(cols[1]),
+                "portion": portion,
+                "piece": float(cols[3]) if len(cols) > 3 and cols[3].strip() else portion,
+                "whole": whole,
+            }
+    return entries
+
+_food_matcher = None
+_food_matcher_lock = threading.Lock()
+
+def get_food_matcher():
+    global _food_matcher
+    if _food_matcher is None:
+        with _food_matcher_lock:
+            if _food_matcher is None:
+                try:
+                    entries = load_food_dict(FOOD_DICT_PATH)
+                except OSError as e:
+                    logger.warning(f"Food dictionary unavailable ({e}), text meals use the fallback")
+                    entries = {}
+                _food_matcher = PatternMatcher(entries)
+                logger.info(f"Food dictionary: {len(entries)} stems")
+    return _food_matcher
+
+def find_foods(t):
+    """Вхождения основ с границей слова слева; при пересечении — самое левое и длинное"""
+    found = []
+    for start, end, entry in get_food_matcher().finditer(t):
+        if start > 0 and t[start - 1].isalpha():
+            continue
+        if entry["whole"] and end < len(t) and t[end].isalpha():
+            continue
+        found.append((start, end, entry))
+    found.sort(key=lambda m: (m[0], m[0] - m[1]))
+    chosen = []
+    last_end = 0
+    for m in found:
+        if m[0] >= last_end:
+            chosen.append(m)
+            last_end = m[1]
+    return chosen
+
+def parse_unit(token):
+    for prefix, unit in UNIT_PREFIXES:
+        if token == prefix if prefix in SHORT_UNITS else token.startswith(prefix):
+            return unit
+    return None
+
+def parse_number(token):
+    if token[0].isdigit():
+        return float(token.replace(",", "."))
+    return NUMBER_WORDS.get(token)
+
+def parse_quantity(before, after):
+    """Слова перед продуктом (в пределах фразы) и сразу после -> (кол-во, единица, множитель)"""
+    qty, unit, mult = None, None, 1.0
+    clause = CLAUSE_SPLIT_RE.split(before)[-1]
+    for token in TOKEN_RE.findall(clause):
+        number = parse_number(token)
+        if number is not None:
+            qty = number if qty is None or token[0].isdigit() else qty * number
+            continue
+        u = parse_unit(token)
+        if u:
+            unit = u
+            continue
+        for word, m in PORTION_WORDS.items():
+            if token.startswith(word):
+                mult *= m
+                break
+    consumed = 0
+    m = TRAILING_QTY_RE.match(after)
+    if m and qty is None and parse_unit(m.group(2)):
+        qty, unit, consumed = float(m.group(1).replace(",", ".")), parse_unit(m.group(2)), m.end()
+    return qty, unit, mult, consumed
+
+def parse_meal_text(text):
+    """Текст приёма пищи -> [{"food", "grams", "kcal"}]"""
+    t = normalize_food_text(text)
+    items = []
+    prev_end = 0
+    for start, end, entry in find_foods(t):
+        word_end = end
+        while word_end < len(t) and (t[word_end].isalpha() or t[word_end] == "-"):
+            word_end += 1
+        qty, unit, mult, consumed = parse_quantity(t[prev_end:start], t[word_end:])
+        kind, unit_g = unit or ("piece", None)
+        if kind == "g":
+            grams = (qty or 1) * unit_g
+        elif kind == "portion":
+            grams = (qty or 1) * entry["portion"]
+        elif qty is None or qty < 1:
+            # «пол пиццы» — половина порции, а не половина куска
+            grams = (qty or 1) * entry["portion"]
+        else:
+            grams = qty * entry["piece"]
+        grams *= mult
+        items.append({"food": t[start:word_end], "grams": round(grams),
+                      "kcal": round(grams * entry["kcal"] / 100)})
+        prev_end = word_end + consumed
+    return items
 
-# ========= Meals estimation =========
 def estimate_text_kcal(text):
-    t = (text or "").lower()
-    kcal = 0
-    if "яйц" in t:
-        kcal += 160
-    if "хлеб" in t:
-        kcal += 120
-    if "печен" in t and "треск" in t:
-        kcal += 480
-    if "сахар" in t:
-        kcal += 30
-    return kcal if kcal > 0 else 500
+    items = parse_meal_text(text)
+    kcal = sum(i["kcal"] for i in items)
+    return kcal if kcal > 0 else TEXT_KCAL_FALLBACK
+
+def estimate_text_kcal_batch(texts):
+    """Оценка пачки текстов (одинаковые считаются один раз)"""
+    memo = {}
+    out = []
+    for text in texts:
+        key = normalize_food_text(text).strip()
+        if key not in memo:
+            memo[key] = estimate_text_kcal(key)
+        out.append(memo[key])
+    return out
 
 # ========= Totals =========
+# kcal_eaten в daily_log — накопительная сумма: каждый приём пищи прибавляет
+# свои калории (add_meal_kcal), а reconcile_kcal_eaten время от времени
+# сверяет её с листом meals и исправляет расхождения.
+
+@contextmanager
+def user_lock(user_id):
+    """Лок на пользователя во всех воркерах: сериализует read-modify-write его строк.
+
+    Записи, накопленные в write_batch, уходят до снятия внешнего лока.
+    """
+    depth = getattr(_write_local, "lock_depth", 0)
+    with process_locks.hold(f"user:{user_id}"):
+        _write_local.lock_depth = depth + 1
+        try:
+            yield
+        except Exception:
+            if depth == 0:
+                try:
+                    flush_writes()
+                except WriteFlushError as e:
+                    logger.error(f"user_lock {user_id}: flush after error failed: {e}")
+            raise
+        else:
+            if depth == 0:
+                flush_writes()
+        finally:
+            _write_local.lock_depth = depth
+            if depth == 0:
+                forget_verified_rows()
+
+def add_meal_kcal(ws_daily, user_id, day, kcal):
+    """Прибавляет kcal к kcal_eaten за день, возвращает номер строки daily_log"""
+    with user_lock(user_id):
+        row = daily_find_or_create(ws_daily, user_id, day)
+        # Инкремент пишем сразу, мимо буфера — иначе поздний flush затрёт чужой
+        buf = current_write_buffer()
+        if buf is not None:
+            buf.discard(ws_daily, row, 9)
+        total = ws_daily.increment_cell(row, 9, int(kcal))
+        write_row(ws_daily, row, 14, [iso_now()])
+        logger.info(f"add_meal_kcal: user={user_id}, day={day}, +{kcal} -> {total}")
+        today_cache.invalidate(user_id)
+        return row
+
+def meal_kcal(r):
+    try:
+        return int(float(r[7] or "0"))
+    except:
+        return 0
+
 def sum_today_kcal(ws_meals, user_id, day):
     try:
-        rows = ws_meals.get_all_values()
-        total = 0
-        for i in range(1, len(rows)):
-            r = rows[i]
-            if len(r) < 8:
-                continue
-            uid = r[1] if len(r) > 1 else ""
-            ts = r[0] if len(r) > 0 else ""
-            if uid != str(user_id):
+        return sum(meal_kcal(r) for r in ws_meals.meals_for_day(day, user_id) if len(r) >= 8)
+    except Exception as e:
+        logger.error(f"sum_today_kcal error: {e}")
+        return 0
+
+def reconcile_user_kcal(ws_daily, ws_users, ws_meals, uid, day):
+    """Сверка одного пользователя под его локом: сумму meals и kcal_eaten читаем
+    заново, иначе приём пищи между чтением и записью затёрся бы старой суммой.
+    Возвращает (было, стало) или None, если расхождения нет"""
+    with user_lock(uid), write_batch():
+        total = sum(meal_kcal(r) for r in ws_meals.meals_for_day(day, uid) if len(r) >= 8)
+        row = ws_daily.find_daily_row(day, uid)
+        if row is None and total == 0:
+            return None
+        current = None
+        if row is not None:
+            values = get_daily_row_values(ws_daily, row)
+            try:
+                current = int(float(values[8] or "0"))
+            except (ValueError, IndexError):
+                current = None
+        if current == total:
+            return None
+        row = row or daily_find_or_create(ws_daily, uid, day)
+        daily_set(ws_daily, row, 9, str(total))
+        recalculate_daily_stats(ws_daily, ws_users, ws_meals, uid, day, row)
+        return current, total
+
+def reconcile_kcal_eaten(day=None):
+    """Сверяет kcal_eaten за день с суммой по meals и исправляет расхождения"""
+    day = day or today_str()
+    try:
+        ws_meals = get_partition("meals", day)
+        ws_daily = get_partition("daily_log", day)
+        ws_users = get_worksheet("users")
+        
+        # Общий проход только отбирает кандидатов; решение — под локом пользователя
+        totals = {}
+        for r in ws_meals.meals_for_day(day):
+            if len(r) >= 8 and r[1]:
+                totals[r[1]] = totals.get(r[1], 0) + meal_kcal(r)
+        
+        current = {}
+        for dr in ws_daily.daily_rows_for_day(day):
+            if len(dr) >= 9 and dr[1] and dr[1] not in current:
+                try:
+                    current[dr[1]] = int(float(dr[8] or "0"))
+                except:
+                    current[dr[1]] = None
+        
+        fixed = 0
+        for uid in set(totals) | set(current):
+            total = totals.get(uid, 0)
+            if current.get(uid, 0 if total == 0 else None) == total:
                 continue
-            if not ts.startswith(day):
+            change = reconcile_user_kcal(ws_daily, ws_users, ws_meals, uid, day)
+            if change is None:
                 continue
-            try:
-                total += int(float(r[7] or "0"))
-            except:
-                pass
-        return total
+            fixed += 1
+            logger.info(f"reconcile_kcal_eaten: user={uid}, day={day}, {change[0]} -> {change[1]}")
+        logger.info(f"reconcile_kcal_eaten: day={day}, users={len(set(totals) | set(current))}, fixed={fixed}")
+        return fixed
     except Exception as e:
-        logger.error(f"sum_today_kcal error: {e}")
+        logger.error(f"reconcile_kcal_eaten error: {e}")
         return 0
 
+# Сверка по расписанию: запускается из тика cron (/trigger_reminder), не чаще
+# раза в RECONCILE_INTERVAL секунд на все воркеры; 0 — только mode=reconcile
+RECONCILE_INTERVAL = int(os.environ.get("RECONCILE_INTERVAL", "3600"))
+
+def maybe_reconcile():
+    """Фоновая сверка за сегодня, если в этом интервале её ещё никто не запускал"""
+    if RECONCILE_INTERVAL <= 0:
+        return False
+    slot = int(time.time() // RECONCILE_INTERVAL)
+    if not get_shared_store().claim("cron", "reconcile", slot):
+        return False
+    threading.Thread(target=reconcile_kcal_eaten, daemon=True).start()
+    return True
+
 def get_user_targets(ws_users, user_id):
     try:
-        r = find_row_by_user(ws_users, user_id)
-        if not r:
+        profile = get_user_profile(ws_users, user_id)
+        if not profile:
             return None
-        vals = ws_users.row_values(r)
-        kcal_target = 2100
-        if len(vals) > 10 and vals[10]:
-            try:
-                kcal_target = int(float(vals[10]))
-            except:
-                pass
-        return {"kcal_target": kcal_target}
+        return {"kcal_target": profile["kcal_target"]}
     except Exception as e:
         logger.error(f"get_user_targets error: {e}")
         return {"kcal_target": 2100}
 
+# ========= Today snapshot =========
+# /api/today и /api/bootstrap только читают: снимок «сегодня» считается из
+# строки daily_log и цели пользователя, кэшируется и сбрасывается, когда
+# меняются входные данные (пересчёт дня, сохранение профиля).
+TODAY_CACHE_TTL = int(os.environ.get("TODAY_CACHE_TTL", "60"))
+
+class TodayCache:
+    """user_id -> (день, снимок, время) в shared_store — один снимок на все воркеры.
+
+    Поколения ("today" на всех и "today:<user_id>") защищают от гонки:
+    снимок, посчитанный до изменения данных, не кладётся.
+    """
+
+    def __init__(self, ttl=TODAY_CACHE_TTL):
+        self.ttl = ttl
+
+    def _generation(self, store, uid):
+        return [store.generation("today"), store.generation(f"today:{uid}")]
+
+    def get(self, user_id, day):
+        uid = str(user_id)
+        store = get_shared_store()
+        generation = self._generation(store, uid)
+        entry = store.get("today", uid)
+        if (entry and entry["day"] == day and entry["generation"] == generation
+                and time.time() - entry["at"] <= self.ttl):
+            return entry["snapshot"], generation
+        return None, generation
+
+    def put(self, user_id, day, snapshot, generation):
+        uid = str(user_id)
+        store = get_shared_store()
+        # Пока считали, данные могли поменяться — такой снимок не кладём
+        if self._generation(store, uid) == generation:
+            store.put("today", uid, {"day": day, "snapshot": snapshot,
+                                     "generation": generation, "at": time.time()})
+
+    def invalidate(self, user_id):
+        key = f"today:{user_id}"
+
+        def drop():
+            get_shared_store().bump(key)
+
+        drop()
+        after_write(drop)
+
+    def clear(self):
+        store = get_shared_store()
+        store.bump("today")
+        store.delete("today")
+
+today_cache = TodayCache()
+
+def compute_today(user_id, day):
+    """Снимок «сегодня» без записей в таблицы"""
+    profile = get_user_profile(get_worksheet("users"), user_id)
+    kcal_target = profile["kcal_target"] if profile else 2100
+    
+    ws_daily = get_worksheet("daily_log")
+    row = ws_daily.find_daily_row(day, user_id)
+    values = get_daily_row_values(ws_daily, row) if row else [""] * 14
+    
+    steps = int(float(values[4])) if values[4] else 0         # Колонка 5
+    kcal_eaten = int(float(values[8])) if values[8] else 0    # Колонка 9
+    
+    return {
+        "exists": profile is not None,
+        "profile": profile,
+        "today": {
+            "date": day,
+            "kcal_target": kcal_target,
+            "kcal_eaten": kcal_eaten,
+            "kcal_left": calc_kcal_left(kcal_target, steps, kcal_eaten),
+            "steps": steps,
+        },
+    }
+
+def get_today(user_id):
+    day = today_str()
+    snapshot, generation = today_cache.get(user_id, day)
+    if snapshot is None:
+        snapshot = compute_today(user_id, day)
+        today_cache.put(user_id, day, snapshot, generation)
+    return snapshot
+
+# ========= Weight history =========
+# Ряд весов пользователя (по дате, новые первыми) держим в памяти: загружается
+# при первом запросе из его строк daily_log, дальше обновляется при записи
+# weight_morning / weight_evening.
+WEIGHT_HISTORY_MONTHS = int(os.environ.get("WEIGHT_HISTORY_MONTHS", "12"))
+WEIGHT_INDEX_TTL = int(os.environ.get("WEIGHT_INDEX_TTL", "3600"))
+WEIGHT_INDEX_MAX_USERS = int(os.environ.get("WEIGHT_INDEX_MAX_USERS", "5000"))
+
+class WeightIndex:
+    """user_id -> {date: {"morning", "evening"}} + отсортированные даты.
+
+    Ряды свои в каждом процессе; о записи веса в другом воркере узнаём по
+    общему поколению "weight:<user_id>" и перечитываем ряд.
+    """
+
+    def __init__(self, ttl=WEIGHT_INDEX_TTL, max_users=WEIGHT_INDEX_MAX_USERS):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.series = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _load(self, user_id):
+        end_day = today_str()
+        start_day = shift_period(period_of(end_day), -(WEIGHT_HISTORY_MONTHS - 1)).replace("_", "-") + "-01"
+        points = {}
+        for r in partition_rows_for_user("daily_log", user_id, start_day, end_day):
+            if len(r) < 3:
+                continue
+            points[r[0]] = {"morning": r[2], "evening": r[3] if len(r) > 3 else ""}
+        return {"points": points, "dates": sorted(points, reverse=True), "loaded_at": time.monotonic()}
+
+    def _generation(self, uid):
+        store = get_shared_store()
+        return [store.generation("weight"), store.generation(f"weight:{uid}")]
+
+    def _get(self, user_id):
+        uid = str(user_id)
+        entry = self.series.get(uid)
+        generation = self._generation(uid)
+        if (entry is None or time.monotonic() - entry["loaded_at"] > self.ttl
+                or entry["generation"] != generation):
+            entry = self._load(uid)
+            entry["generation"] = generation
+            self.series[uid] = entry
+            while len(self.series) > self.max_users:
+                self.series.popitem(last=False)
+        self.series.move_to_end(uid)
+        return entry
+
+    def page(self, user_id, before=None, limit=30):
+        """Точки с весом, новые первыми: (data, next_before)"""
+        with self.lock:
+            entry = self._get(user_id)
+            data = []
+            next_before = None
+            for d in entry["dates"]:
+                if before and d >= before:
+                    continue
+                p = entry["points"][d]
+                if not p["morning"] and not p["evening"]:
+                    continue
+                if len(data) == limit:
+                    next_before = data[-1]["date"]
+                    break
+                data.append({"date": d, "morning": p["morning"], "evening": p["evening"]})
+            return data, next_before
+
+    def record(self, user_id, day, field, value):
+        """Вес записан в daily_log — обновляем ряд, если он уже загружен"""
+        uid = str(user_id)
+        with self.lock:
+            entry = self.series.get(uid)
+            if entry is not None:
+                p = entry["points"].get(day)
+                if p is None:
+                    p = entry["points"][day] = {"morning": "", "evening": ""}
+                    entry["dates"] = sorted(entry["points"], reverse=True)
+                p[field] = value
+        # Поколение — после записи буфера, иначе другой воркер перечитает старое
+        after_write(lambda: self._published(uid))
+
+    def _published(self, uid):
+        generation = get_shared_store().bump(f"weight:{uid}")
+        with self.lock:
+            entry = self.series.get(uid)
+            if entry is None:
+                return
+            if entry["generation"][1] == generation - 1:
+                entry["generation"][1] = generation
+            else:
+                # Между нашими записями писал другой воркер — ряд перечитаем
+                del self.series[uid]
+
+    def invalidate(self):
+        get_shared_store().bump("weight")
+        with self.lock:
+            self.series.clear()
+
+weight_index = WeightIndex()
+
+def etag_response(payload):
+    """JSON-ответ с ETag; 304, если клиент прислал тот же If-None-Match"""
+    body = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    etag = '"' + hashlib.sha1(body.encode("utf-8")).hexdigest()[:20] + '"'
+    if etag in [t.strip() for t in request.headers.get("If-None-Match", "").split(",")]:
+        resp = app.response_class(status=304)
+    else:
+        resp = app.response_class(body, mimetype="application/json")
+    resp.headers["ETag"] = etag
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+# ========= Static assets =========
+# Мини-приложение: index.html отдаётся с no-cache, а все файлы, на которые он
+# ссылается, — по URL с хэшем содержимого (app.<hash>.js) и Cache-Control
+# immutable на год. html/js/css заранее (один раз при старте) сжимаются в
+# gzip и brotli. Видео и картинки идут через send_from_directory с поддержкой
+# Range. Облегчённое видео и постер делает build_assets.py на этапе сборки
+# (в git их нет); без них index.html ссылается на исходное видео.
+WEB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "web")
+ASSET_MAX_AGE = 365 * 24 * 3600
+ASSET_PLAIN_MAX_AGE = 300
+COMPRESSIBLE_EXT = {".html", ".js", ".css", ".json", ".svg", ".txt"}
+
+class StaticAssets:
+    """Хэшированные имена и предсжатые варианты файлов web/"""
+
+    def __init__(self, root):
+        self.root = root
+        self.hashed = {}      # app.<hash>.js -> app.js
+        self.urls = {}        # app.js -> app.<hash>.js
+        self.blobs = {}       # имя -> {"identity": bytes, "gzip": bytes, "br": bytes, "etag": str}
+        self.lock = threading.Lock()
+        self.loaded = False
+
+    def _hashed_name(self, name, content):
+        digest = hashlib.sha256(content).hexdigest()[:10]
+        stem, ext = os.path.splitext(name)
+        return f"{stem}.{digest}{ext}"
+
+    def _compress(self, content):
+        variants = {"identity": content, "gzip": gzip.compress(content, compresslevel=9)}
+        if brotli is not None:
+            variants["br"] = brotli.compress(content, quality=11)
+        variants["etag"] = '"' + hashlib.sha256(content).hexdigest()[:20] + '"'
+        return variants
+
+    def _rewrite_index(self, html):
+        """./app.js -> ./app.<hash>.js для всех файлов, что есть в web/.
+
+        Постер и <source> на файлы, которых нет (build_assets.py не запускали),
+        убираются — браузер сразу берёт следующий источник.
+        """
+        html = re.sub(r'\s*<source src="\./([^"/]+)"[^>]*>',
+                      lambda m: m.group(0) if m.group(1) in self.urls else "", html)
+        html = re.sub(r'\s+poster="\./([^"/]+)"',
+                      lambda m: m.group(0) if m.group(1) in self.urls else "", html)
+        def repl(m):
+            name = m.group(2)
+            return f'{m.group(1)}="./{self.urls.get(name, name)}"'
+        return re.sub(r'(src|href|poster)="\./([^"/]+)"', repl, html)
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            for name in sorted(os.listdir(self.root)):
+                path = os.path.join(self.root, name)
+                if not os.path.isfile(path) or name == "index.html":
+                    continue
+                with open(path, "rb") as f:
+                    content = f.read()
+                hashed = self._hashed_name(name, content)
+                self.hashed[hashed] = name
+                self.urls[name] = hashed
+                if os.path.splitext(name)[1] in COMPRESSIBLE_EXT:
+                    self.blobs[name] = self._compress(content)
+            with open(os.path.join(self.root, "index.html"), encoding="utf-8") as f:
+                html = self._rewrite_index(f.read())
+            self.blobs["index.html"] = self._compress(html.encode("utf-8"))
+            self.loaded = True
+            logger.info(f"Static assets ready: {len(self.hashed)} hashed files")
+
+    def _negotiate(self, blob):
+        """Лучшее из br/gzip по q-значениям Accept-Encoding (q=0 — запрет), иначе identity"""
+        accepted = request.accept_encodings
+        best, best_q = "identity", 0.0
+        for encoding in ("br", "gzip"):
+            q = accepted.quality(encoding)
+            if encoding in blob and q > best_q:
+                best, best_q = encoding, q
+        return best
+
+    def response(self, filename):
+        self.load()
+        real = self.hashed.get(filename)
+        if real is not None:
+            cache = f"public, max-age={ASSET_MAX_AGE}, immutable"
+        elif filename == "index.html":
+            real = filename
+            cache = "no-cache"
+        else:
+            # Старые прямые ссылки (например, фото для /start) — без immutable
+            real = filename
+            cache = f"public, max-age={ASSET_PLAIN_MAX_AGE}"
+
+        blob = self.blobs.get(real)
+        if blob is None:
+            resp = send_from_directory(self.root, real, conditional=True)
+            resp.headers["Cache-Control"] = cache
+            return resp
+
+        if blob["etag"] in [t.strip() for t in request.headers.get("If-None-Match", "").split(",")]:
+            resp = app.response_class(status=304)
+        else:
+            encoding = self._negotiate(blob)
+            mimetype = mimetypes.guess_type(real)[0] or "application/octet-stream"
+            resp = app.response_class(blob[encoding], mimetype=mimetype)
+            if encoding != "identity":
+                resp.headers["Content-Encoding"] = encoding
+        resp.headers["ETag"] = blob["etag"]
+        resp.headers["Vary"] = "Accept-Encoding"
+        resp.headers["Cache-Control"] = cache
+        return resp
+
+static_assets = StaticAssets(WEB_DIR)
+
 # ========= Web routes =========
+@app.before_request
+def metrics_start_timer():
+    g.metrics_started = time.perf_counter()
+
+@app.after_request
+def metrics_record_request(resp):
+    started = getattr(g, "metrics_started", None)
+    if started is not None:
+        # Шаблон маршрута, а не путь: /web/<path:filename>, а не каждый файл
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.observe("http_request_seconds", time.perf_counter() - started, route=route, method=request.method)
+        metrics.inc("http_requests_total", route=route, method=request.method, status=str(resp.status_code))
+    return resp
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    if METRICS_SECRET:
+        auth = request.headers.get("Authorization", "")
+        if request.args.get("secret", "") != METRICS_SECRET and auth != f"Bearer {METRICS_SECRET}":
+            return "Forbidden", 403
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/", methods=["GET"])
 def health():
     return "OK", 200
@@ -649,10 +3713,37 @@ def trigger_reminder():
     
     mode = request.args.get("mode") or (request.json or {}).get("mode", "checkin")
     
-    if mode == "checkin":
-        run_checkin()
-    elif mode == "checkout":
-        run_checkout()
+    if mode in ("checkin", "checkout"):
+        maybe_reconcile()
+        run = run_checkin if mode == "checkin" else run_checkout
+        # Рассылка может идти долго — cron не ждёт, если не попросил wait=1
+        if request.args.get("wait") or (request.json or {}).get("wait"):
+            report = run()
+            if report is None:
+                return "Broadcast failed", 500
+            report.pop("results")
+            return jsonify(report)
+        threading.Thread(target=run, daemon=True).start()
+    elif mode == "reconcile":
+        day = request.args.get("day") or (request.json or {}).get("day") or None
+        threading.Thread(target=reconcile_kcal_eaten, args=(day,), daemon=True).start()
+    elif mode == "archive":
+        threading.Thread(target=archive_closed_partitions, daemon=True).start()
+    elif mode == "reindex":
+        invalidate_sheet_indexes()
+    elif mode == "export":
+        force = request.args.get("force") or (request.json or {}).get("force")
+        try:
+            export_to_sheets(force=bool(force))
+        except Exception as e:
+            logger.error(f"export_to_sheets error: {e}")
+            return "Export failed", 500
+    elif mode == "import":
+        try:
+            return jsonify({"ok": True, "imported": import_from_sheets()})
+        except Exception as e:
+            logger.error(f"import_from_sheets error: {e}")
+            return "Import failed", 500
     else:
         return "Unknown mode", 400
     
@@ -660,7 +3751,7 @@ def trigger_reminder():
 
 @app.route("/web/<path:filename>", methods=["GET"])
 def web_files(filename):
-    return send_from_directory("web", filename)
+    return static_assets.response(filename)
 
 @app.route("/api/today", methods=["GET"])
 def api_today():
@@ -669,75 +3760,58 @@ def api_today():
         if not user_id:
             return jsonify({"ok": False, "error": "user_id required"}), 400
 
-        ws_users = get_worksheet("users")
-        ws_meals = get_worksheet("meals")
-        ws_daily = get_worksheet("daily_log")
+        return jsonify({"ok": True, **get_today(user_id)["today"]})
+    except Exception as e:
+        logger.error(f"api_today error: {e}")
+        return jsonify({"ok": False, "error": str(e)}), 500
 
-        targets = get_user_targets(ws_users, user_id) or {"kcal_target": 2100}
-        day = today_str()
-        
-        # Пересчитываем статистику
-        row = daily_find_or_create(ws_daily, user_id, day)
-        recalculate_daily_stats(ws_daily, ws_users, ws_meals, user_id, day, row)
-        
-        # Получаем обновлённые значения
-        values = get_daily_row_values(ws_daily, row)
-        
-        kcal_eaten = int(values[8]) if values[8] else 0   # Колонка 9
-        kcal_left = int(values[9]) if values[9] else 0    # Колонка 10
-        steps = int(values[4]) if values[4] else 0        # Колонка 5
+@app.route("/api/bootstrap", methods=["GET"])
+def api_bootstrap():
+    """Всё для открытия мини-приложения одним запросом: есть ли профиль, цели, сегодня"""
+    try:
+        user_id = request.args.get("user_id", "").strip()
+        if not user_id:
+            return jsonify({"ok": False, "error": "user_id required"}), 400
 
-        return jsonify({
+        snapshot = get_today(user_id)
+        profile = snapshot["profile"]
+        return etag_response({
             "ok": True,
-            "date": day,
-            "kcal_target": targets["kcal_target"],
-            "kcal_eaten": kcal_eaten,
-            "kcal_left": kcal_left,
-            "steps": steps
+            "exists": snapshot["exists"],
+            "profile": {
+                "first_name": profile["first_name"],
+                "timezone": profile["timezone"],
+                "kcal_target": profile["kcal_target"],
+                "checkin_time": profile["checkin_time"],
+                "checkout_time": profile["checkout_time"],
+            } if profile else None,
+            "today": snapshot["today"],
         })
     except Exception as e:
-        logger.error(f"api_today error: {e}")
+        logger.error(f"api_bootstrap error: {e}")
         return jsonify({"ok": False, "error": str(e)}), 500
 
 @app.route("/api/weight_history", methods=["GET"])
 def api_weight_history():
+    """История веса: ?user_id=&limit=30[&before=YYYY-MM-DD] (days= — старое имя limit)"""
     try:
         user_id = request.args.get("user_id", "").strip()
-        days = int(request.args.get("days", "30"))
+        limit = int(request.args.get("limit") or request.args.get("days") or "30")
+        limit = max(1, min(limit, 366))
+        before = request.args.get("before", "").strip() or None
         
         if not user_id:
             return jsonify({"ok": False, "error": "user_id required"}), 400
 
-        ws_daily = get_worksheet("daily_log")
-        rows = ws_daily.get_all_values()
-        
-        data = []
-        for i in range(1, len(rows)):
-            r = rows[i]
-            if len(r) < 3:
-                continue
-            date_val = r[0]
-            uid = r[1]
-            if uid != str(user_id):
-                continue
-            
-            morning = r[2] if len(r) > 2 else ""
-            evening = r[3] if len(r) > 3 else ""
-            
-            data.append({
-                "date": date_val,
-                "morning": morning,
-                "evening": evening
-            })
-        
-        data = sorted(data, key=lambda x: x["date"], reverse=True)[:days]
+        data, next_before = weight_index.page(user_id, before, limit)
         
-        return jsonify({"ok": True, "data": data})
+        return etag_response({"ok": True, "data": data, "next_before": next_before})
     except Exception as e:
         logger.error(f"api_weight_history error: {e}")
         return jsonify({"ok": False, "error": str(e)}), 500
 
 @app.route("/api/profile_save", methods=["POST"])
+@write_batched
 def api_profile_save():
     try:
         data = request.get_json(force=True) or {}
@@ -828,6 +3902,299 @@ def api_debug_daily():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/api/recognizer_stats", methods=["GET"])
+def api_recognizer_stats():
+    """Попадания в кэш, таймауты и задержка распознавания фото"""
+    if request.args.get("secret", "") != CRON_SECRET:
+        return "Forbidden", 403
+    return jsonify({"ok": True, **get_recognition_service().snapshot()})
+
+# ========= Update dedup =========
+# Telegram присылает апдейт повторно, если webhook отвечал слишком долго.
+# Каждый update_id захватывается один раз: сначала LRU процесса, затем
+# INSERT OR IGNORE в общий для всех воркеров SQLite-журнал. Повтор уже
+# обработанного или ещё обрабатываемого апдейта сразу получает 200.
+# Упавшую обработку снимаем с журнала, чтобы повтор Telegram её доделал.
+UPDATE_LEDGER_PATH = os.environ.get("UPDATE_LEDGER_PATH", "update_ledger.db")
+UPDATE_DEDUP_SIZE = int(os.environ.get("UPDATE_DEDUP_SIZE", "10000"))
+UPDATE_LEDGER_TTL = int(os.environ.get("UPDATE_LEDGER_TTL", "86400"))
+UPDATE_INFLIGHT_TIMEOUT = int(os.environ.get("UPDATE_INFLIGHT_TIMEOUT", "300"))
+
+metrics.describe("updates_deduplicated_total", "counter", "Redelivered Telegram updates skipped")
+
+class UpdateLedger:
+    """update_id -> inflight/done: LRU в памяти + журнал SQLite на горизонт UPDATE_LEDGER_TTL"""
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path, size=UPDATE_DEDUP_SIZE, ttl=UPDATE_LEDGER_TTL,
+                 inflight_timeout=UPDATE_INFLIGHT_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self.inflight_timeout = inflight_timeout
+        self.recent = OrderedDict()
+        self.lock = threading.Lock()
+        self.claims = 0
+        self._local = threading.local()
+        self.conn().execute(
+            "CREATE TABLE IF NOT EXISTS updates (update_id INTEGER PRIMARY KEY, status TEXT NOT NULL, at REAL NOT NULL)"
+        )
+
+    def conn(self):
+        # Соединение, открытое до fork (gunicorn --preload), в дочернем процессе не используем
+        c = getattr(self._local, "conn", None)
+        if c is None or self._local.pid != os.getpid():
+            c = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = c
+            self._local.pid = os.getpid()
+        return c
+
+    def _remember(self, update_id, status):
+        self.recent[update_id] = status
+        self.recent.move_to_end(update_id)
+        while len(self.recent) > self.size:
+            self.recent.popitem(last=False)
+
+    def claim(self, update_id):
+        """True — апдейт обрабатываем мы; False — это повтор"""
+        if update_id is None:
+            return True
+        with self.lock:
+            if update_id in self.recent:
+                self.recent.move_to_end(update_id)
+                return False
+            self._remember(update_id, "inflight")
+            self.claims += 1
+            prune = self.claims % self.PRUNE_EVERY == 0
+        now = time.time()
+        try:
+            db = self.conn()
+            owned = db.execute(
+                "INSERT OR IGNORE INTO updates (update_id, status, at) VALUES (?, 'inflight', ?)",
+                (update_id, now)
+            ).rowcount == 1
+            if not owned:
+                # Захват воркера, который упал посреди обработки, забираем себе
+                owned = db.execute(
+                    "UPDATE updates SET at = ? WHERE update_id = ? AND status = 'inflight' AND at < ?",
+                    (now, update_id, now - self.inflight_timeout)
+                ).rowcount == 1
+            status = None
+            if not owned:
+                row = db.execute("SELECT status FROM updates WHERE update_id = ?", (update_id,)).fetchone()
+                status = row[0] if row else None
+            if prune:
+                db.execute("DELETE FROM updates WHERE at < ?", (now - self.ttl,))
+        except sqlite3.Error as e:
+            # Журнал недоступен — апдейт не теряем, от повторов защищает LRU
+            logger.error(f"update ledger error: {e}")
+            owned = True
+        if not owned:
+            with self.lock:
+                if status == "done":
+                    self._remember(update_id, "done")
+                else:
+                    # Апдейт держит другой воркер: если он упадёт, повтор должен снова спросить журнал
+                    self.recent.pop(update_id, None)
+        return owned
+
+    def finish(self, update_id, ok):
+        """Обработан — помечаем done; упал — снимаем захват, чтобы повтор прошёл"""
+        if update_id is None:
+            return
+        with self.lock:
+            if ok:
+                self._remember(update_id, "done")
+            else:
+                self.recent.pop(update_id, None)
+        try:
+            if ok:
+                self.conn().execute("UPDATE updates SET status = 'done', at = ? WHERE update_id = ?",
+                                    (time.time(), update_id))
+            else:
+                self.conn().execute("DELETE FROM updates WHERE update_id = ?", (update_id,))
+        except sqlite3.Error as e:
+            logger.error(f"update ledger error: {e}")
+
+_update_ledger = None
+_update_ledger_lock = threading.Lock()
+
+def get_update_ledger():
+    global _update_ledger
+    if _update_ledger is None:
+        with _update_ledger_lock:
+            if _update_ledger is None:
+                _update_ledger = UpdateLedger(UPDATE_LEDGER_PATH)
+    return _update_ledger
+
+def process_update(update):
+    """handle_update + отметка в журнале апдейтов"""
+    ok = False
+    try:
+        result = handle_update(update)
+        ok = not (isinstance(result, tuple) and result[1] >= 500)
+        return result
+    finally:
+        get_update_ledger().finish(update.get("update_id"), ok)
+
+# ========= Update queue =========
+# WEBHOOK_ASYNC=1: /webhook только кладёт апдейт в очередь и сразу отвечает 200.
+# Апдейты раскладываются по шардам по user_id: разные пользователи
+# обрабатываются параллельно, апдейты одного пользователя — строго по порядку
+# (цепочка food → sauce → size не перемешивается).
+WEBHOOK_ASYNC = os.environ.get("WEBHOOK_ASYNC", "0") == "1"
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "4"))
+
+def update_chat_id(update):
+    """Чат, куда отвечать на апдейт (None, если апдейт не из чата)"""
+    q = update.get("callback_query")
+    obj = (q or {}).get("message") or update.get("message") or update.get("edited_message") or {}
+    return obj.get("chat", {}).get("id")
+
+def update_user_key(update):
+    """Ключ упорядочивания апдейта: id пользователя (или чата)"""
+    for kind in ("callback_query", "message", "edited_message", "my_chat_member"):
+        obj = update.get(kind)
+        if obj:
+            uid = obj.get("from", {}).get("id")
+            if uid is None:
+                uid = (obj.get("message") or obj).get("chat", {}).get("id")
+            if uid is not None:
+                return str(uid)
+    return str(update.get("update_id", ""))
+
+class UpdateQueue:
+    """Пул воркеров: у каждого своя FIFO-очередь, шард выбирается по ключу пользователя"""
+
+    def __init__(self, workers):
+        self.workers = max(1, workers)
+        self.queues = [queue.Queue() for _ in range(self.workers)]
+        self.threads = []
+        self.lock = threading.Lock()
+        self.stats = {
+            "enqueued": 0,
+            "processed": 0,
+            "failed": 0,
+            "lag_last": 0.0,
+            "lag_max": 0.0,
+            "lag_sum": 0.0,
+            "busy_sum": 0.0,
+        }
+
+    def _start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i, q in enumerate(self.queues):
+                t = threading.Thread(target=self._run, args=(q,), name=f"update-worker-{i}", daemon=True)
+                t.start()
+                self.threads.append(t)
+            logger.info(f"UpdateQueue started {self.workers} workers")
+
+    def submit(self, key, update):
+        # Потоки стартуют лениво — уже после форка воркера gunicorn
+        if not self.threads:
+            self._start()
+        shard = zlib.crc32(key.encode()) % self.workers
+        self.queues[shard].put((time.monotonic(), update))
+        with self.lock:
+            self.stats["enqueued"] += 1
+
+    def _run(self, q):
+        while True:
+            enqueued_at, update = q.get()
+            started = time.monotonic()
+            lag = started - enqueued_at
+            ok = True
+            try:
+                result = process_update(update)
+                ok = not (isinstance(result, tuple) and result[1] >= 500)
+            except Exception as e:
+                ok = False
+                logger.error(f"update worker error: {e}")
+            finally:
+                busy = time.monotonic() - started
+                with self.lock:
+                    self.stats["processed"] += 1
+                    if not ok:
+                        self.stats["failed"] += 1
+                    self.stats["lag_last"] = lag
+                    self.stats["lag_max"] = max(self.stats["lag_max"], lag)
+                    self.stats["lag_sum"] += lag
+                    self.stats["busy_sum"] += busy
+                q.task_done()
+
+    def drain(self):
+        """Ждёт, пока все поставленные апдейты обработаются"""
+        for q in self.queues:
+            q.join()
+
+    def snapshot(self):
+        now = time.monotonic()
+        shards = []
+        for q in self.queues:
+            with q.mutex:
+                depth = len(q.queue)
+                oldest = now - q.queue[0][0] if depth else 0.0
+            shards.append({"depth": depth, "oldest_wait_s": round(oldest, 3)})
+        with self.lock:
+            st = dict(self.stats)
+        done = st["processed"] or 1
+        return {
+            "workers": self.workers,
+            "depth": sum(sh["depth"] for sh in shards),
+            "shards": shards,
+            "enqueued": st["enqueued"],
+            "processed": st["processed"],
+            "failed": st["failed"],
+            "lag_last_s": round(st["lag_last"], 3),
+            "lag_max_s": round(st["lag_max"], 3),
+            "lag_avg_s": round(st["lag_sum"] / done, 3),
+            "processing_avg_s": round(st["busy_sum"] / done, 3),
+        }
+
+_update_queue = None
+_update_queue_lock = threading.Lock()
+
+def get_update_queue():
+    global _update_queue
+    if _update_queue is None:
+        with _update_queue_lock:
+            if _update_queue is None:
+                _update_queue = UpdateQueue(WEBHOOK_WORKERS)
+    return _update_queue
+
+def update_queue_gauges():
+    if _update_queue is None:
+        return []
+    snap = _update_queue.snapshot()
+    return [({"stat": "depth"}, snap["depth"]), ({"stat": "lag_last_s"}, snap["lag_last_s"]),
+            ({"stat": "lag_max_s"}, snap["lag_max_s"]), ({"stat": "failed"}, snap["failed"])]
+
+metrics.gauge("update_queue", "Async update queue depth and lag", update_queue_gauges)
+
+@app.route("/api/queue_stats", methods=["GET"])
+def api_queue_stats():
+    """Глубина очереди и задержка обработки (для подбора числа воркеров)"""
+    if request.args.get("secret", "") != CRON_SECRET:
+        return "Forbidden", 403
+    return jsonify({"ok": True, "async": WEBHOOK_ASYNC, **get_update_queue().snapshot()})
+
+@app.route("/api/broadcast_stats", methods=["GET"])
+def api_broadcast_stats():
+    """Итоги последних рассылок и число неактивных (заблокировавших бота) пользователей"""
+    if request.args.get("secret", "") != CRON_SECRET:
+        return "Forbidden", 403
+    store = get_shared_store()
+    return jsonify({
+        "ok": True,
+        "last": dict(store.items("broadcast")),
+        "inactive_users": len(store.items("inactive")),
+    })
+
 # ========= Telegram webhook =========
 @app.route("/webhook", methods=["POST"])
 def webhook():
@@ -837,111 +4204,128 @@ def webhook():
 
         update = request.get_json(force=True)
         logger.info(f"webhook update: {update}")
+    except Exception as e:
+        logger.error(f"webhook error: {e}")
+        return "Bad Request", 400
+
+    if not isinstance(update, dict):
+        # Не апдейт Telegram: 200, чтобы его не присылали повторно
+        logger.warning(f"webhook: ignored non-object body {type(update).__name__}")
+        return "Ignored", 200
+
+    if not get_update_ledger().claim(update.get("update_id")):
+        metrics.inc("updates_deduplicated_total")
+        logger.info(f"webhook: duplicate update {update.get('update_id')}, skipped")
+        return "OK", 200
+
+    if WEBHOOK_ASYNC:
+        get_update_queue().submit(update_user_key(update), update)
+        return "OK", 200
+    return process_update(update)
+
+WEB_APP_ACTIONS = {"weight_morning", "weight_evening", "steps"}
+
+def update_kind(update):
+    """Тип апдейта для метрик (ограниченный набор значений)"""
+    q = update.get("callback_query")
+    if q:
+        data = q.get("data", "")
+        if data in ("meal_prompt", "cancel"):
+            return f"callback:{data}"
+        if data.startswith((MEAL_CB_PREFIX + ":", "food:", "sauce:", "size:")):
+            return "callback:meal"
+        return "callback:other"
+    if "my_chat_member" in update:
+        return "my_chat_member"
+    msg = update.get("message")
+    if not msg:
+        return "other"
+    if msg.get("text") == "/start":
+        return "start"
+    if "web_app_data" in msg:
+        try:
+            action = json.loads(msg["web_app_data"]["data"]).get("action", "")
+        except Exception:
+            action = ""
+        return f"web_app_data:{action}" if action in WEB_APP_ACTIONS else "web_app_data:other"
+    if "photo" in msg:
+        return "photo"
+    if "text" in msg:
+        return "text"
+    return "message:other"
+
+def metered_update(fn):
+    """Время и результат обработки апдейта по типу"""
+    @wraps(fn)
+    def wrapper(update):
+        kind = update_kind(update)
+        started = time.perf_counter()
+        status = "error"
+        try:
+            result = fn(update)
+            status = "error" if isinstance(result, tuple) and result[1] >= 500 else "ok"
+            return result
+        finally:
+            metrics.observe("update_seconds", time.perf_counter() - started, kind=kind)
+            metrics.inc("updates_total", kind=kind, status=status)
+    return wrapper
+
+@metered_update
+@write_batched
+def handle_update(update):
+    """Обработка одного апдейта Telegram (синхронно из webhook или воркером очереди)"""
+    try:
+        # бот заблокирован / разблокирован в личке
+        if "my_chat_member" in update:
+            m = update["my_chat_member"]
+            if m.get("chat", {}).get("type") == "private":
+                user_id = str(m["chat"]["id"])
+                status = m.get("new_chat_member", {}).get("status")
+                if status == "kicked":
+                    mark_user_inactive(user_id, "blocked the bot")
+                elif status == "member":
+                    mark_user_active(user_id)
+            return "OK", 200
+
+        sender = (update.get("callback_query") or update.get("message") or {}).get("from", {}).get("id")
+        if sender:
+            mark_user_active(sender)
 
         # callbacks
         if "callback_query" in update:
             q = update["callback_query"]
             tg_answer_cb(q["id"])
-            chat_id = q["message"]["chat"]["id"]
             user_id = str(q.get("from", {}).get("id", ""))
+            # message нет у слишком старых сообщений; бот работает в личке — чат = пользователь
+            chat_id = (q.get("message") or {}).get("chat", {}).get("id") or user_id
             data = q.get("data", "")
-            
-            ws_state = get_worksheet("state")
-            ws_meals = get_worksheet("meals")
-            ws_daily = get_worksheet("daily_log")
-            ws_users = get_worksheet("users")
 
             if data == "meal_prompt":
-                state_set(ws_state, user_id, "meal", "Ждём фото или текст еды")
+                state_set(user_id, "meal", "Ждём фото или текст еды")
                 tg_send(chat_id, "Кидай фото еды 📸\nЕсли фото не получается — напиши текстом, что съел.", reply_markup=cancel_kb())
                 return "OK", 200
 
             if data == "cancel":
-                state_clear(ws_state, user_id)
+                state_clear(user_id)
                 tg_send(chat_id, "Ок.", reply_markup=open_app_kb())
                 return "OK", 200
             
             # === Уточнения еды ===
-            if data.startswith("food:"):
-                food_name = data.split(":", 1)[1]
-                pending_data = state_get_data(ws_state, user_id)
-                
-                try:
-                    temp_data = json.loads(pending_data) if pending_data else {}
-                except:
-                    temp_data = {}
-                
-                temp_data["food_name"] = food_name
-                
-                rule = get_food_questions(food_name)
-                
-                if rule["ask_sauce"]:
-                    state_set(ws_state, user_id, "sauce", json.dumps(temp_data))
-                    tg_send(chat_id, f"*{food_name}* — понял ✅\nБыл соус или майонез?", reply_markup=make_food_kb("sauce"))
-                elif rule["ask_size"]:
-                    state_set(ws_state, user_id, "size", json.dumps(temp_data))
-                    tg_send(chat_id, f"*{food_name}* — понял ✅\nКакой размер порции?", reply_markup=make_food_kb("size"))
-                else:
-                    kcal = calculate_kcal(food_name)
-                    finalize_meal(ws_meals, ws_daily, ws_users, user_id, chat_id, temp_data, kcal)
-                    state_clear(ws_state, user_id)
-                
-                return "OK", 200
-            
-            if data.startswith("sauce:"):
-                sauce_answer = data.split(":", 1)[1]
-                pending_data = state_get_data(ws_state, user_id)
-                
-                try:
-                    temp_data = json.loads(pending_data) if pending_data else {}
-                except:
-                    tg_send(chat_id, "Ошибка, начни заново.", reply_markup=open_app_kb())
-                    state_clear(ws_state, user_id)
+            # food:/sauce:/size: — кнопки старого формата без подписи и ссылки на фото:
+            # восстановить по ним выбор нельзя, отвечаем «кнопка устарела»
+            if data.startswith((MEAL_CB_PREFIX + ":", "food:", "sauce:", "size:")):
+                choice = decode_meal_cb(user_id, data)
+                if not choice or not choice["food"]:
+                    tg_send(chat_id, "Кнопка устарела, начни заново.", reply_markup=open_app_kb())
                     return "OK", 200
-                
-                temp_data["has_sauce"] = sauce_answer not in ["no"]
-                temp_data["sauce_type"] = sauce_answer if sauce_answer not in ["yes", "no"] else None
-                
-                food_name = temp_data.get("food_name", temp_data.get("food_guess", "неизвестно"))
-                rule = get_food_questions(food_name)
-                
-                if rule["ask_size"]:
-                    state_set(ws_state, user_id, "size", json.dumps(temp_data))
-                    tg_send(chat_id, "Понял! А размер порции какой?", reply_markup=make_food_kb("size"))
-                else:
-                    kcal = calculate_kcal(
-                        food_name,
-                        has_sauce=temp_data.get("has_sauce", False),
-                        sauce_type=temp_data.get("sauce_type")
-                    )
-                    finalize_meal(ws_meals, ws_daily, ws_users, user_id, chat_id, temp_data, kcal)
-                    state_clear(ws_state, user_id)
-                
-                return "OK", 200
-            
-            if data.startswith("size:"):
-                size = data.split(":", 1)[1]
-                pending_data = state_get_data(ws_state, user_id)
-                
-                try:
-                    temp_data = json.loads(pending_data) if pending_data else {}
-                except:
-                    tg_send(chat_id, "Ошибка, начни заново.", reply_markup=open_app_kb())
-                    state_clear(ws_state, user_id)
+                if choice["ref"] and not meal_photo_message(q, choice["ref"]):
+                    # Фото удалили или Telegram не прислал reply_to_message — без него не записываем
+                    tg_send(chat_id, "Не вижу фото, к которому эта кнопка. Пришли фото ещё раз 📸",
+                            reply_markup=open_app_kb())
                     return "OK", 200
-                
-                temp_data["size"] = size
-                food_name = temp_data.get("food_name", temp_data.get("food_guess", "неизвестно"))
-                
-                kcal = calculate_kcal(
-                    food_name,
-                    size=size,
-                    has_sauce=temp_data.get("has_sauce", False),
-                    sauce_type=temp_data.get("sauce_type")
-                )
-                finalize_meal(ws_meals, ws_daily, ws_users, user_id, chat_id, temp_data, kcal)
-                state_clear(ws_state, user_id)
-                
+
+                lead = "Понял!" if choice["sauce"] else f"*{choice['food']}* — понял ✅"
+                advance_meal(user_id, chat_id, choice, lead, lambda: meal_photo_from_callback(q, choice["ref"]))
                 return "OK", 200
 
             return "OK", 200
@@ -992,8 +4376,10 @@ def webhook():
                         return "OK", 200
                     
                     day = today_str()
-                    row = daily_find_or_create(ws_daily, user_id, day)
-                    daily_set(ws_daily, row, 3, str(w_float))
+                    with user_lock(user_id):
+                        row = daily_find_or_create(ws_daily, user_id, day)
+                        daily_set(ws_daily, row, 3, str(w_float))
+                        weight_index.record(user_id, day, "morning", str(w_float))
                     
                     tg_send(chat_id, f"Вес утром записан ✅ {w_float} кг", reply_markup=open_app_kb())
                     
@@ -1018,8 +4404,10 @@ def webhook():
                         return "OK", 200
                     
                     day = today_str()
-                    row = daily_find_or_create(ws_daily, user_id, day)
-                    daily_set(ws_daily, row, 4, str(w_float))
+                    with user_lock(user_id):
+                        row = daily_find_or_create(ws_daily, user_id, day)
+                        daily_set(ws_daily, row, 4, str(w_float))
+                        weight_index.record(user_id, day, "evening", str(w_float))
                     
                     tg_send(chat_id, f"Вес вечером записан ✅ {w_float} кг", reply_markup=open_app_kb())
                     
@@ -1054,14 +4442,15 @@ def webhook():
                     
                     day = today_str()
                     
-                    # Находим или создаём строку
-                    row = daily_find_or_create(ws_daily, user_id, day)
-                    
-                    # Записываем шаги (колонка 5)
-                    daily_set(ws_daily, row, 5, str(steps_int))
-                    
-                    # Пересчитываем калории
-                    recalculate_daily_stats(ws_daily, ws_users, ws_meals, user_id, day, row)
+                    with user_lock(user_id):
+                        # Находим или создаём строку
+                        row = daily_find_or_create(ws_daily, user_id, day)
+                        
+                        # Записываем шаги (колонка 5)
+                        daily_set(ws_daily, row, 5, str(steps_int))
+                        
+                        # Пересчитываем калории
+                        recalculate_daily_stats(ws_daily, ws_users, ws_meals, user_id, day, row)
                     
                     # Получаем обновлённые значения для ответа
                     values = get_daily_row_values(ws_daily, row)
@@ -1084,58 +4473,34 @@ def webhook():
             return "OK", 200
 
         # State-based handlers
-        ws_state = get_worksheet("state")
-        pending = state_get(ws_state, user_id)
+        pending = state_get(user_id)
         logger.info(f"Message from {user_id}, pending state: '{pending}'")
 
         # meal photo — начало диалога уточнений
         if "photo" in msg:
             logger.info(f"Photo received from {user_id}, pending='{pending}'")
             if pending == "meal":
-                ws_meals = get_worksheet("meals")
-                
+                # Дальше диалог идёт кнопками, состояние ему не нужно
+                state_clear(user_id)
+
                 best = msg["photo"][-1]
                 file_id = best["file_id"]
                 photo_url = tg_get_file_url(file_id)
                 
-                food_name, confidence = recognize_food(photo_url)
-                
-                temp_data = {
-                    "photo_url": photo_url,
-                    "file_id": file_id,
-                    "food_guess": food_name,
-                    "confidence": confidence
-                }
+                food_name, confidence = recognize_food(photo_url, best.get("file_unique_id", ""))
+                choice = {"food": None, "sauce": None, "size": None, "ref": msg.get("message_id", 0)}
                 
-                if confidence < 0.7:
-                    state_set(ws_state, user_id, "food_type", json.dumps(temp_data))
+                if confidence < 0.7 or food_name not in FOOD_CODE_OF:
                     tg_send(
                         chat_id,
                         "Не уверен, что на фото 🤔\nВыбери, что это:",
-                        reply_markup=make_food_kb("food_type")
+                        reply_markup=make_food_kb("food_type", user_id, choice),
+                        reply_to=choice["ref"]
                     )
                 else:
-                    rule = get_food_questions(food_name)
-                    if rule["ask_sauce"]:
-                        state_set(ws_state, user_id, "sauce", json.dumps(temp_data))
-                        tg_send(
-                            chat_id,
-                            f"Похоже на *{food_name}* ✅\nБыл соус или майонез?",
-                            reply_markup=make_food_kb("sauce")
-                        )
-                    elif rule["ask_size"]:
-                        state_set(ws_state, user_id, "size", json.dumps(temp_data))
-                        tg_send(
-                            chat_id,
-                            f"Похоже на *{food_name}* ✅\nКакой размер порции?",
-                            reply_markup=make_food_kb("size")
-                        )
-                    else:
-                        ws_daily = get_worksheet("daily_log")
-                        ws_users = get_worksheet("users")
-                        kcal = calculate_kcal(food_name)
-                        finalize_meal(ws_meals, ws_daily, ws_users, user_id, chat_id, temp_data, kcal)
-                        state_clear(ws_state, user_id)
+                    choice["food"] = food_name
+                    advance_meal(user_id, chat_id, choice, f"Похоже на *{food_name}* ✅",
+                                 lambda: (file_id, photo_url))
                 
                 return "OK", 200
             else:
@@ -1149,18 +4514,21 @@ def webhook():
             ws_daily = get_worksheet("daily_log")
             ws_users = get_worksheet("users")
             
-            kcal = estimate_text_kcal(text)
-            ws_meals.append_row([iso_now(), user_id, "text", "", text, "", "", str(kcal), "0.25", "", "", "MVP: текст"])
-            state_clear(ws_state, user_id)
-
+            items = parse_meal_text(text)
+            kcal = sum(i["kcal"] for i in items) or TEXT_KCAL_FALLBACK
+            notes = "; ".join(f"{i['food']} {i['grams']} г" for i in items) or "не распознано"
+            confidence = "0.6" if items else "0.25"
             day = today_str()
-            
-            # Пересчитываем статистику
-            row = daily_find_or_create(ws_daily, user_id, day)
-            recalculate_daily_stats(ws_daily, ws_users, ws_meals, user_id, day, row)
-            
-            # Получаем обновлённые значения
-            values = get_daily_row_values(ws_daily, row)
+            with user_lock(user_id):
+                ws_meals.append_row([iso_now(), user_id, "text", "", text, "", "", str(kcal), confidence, "", "", notes])
+                
+                # Прибавляем к kcal_eaten и пересчитываем статистику
+                row = add_meal_kcal(ws_daily, user_id, day, kcal)
+                recalculate_daily_stats(ws_daily, ws_users, ws_meals, user_id, day, row)
+                
+                # Получаем обновлённые значения
+                values = get_daily_row_values(ws_daily, row)
+            state_clear(user_id)
             eaten = values[8] if len(values) > 8 else "0"
             left = values[9] if len(values) > 9 else "?"
 
@@ -1170,10 +4538,117 @@ def webhook():
         tg_send(chat_id, "Открывай мини-приложение — там основной интерфейс.", reply_markup=open_app_kb())
         return "OK", 200
         
+    except WriteFlushError as e:
+        # Приём пищи и инкремент kcal уже записаны — повтор апдейта их задвоил бы
+        logger.error(f"handle_update: writes not flushed: {e}")
+        chat_id = update_chat_id(update)
+        if chat_id is not None:
+            tg_send(chat_id, "⚠️ Сохранилось не всё. Проверь данные в приложении.", reply_markup=open_app_kb())
+        return "OK", 200
     except Exception as e:
-        logger.error(f"webhook error: {e}")
+        logger.error(f"handle_update error: {e}")
         return "Error", 500
 
+# ========= Startup =========
+# Платформа усыпляет простаивающий инстанс, и первый запрос после пробуждения
+# раньше платил за всё сразу: импорт gspread, получение OAuth-токена, открытие
+# таблицы, чтение users. Теперь импорт лёгкий, а прогрев идёт фоновым потоком:
+# / и постановка апдейта в очередь (WEBHOOK_ASYNC) отвечают немедленно, а
+# обработчики, которым нужен ещё не готовый ресурс, просто ждут его на тех же
+# блокировках ленивых синглтонов.
+# Сам импорт ничего не запускает (тесты, bench.py, мастер gunicorn --preload):
+# прогрев стартует в процессе, который обслуживает запросы, — на первом
+# запросе (или раньше из post_fork gunicorn: app.start_warm_up()).
+WARMUP = os.environ.get("WARMUP", "1") == "1"
+
+startup_timings = {"import": None, "warmup": None, "first_response": None}
+warmup_steps = {}
+_first_response_lock = threading.Lock()
+_warmup_pid = None
+_warmup_lock = threading.Lock()
+
+def warm_storage():
+    # Заодно проверка старых непартиционированных листов (migrate_legacy_partitions)
+    get_partition("meals")
+    if STORAGE_BACKEND == "sheets":
+        sheet_handles.get_spreadsheet()
+
+def warm_users():
+    ws_users = get_worksheet("users")
+    USER_DIRECTORIES["users"].refresh(ws_users)
+    reminder_schedule.ensure_built(ws_users)
+
+def warm_queue():
+    if WEBHOOK_ASYNC:
+        get_update_queue()
+
+WARMUP_STEPS = [
+    ("shared_store", get_shared_store),
+    ("queue", warm_queue),
+    ("storage", warm_storage),
+    ("users", warm_users),
+    ("conversations", get_conversation_store),
+    ("update_ledger", get_update_ledger),
+    ("telegram", tg_client),
+    ("food_dict", get_food_matcher),
+    ("recognizer", get_recognition_service),
+]
+
+def warm_up():
+    """Фоновая инициализация тяжёлых ресурсов; ошибка шага не мешает остальным"""
+    started = time.monotonic()
+    for name, step in WARMUP_STEPS:
+        step_started = time.monotonic()
+        try:
+            step()
+            warmup_steps[name] = round(time.monotonic() - step_started, 3)
+        except Exception as e:
+            logger.error(f"warm-up {name} error: {e}")
+            warmup_steps[name] = None
+    startup_timings["warmup"] = time.monotonic() - started
+    logger.info(f"Warm-up done in {startup_timings['warmup']:.2f}s: {warmup_steps}")
+
+def start_warm_up():
+    """Запускает warm_up() один раз на процесс (после fork — заново)"""
+    global _warmup_pid
+    if not WARMUP or _warmup_pid == os.getpid():
+        return False
+    with _warmup_lock:
+        if _warmup_pid == os.getpid():
+            return False
+        _warmup_pid = os.getpid()
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    return True
+
+@app.before_request
+def warm_up_on_first_request():
+    if _warmup_pid != os.getpid():
+        start_warm_up()
+
+@app.after_request
+def record_first_response(resp):
+    if startup_timings["first_response"] is None:
+        with _first_response_lock:
+            if startup_timings["first_response"] is None:
+                startup_timings["first_response"] = time.monotonic() - PROCESS_STARTED
+                route = request.url_rule.rule if request.url_rule else "unmatched"
+                logger.info(f"First response {startup_timings['first_response']:.3f}s after start ({route})")
+    return resp
+
+def startup_gauges():
+    return [({"phase": k}, round(v, 4)) for k, v in startup_timings.items() if v is not None]
+
+metrics.gauge("startup_seconds", "Seconds since process start: import, warm-up, first response", startup_gauges)
+metrics.gauge("time_to_first_response_seconds", "Seconds from process start to the first HTTP response",
+              lambda: [({}, round(startup_timings["first_response"], 4))]
+              if startup_timings["first_response"] is not None else [])
+metrics.gauge("warmup_step_seconds", "Background warm-up duration by step",
+              lambda: [({"step": k}, v) for k, v in warmup_steps.items() if v is not None])
+
+startup_timings["import"] = time.monotonic() - PROCESS_STARTED
+logger.info(f"app imported in {startup_timings['import']:.3f}s")
+
 if __name__ == "__main__":
+    start_warm_up()
     port = int(os.environ.get("PORT", "5000"))
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,525 @@
+"""Офлайн-бенчмарк обработки апдейтов.
+
+Гоняет Flask test client по типовым сценариям (/start, еда фото + кнопки
+уточнений, вес и шаги из мини-приложения, /api/today, /api/weight_history,
+вечерний крон) против фейков в памяти: листов gspread и Bot API Telegram,
+с настраиваемой задержкой каждого вызова. Для каждого сценария печатает
+перцентили задержки и — главное — сколько чтений/записей Sheets и вызовов
+Telegram уходит на одну операцию.
+
+Запуск:
+    python bench.py                          # Sheets-бэкенд, без задержек
+    python bench.py --sheets-latency 80 --tg-latency 40
+    python bench.py --backend sqlite
+    python bench.py --json bench.json        # сохранить результат
+    python bench.py --baseline bench.json    # упасть, если вызовов стало больше
+    python bench.py --warmup                 # фоновый прогрев, как в проде
+
+В шапке отчёта — время импорта app и время до первого ответа.
+
+Отчёт также пишется в bench_output.txt (--out).
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+SHEETS_READ_OPS = {"open_spreadsheet", "open_worksheet", "worksheets", "get_all_values",
+                   "col_values", "row_values", "get", "batch_get"}
+BASE_USER_ID = 700000
+
+
+# ----- Фейк Google Sheets -----
+
+class FakeWorksheet:
+    def __init__(self, sheets, title):
+        self.sheets = sheets
+        self.title = title
+        self.data = []
+
+    def _call(self, op):
+        self.sheets.call(op)
+
+    def _set(self, r, c, v):
+        while len(self.data) < r:
+            self.data.append([])
+        row = self.data[r - 1]
+        while len(row) < c:
+            row.append("")
+        row[c - 1] = str(v)
+
+    @staticmethod
+    def _a1(cell):
+        m = re.match(r"([A-Z]+)(\d+)", cell)
+        col = 0
+        for ch in m.group(1):
+            col = col * 26 + ord(ch) - 64
+        return int(m.group(2)), col
+
+    @staticmethod
+    def _trim(values):
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def get_all_values(self):
+        self._call("get_all_values")
+        width = max((len(r) for r in self.data), default=0)
+        return [r + [""] * (width - len(r)) for r in self.data]
+
+    def col_values(self, col):
+        self._call("col_values")
+        return self._trim([r[col - 1] if len(r) >= col else "" for r in self.data])
+
+    def row_values(self, row):
+        self._call("row_values")
+        return self._trim(list(self.data[row - 1]) if row <= len(self.data) else [])
+
+    def update_cell(self, row, col, value):
+        self._call("update_cell")
+        self._set(row, col, value)
+
+    def update(self, range_name=None, values=None, **kwargs):
+        self._call("update")
+        r, c = self._a1(range_name.split(":")[0])
+        for i, vals in enumerate(values):
+            for j, v in enumerate(vals):
+                self._set(r + i, c + j, v)
+
+    def batch_update(self, data, **kwargs):
+        self._call("batch_update")
+        for d in data:
+            r, c = self._a1(d["range"].split(":")[0])
+            for i, vals in enumerate(d["values"]):
+                for j, v in enumerate(vals):
+                    self._set(r + i, c + j, v)
+
+    def append_row(self, values, **kwargs):
+        self._call("append_row")
+        self.data.append([str(v) for v in values])
+        n = len(self.data)
+        return {"updates": {"updatedRange": f"{self.title}!A{n}:Z{n}"}}
+
+    def append_rows(self, values, **kwargs):
+        self._call("append_rows")
+        start = len(self.data) + 1
+        self.data.extend([str(v) for v in row] for row in values)
+        return {"updates": {"updatedRange": f"{self.title}!A{start}:Z{len(self.data)}"}}
+
+    def update_title(self, title):
+        self._call("update_title")
+        self.sheets.tabs[title] = self.sheets.tabs.pop(self.title)
+        self.title = title
+
+    def clear(self):
+        self._call("clear")
+        self.data = []
+
+    def resize(self, rows=None, cols=None):
+        self._call("resize")
+
+
+class FakeSheets:
+    """Таблица целиком: клиент gspread (open_by_key) и Spreadsheet в одном"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.tabs = {}
+        self.calls = Counter()
+
+    def call(self, op):
+        self.calls[op] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    # gspread.Client
+    def open_by_key(self, key):
+        self.call("open_spreadsheet")
+        return self
+
+    # gspread.Spreadsheet
+    def worksheet(self, name):
+        import gspread
+        self.call("open_worksheet")
+        if name not in self.tabs:
+            raise gspread.WorksheetNotFound(name)
+        return self.tabs[name]
+
+    def worksheets(self):
+        self.call("worksheets")
+        return list(self.tabs.values())
+
+    def add_worksheet(self, title, rows=1000, cols=20):
+        self.call("add_worksheet")
+        ws = self.tabs[title] = FakeWorksheet(self, title)
+        return ws
+
+    def del_worksheet(self, ws):
+        self.call("del_worksheet")
+        self.tabs.pop(ws.title, None)
+
+
+# ----- Фейк Bot API -----
+
+class FakeResponse:
+    def __init__(self, payload, status_code=200, content=b""):
+        self._payload = payload
+        self.status_code = status_code
+        self.headers = {}
+        self.content = content
+
+    def json(self):
+        return self._payload
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeTelegram:
+    """Подменяет requests.Session клиента Bot API"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+
+    def _call(self, method):
+        self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def post(self, url, json=None, timeout=None, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        self._call(method)
+        return FakeResponse({"ok": True, "result": {"message_id": 1}})
+
+    def get(self, url, params=None, timeout=None, **kwargs):
+        if "/file/bot" in url:
+            self._call("downloadFile")
+            return FakeResponse({}, content=b"\xff\xd8\xff")
+        method = url.rsplit("/", 1)[-1]
+        self._call(method)
+        return FakeResponse({"ok": True, "result": {"file_path": "photos/bench.jpg"}})
+
+
+# ----- Сценарии -----
+
+def message(uid, **fields):
+    return {"message_id": fields.pop("message_id", 1), "chat": {"id": uid},
+            "from": {"id": uid, "first_name": "Bench"}, **fields}
+
+
+def callback(uid, data, reply_to=None):
+    msg = {"message_id": 2, "chat": {"id": uid}}
+    if reply_to:
+        msg["reply_to_message"] = reply_to
+    return {"id": "cb", "from": {"id": uid}, "message": msg, "data": data}
+
+
+class Bench:
+    def __init__(self, app_module, sheets, telegram, cold=False):
+        self.A = app_module
+        self.client = app_module.app.test_client()
+        self.sheets = sheets
+        self.telegram = telegram
+        self.cold = cold
+        self.update_id = 0
+        self.results = {}
+        self.current = None
+
+    def update(self, update_id=None, **fields):
+        if update_id is None:
+            self.update_id += 1
+            update_id = self.update_id
+        r = self.client.post("/webhook", json={"update_id": update_id, **fields})
+        if self.A.WEBHOOK_ASYNC:
+            self.A.get_update_queue().drain()
+        return r
+
+    def get(self, url):
+        return self.client.get(url)
+
+    @contextmanager
+    def measure(self):
+        if self.cold:
+            self.A.invalidate_sheet_indexes()
+        sheets_before = Counter(self.sheets.calls) if self.sheets else Counter()
+        tg_before = Counter(self.telegram.calls)
+        started = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - started
+        stats = self.results[self.current]
+        stats["latency"].append(elapsed)
+        if self.sheets:
+            stats["sheets"].update(self.sheets.calls - sheets_before)
+        stats["telegram"].update(self.telegram.calls - tg_before)
+
+    def run(self, name, scenario, users, iterations):
+        self.current = name
+        self.results[name] = {"latency": [], "sheets": Counter(), "telegram": Counter()}
+        for i in range(iterations):
+            scenario(self, users[i % len(users)], i)
+
+
+def sc_start(b, uid, i):
+    with b.measure():
+        b.update(message=message(uid, text="/start"))
+
+
+def sc_photo_meal(b, uid, i):
+    b.update(callback_query=callback(uid, "meal_prompt"))
+    with b.measure():
+        b.update(message=message(uid, message_id=100 + i,
+                                 photo=[{"file_id": f"F{i}", "file_unique_id": f"U{uid}_{i}"}]))
+
+
+def meal_choice_cb(b, uid, i, **choice):
+    ref = 100 + i
+    data = b.A.encode_meal_cb(str(uid), {"food": None, "sauce": None, "size": None, "ref": ref, **choice})
+    photo = {"message_id": ref, "photo": [{"file_id": f"F{i}", "file_unique_id": f"U{uid}_{i}"}]}
+    return callback(uid, data, reply_to=photo)
+
+
+def sc_food_cb(b, uid, i):
+    with b.measure():
+        b.update(callback_query=meal_choice_cb(b, uid, i, food="бургер"))
+
+
+def sc_sauce_cb(b, uid, i):
+    with b.measure():
+        b.update(callback_query=meal_choice_cb(b, uid, i, food="бургер", sauce="майонез"))
+
+
+def sc_size_cb(b, uid, i):
+    with b.measure():
+        b.update(callback_query=meal_choice_cb(b, uid, i, food="бургер", sauce="майонез", size="large"))
+
+
+def sc_redelivery(b, uid, i):
+    """Telegram повторил уже обработанный апдейт (запись еды)"""
+    cb = meal_choice_cb(b, uid, i, food="бургер", sauce="майонез", size="large")
+    b.update(callback_query=cb)
+    with b.measure():
+        b.update(update_id=b.update_id, callback_query=cb)
+
+
+def sc_text_meal(b, uid, i):
+    b.update(callback_query=callback(uid, "meal_prompt"))
+    with b.measure():
+        b.update(message=message(uid, text="2 яйца, 200 г гречки и хлеб"))
+
+
+def sc_weight(b, uid, i):
+    data = json.dumps({"action": "weight_morning", "weight_morning_kg": str(90 - i * 0.1)})
+    with b.measure():
+        b.update(message=message(uid, web_app_data={"data": data}))
+
+
+def sc_steps(b, uid, i):
+    data = json.dumps({"action": "steps", "steps": str(5000 + i * 100)})
+    with b.measure():
+        b.update(message=message(uid, web_app_data={"data": data}))
+
+
+def sc_api_today(b, uid, i):
+    with b.measure():
+        b.get(f"/api/today?user_id={uid}")
+
+
+def sc_api_weight_history(b, uid, i):
+    with b.measure():
+        b.get(f"/api/weight_history?user_id={uid}")
+
+
+def sc_checkout(b, uid, i):
+    b.A.reminder_schedule.clear_sent()
+    with b.measure():
+        b.get(f"/trigger_reminder?secret={b.A.CRON_SECRET}&mode=checkout&wait=1")
+
+
+SCENARIOS = [
+    ("start", sc_start),
+    ("photo_meal", sc_photo_meal),
+    ("food_cb", sc_food_cb),
+    ("sauce_cb", sc_sauce_cb),
+    ("size_cb", sc_size_cb),
+    ("redelivery", sc_redelivery),
+    ("text_meal", sc_text_meal),
+    ("weight", sc_weight),
+    ("steps", sc_steps),
+    ("api_today", sc_api_today),
+    ("api_weight_history", sc_api_weight_history),
+    ("checkout_cron", sc_checkout),
+]
+
+
+# ----- Отчёт -----
+
+def percentile(values, p):
+    """Перцентиль по ближайшему рангу"""
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(p / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[k]
+
+
+def summarize(results):
+    summary = {}
+    for name, stats in results.items():
+        n = len(stats["latency"]) or 1
+        reads = sum(v for op, v in stats["sheets"].items() if op in SHEETS_READ_OPS)
+        writes = sum(v for op, v in stats["sheets"].items() if op not in SHEETS_READ_OPS)
+        summary[name] = {
+            "n": len(stats["latency"]),
+            "p50_ms": round(percentile(stats["latency"], 50) * 1000, 2),
+            "p95_ms": round(percentile(stats["latency"], 95) * 1000, 2),
+            "p99_ms": round(percentile(stats["latency"], 99) * 1000, 2),
+            "max_ms": round(max(stats["latency"]) * 1000, 2),
+            "sheets_reads": round(reads / n, 2),
+            "sheets_writes": round(writes / n, 2),
+            "telegram_calls": round(sum(stats["telegram"].values()) / n, 2),
+            "sheets_ops": {op: round(v / n, 2) for op, v in sorted(stats["sheets"].items())},
+            "telegram_ops": {op: round(v / n, 2) for op, v in sorted(stats["telegram"].items())},
+        }
+    return summary
+
+
+def render(summary, startup, args):
+    head = (f"backend={args.backend} users={args.users} iterations={args.iterations} "
+            f"sheets_latency={args.sheets_latency}ms tg_latency={args.tg_latency}ms "
+            f"sheets_quota={args.sheets_quota or '-'} cold={args.cold} warmup={args.warmup}")
+    start = (f"startup: import {startup['import_ms']} ms, "
+             f"first response {startup['first_response_ms']} ms after start")
+    lines = [head, start, "",
+             f"{'scenario':<20}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+             f"{'sh.read':>9}{'sh.write':>9}{'tg':>6}"]
+    for name, s in summary.items():
+        lines.append(f"{name:<20}{s['p50_ms']:>9.2f}{s['p95_ms']:>9.2f}{s['p99_ms']:>9.2f}{s['max_ms']:>9.2f}"
+                     f"{s['sheets_reads']:>9.2f}{s['sheets_writes']:>9.2f}{s['telegram_calls']:>6.2f}")
+    lines.append("")
+    lines.append("per-operation calls:")
+    for name, s in summary.items():
+        ops = ", ".join(f"{op}={v:g}" for op, v in {**s["sheets_ops"], **s["telegram_ops"]}.items())
+        lines.append(f"  {name}: {ops or '-'}")
+    return "\n".join(lines) + "\n"
+
+
+def check_baseline(summary, path, tolerance):
+    """Сравнивает число вызовов на операцию с сохранённым прогоном"""
+    with open(path, encoding="utf-8") as f:
+        baseline = json.load(f)["scenarios"]
+    failures = []
+    for name, s in summary.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for key in ("sheets_reads", "sheets_writes", "telegram_calls"):
+            if s[key] > base[key] + tolerance:
+                failures.append(f"{name}: {key} {base[key]} -> {s[key]}")
+    return failures
+
+
+# ----- Запуск -----
+
+def setup_env(args, workdir):
+    os.environ.setdefault("BOT_TOKEN", "bench")
+    os.environ.setdefault("CRON_SECRET", "bench")
+    os.environ["STORAGE_BACKEND"] = args.backend
+    os.environ.setdefault("SHEET_ID", "bench")
+    os.environ.setdefault("GOOGLE_CREDS_JSON", "{}")
+    os.environ["SQLITE_PATH"] = os.path.join(workdir, "bench.db")
+    os.environ["STATE_JOURNAL_PATH"] = os.path.join(workdir, "state_journal.jsonl")
+    os.environ["UPDATE_LEDGER_PATH"] = os.path.join(workdir, "update_ledger.db")
+    os.environ["SHARED_STATE_PATH"] = os.path.join(workdir, "shared_state.db")
+    os.environ["LOCK_PATH"] = os.path.join(workdir, "bench.lock")
+    # Фейки ставятся после импорта app, поэтому прогрев запускаем сами (--warmup)
+    os.environ["WARMUP"] = "0"
+    os.environ.setdefault("RECOGNIZER", "none")
+    os.environ.setdefault("TELEGRAM_API_BASE", "http://telegram.bench")
+    os.environ.setdefault("TG_GLOBAL_RATE", "100000")
+    os.environ.setdefault("TG_CHAT_RATE", "100000")
+    os.environ.setdefault("TG_CHAT_BURST", "100000")
+    # Квоты Sheets: по умолчанию не ограничиваем, чтобы мерить только сами вызовы
+    quota = str(args.sheets_quota or 10 ** 9)
+    os.environ["SHEETS_READ_QUOTA"] = quota
+    os.environ["SHEETS_WRITE_QUOTA"] = quota
+    os.environ["SHEETS_BURST"] = str(args.sheets_burst or quota)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--backend", choices=["sheets", "sqlite"], default="sheets")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--iterations", type=int, default=40)
+    parser.add_argument("--sheets-latency", type=float, default=0.0, help="мс на вызов Sheets")
+    parser.add_argument("--tg-latency", type=float, default=0.0, help="мс на вызов Telegram")
+    parser.add_argument("--sheets-quota", type=int, default=0,
+                        help="квота Sheets (запросов в минуту на чтение и на запись), 0 — без лимита")
+    parser.add_argument("--sheets-burst", type=int, default=0, help="запас токенов квоты")
+    parser.add_argument("--cold", action="store_true", help="сбрасывать кэши перед каждой операцией")
+    parser.add_argument("--warmup", action="store_true", help="фоновый прогрев сразу после импорта")
+    parser.add_argument("--scenario", action="append", help="только эти сценарии")
+    parser.add_argument("--out", default="bench_output.txt")
+    parser.add_argument("--json", help="сохранить результат в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона: упасть, если вызовов стало больше")
+    parser.add_argument("--tolerance", type=float, default=0.0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    setup_env(args, workdir)
+    logging.disable(logging.WARNING)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as A
+    import_ms = round(A.startup_timings["import"] * 1000, 1)
+
+    sheets = None
+    if args.backend == "sheets":
+        sheets = FakeSheets(args.sheets_latency / 1000.0)
+        A._sheet_client = sheets
+    telegram = FakeTelegram(args.tg_latency / 1000.0)
+    A.tg_client().session = telegram
+    if args.warmup:
+        threading.Thread(target=A.warm_up, daemon=True).start()
+
+    bench = Bench(A, sheets, telegram, cold=args.cold)
+    # Вечерний отчёт должен прийти всем во время прогона
+    now_hhmm = datetime.now(timezone.utc).strftime("%H:%M")
+    users = [BASE_USER_ID + n for n in range(args.users)]
+    for uid in users:
+        bench.client.post("/api/profile_save", json={
+            "user_id": uid, "first_name": "Bench", "start_weight_kg": 95, "height_cm": 180,
+            "age": 35, "goal_weight_kg": 80, "goal_weeks": 20,
+            "timezone": "UTC", "checkout_time": now_hhmm,
+        })
+
+    selected = [(n, f) for n, f in SCENARIOS if not args.scenario or n in args.scenario]
+    for name, scenario in selected:
+        bench.run(name, scenario, users, args.iterations)
+
+    summary = summarize(bench.results)
+    startup = {"import_ms": import_ms,
+               "first_response_ms": round(A.startup_timings["first_response"] * 1000, 1)}
+    report = render(summary, startup, args)
+    sys.stdout.write(report)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "startup": startup, "scenarios": summary}, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        failures = check_baseline(summary, args.baseline, args.tolerance)
+        for line in failures:
+            print(f"REGRESSION {line}")
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Офлайн-сборка медиа мини-приложения.
+
+Из web/gipsy.mp4 делает облегчённый вариант фонового видео (без звука,
+меньше разрешение и битрейт, moov в начале файла для быстрого старта)
+и постер — первый кадр, который показывается до загрузки видео.
+
+Запуск: python build_assets.py — шаг сборки при деплое; результаты в git
+не хранятся (.gitignore). Нужен ffmpeg в PATH (или путь в переменной FFMPEG).
+Без них app.py убирает ссылки на них из index.html и отдаёт исходное видео.
+
+Хэшированные URL и gzip/brotli для html/js/css делает сам app.py при старте.
+"""
+import os
+import shutil
+import subprocess
+import sys
+
+WEB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "web")
+SOURCE_VIDEO = "gipsy.mp4"
+
+# имя файла -> аргументы ffmpeg
+VIDEO_VARIANTS = {
+    "gipsy.low.mp4": [
+        "-an",
+        "-vf", "scale=480:-2",
+        "-c:v", "libx264", "-profile:v", "main", "-preset", "slow",
+        "-crf", "30", "-maxrate", "600k", "-bufsize", "1200k",
+        "-pix_fmt", "yuv420p",
+        "-movflags", "+faststart",
+    ],
+}
+POSTER = ("gipsy.poster.jpg", ["-frames:v", "1", "-vf", "scale=480:-2", "-q:v", "5"])
+
+
+def find_ffmpeg():
+    exe = os.environ.get("FFMPEG") or shutil.which("ffmpeg")
+    if not exe:
+        sys.exit("ffmpeg not found: install it or set FFMPEG=/path/to/ffmpeg")
+    return exe
+
+
+def run(ffmpeg, out_name, args):
+    src = os.path.join(WEB_DIR, SOURCE_VIDEO)
+    dst = os.path.join(WEB_DIR, out_name)
+    cmd = [ffmpeg, "-hide_banner", "-loglevel", "error", "-y", "-i", src] + args + [dst]
+    subprocess.run(cmd, check=True)
+    print(f"{out_name}: {os.path.getsize(src)} -> {os.path.getsize(dst)} bytes")
+
+
+def main():
+    ffmpeg = find_ffmpeg()
+    for name, args in VIDEO_VARIANTS.items():
+        run(ffmpeg, name, args)
+    run(ffmpeg, *POSTER)
+
+
+if __name__ == "__main__":
+    main()
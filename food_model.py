@@ -0,0 +1,124 @@
+"""Локальный распознаватель еды: ближайший центроид по цветовой гистограмме.
+
+Это заглушка на CPU вместо «настоящего» AI: картинка сжимается до 32x32,
+считается HSV-гистограмма (8 оттенков x 3 насыщенности x 3 яркости), и
+класс выбирается по ближайшему центроиду. Модель — JSON с центроидами,
+обучается на размеченных фото:
+
+    python food_model.py train photos/ [food_model.json]
+
+где photos/<название из FOOD_RULES>/*.jpg.
+
+Модуль отдельный и без зависимостей от app.py, чтобы процессы пула
+распознавания стартовали быстро. Нужен Pillow.
+"""
+import colorsys
+import io
+import json
+import os
+import sys
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+BINS = (8, 3, 3)
+THUMB = (32, 32)
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def extract_features(image_bytes):
+    """bytes картинки -> нормированная HSV-гистограмма (список float)"""
+    if Image is None:
+        raise RuntimeError("Pillow is not installed")
+    img = Image.open(io.BytesIO(image_bytes))
+    img.draft("RGB", (THUMB[0] * 4, THUMB[1] * 4))  # JPEG декодируется сразу в уменьшенном виде
+    img = img.convert("RGB").resize(THUMB)
+    hb, sb, vb = BINS
+    hist = [0.0] * (hb * sb * vb)
+    raw = img.tobytes()
+    for i in range(0, len(raw), 3):
+        r, g, b = raw[i], raw[i + 1], raw[i + 2]
+        h, s, v = colorsys.rgb_to_hsv(r / 255.0, g / 255.0, b / 255.0)
+        hi = min(int(h * hb), hb - 1)
+        si = min(int(s * sb), sb - 1)
+        vi = min(int(v * vb), vb - 1)
+        hist[(hi * sb + si) * vb + vi] += 1
+    n = float(len(raw) // 3)
+    return [x / n for x in hist]
+
+
+def distance(a, b):
+    """Хи-квадрат между гистограммами"""
+    return sum((x - y) ** 2 / (x + y) for x, y in zip(a, b) if x + y > 0)
+
+
+def load_model(path):
+    with open(path, encoding="utf-8") as f:
+        model = json.load(f)
+    if tuple(model.get("bins", ())) != BINS:
+        raise ValueError(f"Model {path} was built with other bins: {model.get('bins')}")
+    return model
+
+
+def classify(features, model):
+    """-> (label, confidence). Уверенность — насколько лучший центроид ближе второго"""
+    scored = sorted(
+        (distance(features, c), label) for label, c in zip(model["labels"], model["centroids"])
+    )
+    if not scored:
+        return "неизвестно", 0.0
+    best_d, best = scored[0]
+    if len(scored) == 1:
+        return best, 0.5
+    second_d = scored[1][0]
+    confidence = 1.0 - best_d / second_d if second_d > 0 else 0.0
+    return best, round(max(0.0, min(1.0, confidence)), 3)
+
+
+def train(photos_dir):
+    """photos/<label>/*.jpg -> модель с центроидом на метку"""
+    labels, centroids = [], []
+    for label in sorted(os.listdir(photos_dir)):
+        folder = os.path.join(photos_dir, label)
+        if not os.path.isdir(folder):
+            continue
+        feats = []
+        for name in sorted(os.listdir(folder)):
+            if name.lower().endswith(IMAGE_EXTS):
+                with open(os.path.join(folder, name), "rb") as f:
+                    feats.append(extract_features(f.read()))
+        if not feats:
+            continue
+        labels.append(label)
+        centroids.append([sum(col) / len(feats) for col in zip(*feats)])
+        print(f"{label}: {len(feats)} photos")
+    return {"bins": list(BINS), "labels": labels, "centroids": centroids}
+
+
+# ----- Процесс пула распознавания -----
+_worker_model = None
+
+
+def init_worker(model_path):
+    global _worker_model
+    _worker_model = load_model(model_path)
+
+
+def classify_in_worker(image_bytes):
+    return classify(extract_features(image_bytes), _worker_model)
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] != "train":
+        sys.exit("usage: python food_model.py train PHOTOS_DIR [OUT_JSON]")
+    out = sys.argv[3] if len(sys.argv) > 3 else "food_model.json"
+    model = train(sys.argv[2])
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(model, f, ensure_ascii=False)
+    print(f"saved {out}: {len(model['labels'])} labels")
+
+
+if __name__ == "__main__":
+    main()
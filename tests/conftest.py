@@ -0,0 +1,195 @@
+"""Общие фикстуры тестов.
+
+app.py читает настройки из окружения при импорте, поэтому окружение
+(SQLite-хранилище и служебные файлы во временном каталоге, без прогрева и
+без пула распознавания) выставляется здесь, до первого `import app`.
+"""
+import json
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TMP = tempfile.mkdtemp(prefix="bot_hudey_tests_")
+
+os.environ.update(
+    BOT_TOKEN="test-token",
+    CRON_SECRET="test-secret",
+    STORAGE_BACKEND="sqlite",
+    SQLITE_PATH=os.path.join(TMP, "storage.db"),
+    UPDATE_LEDGER_PATH=os.path.join(TMP, "update_ledger.db"),
+    STATE_JOURNAL_PATH=os.path.join(TMP, "state_journal.jsonl"),
+    SHARED_STATE_PATH=os.path.join(TMP, "shared_state.db"),
+    LOCK_PATH=os.path.join(TMP, "bot_hudey.lock"),
+    ARCHIVE_DIR=os.path.join(TMP, "archive"),
+    # Настоящий Bot API тесты не трогают: по умолчанию — закрытый порт
+    TELEGRAM_API_BASE="http://127.0.0.1:9",
+    WARMUP="0",
+    RECOGNIZER="none",
+    BROADCAST_BACKOFF="0.01",
+)
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope="session")
+def app_module():
+    import app
+    return app
+
+
+@pytest.fixture
+def shared_store(app_module, tmp_path, monkeypatch):
+    """Чистый shared_store на тест"""
+    store = app_module.SharedStore(str(tmp_path / "shared_state.db"))
+    monkeypatch.setattr(app_module, "_shared_store", store)
+    return store
+
+
+class FakeBotApi:
+    """Локальный HTTP-сервер вместо api.telegram.org.
+
+    responder(method, payload) -> (status, json) решает, что ответить;
+    по умолчанию — {"ok": true}. Все запросы пишутся в calls.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.responder = lambda method, payload: (200, {"ok": True, "result": {}})
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                method = self.path.rsplit("/", 1)[-1]
+                fake.calls.append((method, payload))
+                status, body = fake.responder(method, payload)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/bottest-token"
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05},
+                                       daemon=True)
+
+    def methods(self, name):
+        return [payload for method, payload in self.calls if method == name]
+
+
+@pytest.fixture
+def fake_bot_api():
+    fake = FakeBotApi()
+    fake.thread.start()
+    yield fake
+    fake.server.shutdown()
+    fake.server.server_close()
+
+
+@pytest.fixture
+def telegram(app_module, fake_bot_api, monkeypatch):
+    """tg_client() приложения, направленный на FakeBotApi, без ожиданий лимитов"""
+    client = app_module.TelegramClient(fake_bot_api.url, global_rate=1000, chat_rate=1000,
+                                       chat_burst=1000, backoff=0.01)
+    monkeypatch.setattr(app_module, "_tg_client", client)
+    return fake_bot_api
+
+
+class FakeTab:
+    """Лист в памяти с нужными приложению методами gspread.Worksheet"""
+
+    def __init__(self, book, title, rows):
+        self.book, self.title, self.rows = book, title, [list(r) for r in rows]
+        self.reads = 0
+        self.fail_append = False
+
+    def get_all_values(self):
+        self.reads += 1
+        return [list(r) for r in self.rows]
+
+    def row_values(self, row):
+        self.reads += 1
+        return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def col_values(self, col):
+        self.reads += 1
+        return [r[col - 1] if len(r) >= col else "" for r in self.rows]
+
+    def _set(self, row, col, value):
+        while len(self.rows) < row:
+            self.rows.append([])
+        cells = self.rows[row - 1]
+        while len(cells) < col:
+            cells.append("")
+        cells[col - 1] = value
+
+    def update_cell(self, row, col, value):
+        self._set(row, col, str(value))
+
+    def batch_update(self, data, **kwargs):
+        app = sys.modules["app"]
+        for item in data:
+            start = item["range"].split(":")[0]
+            row, col = app.parse_a1(start)
+            for i, value in enumerate(item["values"][0]):
+                self._set(row, col + i, value)
+
+    def append_row(self, values, **kwargs):
+        self.rows.append(list(values))
+        return {"updates": {"updatedRange": f"{self.title}!A{len(self.rows)}:N{len(self.rows)}"}}
+
+    def append_rows(self, rows, **kwargs):
+        if self.fail_append:
+            self.fail_append = False
+            raise RuntimeError("quota exceeded")
+        self.rows.extend(list(r) for r in rows)
+
+    def update_title(self, title):
+        self.book[title] = self.book.pop(self.title)
+        self.title = title
+
+
+class FakeSheetHandles:
+    """sheet_handles над словарём листов; недостающий лист создаётся с заголовком"""
+
+    def __init__(self, app_module):
+        self.app = app_module
+        self.book = {}
+
+    def titles(self):
+        return list(self.book)
+
+    def worksheet(self, name):
+        if name not in self.book:
+            header = self.app.SHEET_HEADERS[self.app.base_table_name(name)]
+            self.book[name] = FakeTab(self.book, name, [header])
+        return self.book[name]
+
+    def add(self, name, rows):
+        header = self.app.SHEET_HEADERS[self.app.base_table_name(name)]
+        self.book[name] = FakeTab(self.book, name, [header] + rows)
+        return self.book[name]
+
+    def forget(self, name):
+        pass
+
+
+@pytest.fixture
+def fake_sheets(app_module, shared_store, monkeypatch):
+    """Хранилище Sheets поверх FakeSheetHandles (без квот Sheets API)"""
+    handles = FakeSheetHandles(app_module)
+    monkeypatch.setattr(app_module, "sheets_buckets", {
+        kind: app_module.TokenBucket(1e6, 1e6) for kind in app_module.sheets_buckets})
+    monkeypatch.setattr(app_module, "sheet_handles", handles)
+    monkeypatch.setattr(app_module, "_storage", app_module.SheetsStorage())
+    return handles
@@ -0,0 +1,90 @@
+import pytest
+
+DAY = "2026-10-17"
+
+
+def messages(*user_ids):
+    return [({"user_id": uid}, DAY, f"hi {uid}") for uid in user_ids]
+
+
+@pytest.fixture
+def bot(telegram):
+    """Пользователь 2 заблокировал бота, у 3 чат не найден, остальным доставляется"""
+    def responder(method, payload):
+        chat = str(payload.get("chat_id"))
+        if chat == "2":
+            return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+        if chat == "3":
+            return 400, {"ok": False, "error_code": 400, "description": "Bad Request: chat not found"}
+        return 200, {"ok": True, "result": {}}
+    telegram.responder = responder
+    return telegram
+
+
+def sent_to(bot):
+    return sorted(str(m["chat_id"]) for m in bot.methods("sendMessage"))
+
+
+def test_results_per_recipient(app_module, shared_store, bot):
+    report = app_module.broadcast("checkin", messages("1", "2", "3", "4"))
+
+    statuses = {uid: r["status"] for uid, r in report["results"].items()}
+    assert statuses == {"1": "sent", "2": "blocked", "3": "failed", "4": "sent"}
+    assert sent_to(bot) == ["1", "2", "3", "4"]
+    assert report["total"] == 4 and report["sent"] == 2
+    assert shared_store.get("broadcast", "checkin")["failed"] == 1
+
+
+def test_blocked_user_is_skipped_next_time(app_module, shared_store, bot):
+    app_module.broadcast("checkin", messages("2"))
+    assert app_module.is_user_inactive("2")
+    bot.calls.clear()
+
+    report = app_module.broadcast("checkout", messages("2"))
+
+    assert report["results"]["2"] == {"status": "skipped", "reason": "inactive"}
+    assert bot.calls == []
+
+
+def test_failed_send_releases_the_claim(app_module, shared_store, bot):
+    app_module.broadcast("checkin", messages("1", "3"))
+    bot.calls.clear()
+
+    report = app_module.broadcast("checkin", messages("1", "3"))
+
+    assert report["results"]["1"]["reason"] == "already sent"
+    assert report["results"]["3"]["status"] == "failed"
+    assert sent_to(bot) == ["3"]
+
+
+def test_transient_errors_are_retried(app_module, shared_store, telegram):
+    failures = {"5": 4}  # больше, чем повторов внутри TelegramClient
+
+    def responder(method, payload):
+        chat = str(payload["chat_id"])
+        if failures.get(chat):
+            failures[chat] -= 1
+            return 502, {"ok": False}
+        return 200, {"ok": True, "result": {}}
+    telegram.responder = responder
+
+    report = app_module.broadcast("checkin", messages("5"))
+
+    assert report["results"]["5"]["status"] == "sent"
+    assert report["results"]["5"]["attempts"] == 2
+
+
+def test_user_is_reactivated_by_unblocking_or_writing(app_module, shared_store, telegram):
+    client = app_module.app.test_client()
+    app_module.mark_user_inactive("7", "test")
+    client.post("/webhook", json={"update_id": 2501, "my_chat_member": {
+        "chat": {"id": 7, "type": "private"}, "new_chat_member": {"status": "member"}}})
+    assert not app_module.is_user_inactive("7")
+
+    client.post("/webhook", json={"update_id": 2502, "my_chat_member": {
+        "chat": {"id": 7, "type": "private"}, "new_chat_member": {"status": "kicked"}}})
+    assert app_module.is_user_inactive("7")
+
+    client.post("/webhook", json={"update_id": 2503, "message": {
+        "message_id": 1, "chat": {"id": 7}, "from": {"id": 7}, "text": "привет"}})
+    assert not app_module.is_user_inactive("7")
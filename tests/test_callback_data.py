@@ -0,0 +1,68 @@
+import pytest
+
+CHOICE = {"food": "бургер", "sauce": "майонез", "size": "large", "ref": 123456}
+
+
+def test_round_trip(app_module):
+    data = app_module.encode_meal_cb("42", CHOICE)
+
+    assert len(data.encode("utf-8")) <= 64
+    assert app_module.decode_meal_cb("42", data) == CHOICE
+
+
+def test_unset_fields_round_trip(app_module):
+    choice = {"food": "салат", "sauce": None, "size": None, "ref": 0}
+
+    assert app_module.decode_meal_cb("42", app_module.encode_meal_cb("42", choice)) == choice
+
+
+def test_button_of_another_user_is_rejected(app_module):
+    data = app_module.encode_meal_cb("42", CHOICE)
+
+    assert app_module.decode_meal_cb("43", data) is None
+
+
+@pytest.mark.parametrize("tamper", [
+    lambda d: d.replace(":bml:", ":hml:"),         # другая еда
+    lambda d: d.replace(":2n9c:", ":2n9d:"),       # другое фото
+    lambda d: d[:-1] + ("A" if d[-1] != "A" else "B"),  # подпись
+    lambda d: d.rsplit(":", 1)[0],                 # без подписи
+])
+def test_tampered_data_is_rejected(app_module, tamper):
+    data = app_module.encode_meal_cb("42", CHOICE)
+    forged = tamper(data)
+
+    assert forged != data
+    assert app_module.decode_meal_cb("42", forged) is None
+
+
+@pytest.mark.parametrize("data", ["food:бургер", "sauce:yes", "size:large", "m:bml", "", "m::x:y"])
+def test_legacy_and_malformed_data_is_rejected(app_module, data):
+    assert app_module.decode_meal_cb("42", data) is None
+
+
+def callback_update(update_id, data, message):
+    return {"update_id": update_id,
+            "callback_query": {"id": "cb", "from": {"id": 42}, "data": data, "message": message}}
+
+
+def test_webhook_answers_forged_button_as_stale(app_module, telegram):
+    forged = app_module.encode_meal_cb("43", CHOICE)
+    client = app_module.app.test_client()
+
+    r = client.post("/webhook", json=callback_update(1501, forged, {"chat": {"id": 42}}))
+
+    assert r.status_code == 200
+    assert [m["text"] for m in telegram.methods("sendMessage")] == ["Кнопка устарела, начни заново."]
+
+
+def test_webhook_asks_for_photo_when_reply_is_missing(app_module, telegram):
+    data = app_module.encode_meal_cb("42", {"food": "бургер", "sauce": None, "size": None, "ref": 7})
+    client = app_module.app.test_client()
+
+    r = client.post("/webhook", json=callback_update(1502, data, {"chat": {"id": 42}}))
+
+    assert r.status_code == 200
+    [reply] = telegram.methods("sendMessage")
+    assert reply["chat_id"] == 42
+    assert "Пришли фото ещё раз" in reply["text"]
@@ -0,0 +1,98 @@
+"""ConversationStore: восстановление из журнала, недописанные строки, TTL и
+догонка журнала другим процессом (у каждого экземпляра свои inode и offset)."""
+import json
+import os
+import time
+
+import pytest
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return str(tmp_path / "state_journal.jsonl")
+
+
+def write_journal(path, records, tail=b""):
+    with open(path, "wb") as f:
+        for rec in records:
+            f.write((json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8"))
+        f.write(tail)
+
+
+def test_replay_then_compact(app_module, journal):
+    now = time.time()
+    write_journal(journal, [
+        {"u": "1", "a": "meal", "d": "", "t": now},
+        {"u": "2", "a": "weight", "d": "{\"x\": 1}", "t": now},
+        {"u": "1", "a": ""},
+        {"u": "2", "a": "steps", "d": "", "t": now},
+    ])
+
+    store = app_module.ConversationStore(journal)
+
+    assert store.get("1") == ("", "")
+    assert store.get("2") == ("steps", "")
+    with open(journal, encoding="utf-8") as f:
+        assert [json.loads(line)["u"] for line in f] == ["2"]
+
+
+def test_torn_last_line_is_skipped(app_module, journal):
+    write_journal(journal, [{"u": "1", "a": "meal", "d": "", "t": time.time()}],
+                  tail=b'{"u": "2", "a": "wei')
+
+    store = app_module.ConversationStore(journal)
+
+    assert store.get("1") == ("meal", "")
+    assert store.get("2") == ("", "")
+    store.set("3", "steps")
+    assert app_module.ConversationStore(journal).get("3") == ("steps", "")
+
+
+def test_partial_tail_is_read_once_complete(app_module, journal):
+    store = app_module.ConversationStore(journal)
+    line = (json.dumps({"u": "1", "a": "meal", "d": "", "t": time.time()}) + "\n").encode()
+
+    with open(journal, "ab") as f:
+        f.write(line[:10])
+    assert store.get("1") == ("", "")
+    with open(journal, "ab") as f:
+        f.write(line[10:])
+    assert store.get("1") == ("meal", "")
+
+
+def test_expired_states_are_dropped(app_module, journal):
+    now = time.time()
+    write_journal(journal, [
+        {"u": "1", "a": "meal", "d": "", "t": now - 120},
+        {"u": "2", "a": "meal", "d": "", "t": now},
+    ])
+
+    store = app_module.ConversationStore(journal, ttl=60)
+    assert set(store.entries) == {"2"}
+
+    store.ttl = 0.05
+    time.sleep(0.1)
+    assert store.get("2") == ("", "")
+    assert app_module.ConversationStore(journal).get("2") == ("", "")
+
+
+def test_other_process_catches_up_after_compaction(app_module, journal):
+    writer = app_module.ConversationStore(journal)
+    reader = app_module.ConversationStore(journal)
+    writer.set("1", "meal")
+    assert reader.get("1") == ("meal", "")
+
+    # Читатель дочитал длинный журнал; после сжатия файл короче его offset
+    for i in range(1000):
+        writer.set("9", f"step{i}")
+    assert reader.get("9") == ("step999", "")
+    inode = os.stat(journal).st_ino
+    for i in range(1000, 1100):
+        writer.set("9", f"step{i}")
+    writer.set("2", "weight")
+    writer.clear("1")
+
+    assert os.stat(journal).st_ino != inode
+    assert reader.get("1") == ("", "")
+    assert reader.get("2") == ("weight", "")
+    assert reader.get("9") == ("step1099", "")
@@ -0,0 +1,34 @@
+"""Разбор текста приёма пищи по словарю продуктов."""
+import pytest
+
+
+@pytest.mark.parametrize("text, food, grams", [
+    ("2 яйца", "яйца", 110),
+    ("200 г гречки", "гречки", 200),
+    ("гречка 200г", "гречка", 200),
+    ("стакан молока", "молока", 250),
+    ("пол пиццы", "пиццы", 125),
+    ("0.5 пиццы", "пиццы", 125),
+    ("полтора яйца", "яйца", 82),
+])
+def test_quantities(app_module, text, food, grams):
+    [item] = app_module.parse_meal_text(text)
+
+    assert (item["food"], item["grams"]) == (food, grams)
+    assert item["kcal"] > 0
+
+
+def test_unknown_text_falls_back(app_module):
+    assert app_module.parse_meal_text("рисунок") == []
+    assert app_module.estimate_text_kcal("рисунок") == app_module.TEXT_KCAL_FALLBACK
+
+
+def test_batch_matches_single_estimates(app_module, monkeypatch):
+    texts = ["2 яйца", "2 Яйца", "рисунок", "пол пиццы"]
+    expected = [app_module.estimate_text_kcal(t) for t in texts]
+    calls = []
+    estimate = app_module.estimate_text_kcal
+    monkeypatch.setattr(app_module, "estimate_text_kcal", lambda t: calls.append(t) or estimate(t))
+
+    assert app_module.estimate_text_kcal_batch(texts) == expected
+    assert len(calls) == 3
@@ -0,0 +1,91 @@
+"""Перенос старых meals/daily_log в месячные партиции: повтор после падения
+и несколько воркеров не задваивают строки."""
+import multiprocessing
+
+import pytest
+
+LEGACY_MEALS = [
+    ["2026-08-03T09:00:00", "1", "text", "", "каша", "", "", "300", "0.6", "", "", ""],
+    ["2026-09-10T13:00:00", "1", "text", "", "суп", "", "", "200", "0.6", "", "", ""],
+    ["2026-09-11T13:00:00", "2", "text", "", "суп", "", "", "200", "0.6", "", "", ""],
+]
+
+
+def fill_legacy(storage):
+    storage.table("meals").append_rows(LEGACY_MEALS)
+
+
+def partition_counts(storage):
+    counts = {name: len(storage.table(name).get_all_values()) - 1
+              for name in sorted(storage.list_tables()) if name.startswith("meals")}
+    return {name: n for name, n in counts.items() if n}
+
+
+@pytest.fixture
+def sqlite_storage(app_module, shared_store, tmp_path, monkeypatch):
+    storage = app_module.SqliteStorage(str(tmp_path / "storage.db"))
+    monkeypatch.setattr(app_module, "_storage", storage)
+    monkeypatch.setattr(app_module, "_legacy_checked", False)
+    fill_legacy(storage)
+    return storage
+
+
+def test_sqlite_crash_then_retry_copies_once(app_module, sqlite_storage, monkeypatch):
+    append_rows = app_module.SqliteTable.append_rows
+
+    def crash_on_september(self, rows):
+        if self.name == "meals_2026_09":
+            raise RuntimeError("disk full")
+        return append_rows(self, rows)
+    monkeypatch.setattr(app_module.SqliteTable, "append_rows", crash_on_september)
+
+    with pytest.raises(RuntimeError):
+        app_module.get_partition("meals")
+    assert partition_counts(sqlite_storage) == {"meals": 3}
+
+    monkeypatch.setattr(app_module.SqliteTable, "append_rows", append_rows)
+    app_module.get_partition("meals")
+
+    assert partition_counts(sqlite_storage) == {"meals_2026_08": 1, "meals_2026_09": 2}
+
+
+def migrate_in_worker(barrier):
+    import app
+    barrier.wait()
+    app.get_partition("meals")
+
+
+def test_concurrent_workers_copy_once(app_module, tmp_path, monkeypatch):
+    for name, filename in (("SQLITE_PATH", "storage.db"), ("SHARED_STATE_PATH", "shared.db"),
+                           ("LOCK_PATH", "locks.lock"), ("UPDATE_LEDGER_PATH", "ledger.db"),
+                           ("STATE_JOURNAL_PATH", "journal.jsonl")):
+        monkeypatch.setenv(name, str(tmp_path / filename))
+    fill_legacy(app_module.SqliteStorage(str(tmp_path / "storage.db")))
+
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(4)
+    procs = [ctx.Process(target=migrate_in_worker, args=(barrier,)) for _ in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(120)
+
+    assert [p.exitcode for p in procs] == [0] * 4
+    storage = app_module.SqliteStorage(str(tmp_path / "storage.db"))
+    assert partition_counts(storage) == {"meals_2026_08": 1, "meals_2026_09": 2}
+
+
+def test_sheets_crash_then_retry_copies_once(app_module, fake_sheets):
+    fake_sheets.add("meals", LEGACY_MEALS)
+    fake_sheets.worksheet("meals_2026_09").fail_append = True
+
+    with pytest.raises(RuntimeError):
+        app_module.migrate_legacy_partitions()
+    assert "meals_migrating" in fake_sheets.book and "meals" not in fake_sheets.book
+
+    app_module.migrate_legacy_partitions()
+    app_module.migrate_legacy_partitions()
+
+    assert "meals_migrated" in fake_sheets.book and "meals_migrating" not in fake_sheets.book
+    assert len(fake_sheets.book["meals_2026_08"].rows) == 2
+    assert len(fake_sheets.book["meals_2026_09"].rows) == 3
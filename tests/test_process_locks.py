@@ -0,0 +1,76 @@
+"""user_lock между процессами: несколько воркеров (spawn, как gunicorn)
+одновременно пишут в daily_log одного пользователя."""
+import multiprocessing
+import os
+import time
+from collections import Counter
+
+import pytest
+
+WORKERS = 4
+ROUNDS = 10
+
+
+def worker(barrier):
+    import app
+
+    # Окно между «не нашли строку» и append_row, в которое влезает чужой воркер
+    find = app.SqliteTable.find_daily_row
+
+    def slow_find(self, *args):
+        row = find(self, *args)
+        time.sleep(0.005)
+        return row
+    app.SqliteTable.find_daily_row = slow_find
+
+    day = app.today_str()
+    barrier.wait()
+    for i in range(ROUNDS):
+        with app.write_batch():
+            ws = app.get_worksheet("daily_log")
+            app.add_meal_kcal(ws, "u-shared", day, 10)
+            app.daily_find_or_create(ws, f"u-{i}", day)
+
+
+def test_workers_create_one_daily_row_per_user(app_module, tmp_path, monkeypatch):
+    for name, filename in (("SQLITE_PATH", "storage.db"), ("SHARED_STATE_PATH", "shared.db"),
+                           ("LOCK_PATH", "locks.lock"), ("UPDATE_LEDGER_PATH", "ledger.db"),
+                           ("STATE_JOURNAL_PATH", "journal.jsonl")):
+        monkeypatch.setenv(name, str(tmp_path / filename))
+
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(WORKERS)
+    procs = [ctx.Process(target=worker, args=(barrier,)) for _ in range(WORKERS)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(120)
+    assert [p.exitcode for p in procs] == [0] * WORKERS
+
+    storage = app_module.SqliteStorage(str(tmp_path / "storage.db"))
+    name = app_module.partition_name("daily_log", app_module.today_str())
+    rows = storage.table(name).get_all_values()[1:]
+    per_user = Counter(r[1] for r in rows)
+
+    assert set(per_user.values()) == {1}
+    assert len(per_user) == ROUNDS + 1
+    [shared] = [r for r in rows if r[1] == "u-shared"]
+    assert shared[8] == str(10 * ROUNDS * WORKERS)
+
+
+def test_sqlite_connections_are_reopened_after_fork(app_module, tmp_path):
+    if not hasattr(os, "fork"):
+        pytest.skip("needs os.fork")
+    storage = app_module.SqliteStorage(str(tmp_path / "storage.db"))
+    ledger = app_module.UpdateLedger(str(tmp_path / "ledger.db"))
+    store = app_module.SharedStore(str(tmp_path / "shared.db"))
+    inherited = [storage.conn(), ledger.conn(), store.conn()]
+
+    pid = os.fork()
+    if pid == 0:
+        reopened = [storage.conn(), ledger.conn(), store.conn()]
+        os._exit(0 if all(a is not b for a, b in zip(inherited, reopened)) else 1)
+    _, status = os.waitpid(pid, 0)
+
+    assert os.WEXITSTATUS(status) == 0
+    assert [storage.conn(), ledger.conn(), store.conn()] == inherited
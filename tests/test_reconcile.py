@@ -0,0 +1,56 @@
+import types
+
+
+def test_reconcile_fixes_drift_from_meals(app_module, shared_store):
+    day = app_module.today_str()
+    ws_meals = app_module.get_worksheet("meals")
+    ws_daily = app_module.get_worksheet("daily_log")
+    for kcal in (300, 450):
+        ws_meals.append_row([f"{day}T12:00:00", "801", "text", "", "x", "", "", str(kcal), "0.6", "", "", ""])
+    row = app_module.daily_find_or_create(ws_daily, "801", day)
+    app_module.daily_set(ws_daily, row, 9, "5")
+
+    assert app_module.reconcile_kcal_eaten(day) >= 1
+    assert app_module.get_daily_row_values(ws_daily, row)[8] == "750"
+    assert app_module.reconcile_user_kcal(ws_daily, app_module.get_worksheet("users"),
+                                          ws_meals, "801", day) is None
+
+
+def test_reconcile_rereads_under_the_lock(app_module, shared_store, monkeypatch):
+    """Приём пищи между общим проходом и записью не затирается старой суммой"""
+    day = app_module.today_str()
+    ws_meals = app_module.get_worksheet("meals")
+    ws_daily = app_module.get_worksheet("daily_log")
+    ws_meals.append_row([f"{day}T08:00:00", "802", "text", "", "x", "", "", "200", "0.6", "", "", ""])
+    row = app_module.daily_find_or_create(ws_daily, "802", day)
+    app_module.daily_set(ws_daily, row, 9, "0")
+
+    reconcile_user = app_module.reconcile_user_kcal
+
+    def meal_arrives_first(ws_daily_, ws_users, ws_meals_, uid, day_):
+        if uid == "802":
+            with app_module.user_lock(uid):
+                ws_meals.append_row([f"{day}T09:00:00", uid, "text", "", "y", "", "", "100", "0.6", "", "", ""])
+                app_module.add_meal_kcal(ws_daily, uid, day, 100)
+        return reconcile_user(ws_daily_, ws_users, ws_meals_, uid, day_)
+    monkeypatch.setattr(app_module, "reconcile_user_kcal", meal_arrives_first)
+
+    app_module.reconcile_kcal_eaten(day)
+
+    assert app_module.get_daily_row_values(ws_daily, row)[8] == "300"
+
+
+def test_cron_tick_schedules_reconcile_once_per_interval(app_module, shared_store, monkeypatch):
+    started = []
+
+    class Thread:
+        def __init__(self, target, **kwargs):
+            self.target = target
+
+        def start(self):
+            started.append(self.target)
+    monkeypatch.setattr(app_module, "threading", types.SimpleNamespace(Thread=Thread))
+
+    assert app_module.maybe_reconcile() is True
+    assert app_module.maybe_reconcile() is False
+    assert started == [app_module.reconcile_kcal_eaten]
@@ -0,0 +1,85 @@
+"""ReminderSchedule: индекс по минуте суток UTC, окно ±1 минута, перестройка
+на смене UTC-смещения и журнал отправленного за локальный день."""
+from datetime import datetime, timezone
+
+import pytest
+
+
+def user_row(user_id, tz, checkin="08:05", checkout="22:30"):
+    return [user_id, f"user{user_id}", tz, "2026-10-01T00:00:00", "180", "30", "90", "80",
+            "", "medium", "2100", checkin, checkout]
+
+
+def utc(day, hhmm):
+    hour, minute = map(int, hhmm.split(":"))
+    return datetime(2026, 10, day, hour, minute, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def users(app_module, fake_sheets):
+    fake_sheets.add("users", [user_row("1", "Europe/Berlin"), user_row("2", "Europe/Moscow")])
+    return app_module.SheetsTable("users")
+
+
+@pytest.fixture
+def schedule(app_module):
+    return app_module.ReminderSchedule()
+
+
+def due_ids(schedule, users, now, kind="checkin"):
+    return sorted(profile["user_id"] for profile, _ in schedule.due(users, kind, now))
+
+
+def test_index_is_keyed_by_utc_minute(schedule, users):
+    # 20 октября: Берлин UTC+2, Москва UTC+3 — 08:05 по местному это 06:05 и 05:05 UTC
+    schedule.ensure_built(users, utc(20, "06:05"))
+
+    assert schedule.slots["checkin"] == {6 * 60 + 5: {"1"}, 5 * 60 + 5: {"2"}}
+    assert schedule.slots["checkout"] == {20 * 60 + 30: {"1"}, 19 * 60 + 30: {"2"}}
+
+
+@pytest.mark.parametrize("hhmm, expected", [
+    ("06:03", []), ("06:04", ["1"]), ("06:05", ["1"]), ("06:06", ["1"]), ("06:07", []),
+    ("05:05", ["2"]),
+])
+def test_one_minute_window(schedule, users, hhmm, expected):
+    assert due_ids(schedule, users, utc(20, hhmm)) == expected
+
+
+def test_dst_change_rebuilds_the_index(schedule, users, monkeypatch):
+    assert due_ids(schedule, users, utc(24, "06:05")) == ["1"]
+    rebuilds = []
+    rebuild = schedule.rebuild
+    monkeypatch.setattr(schedule, "rebuild", lambda ws, now=None: rebuilds.append(now) or rebuild(ws, now))
+
+    # 25 октября Берлин перешёл на зимнее время (UTC+1): 08:05 — это уже 07:05 UTC
+    after = utc(25, "06:05")
+    assert schedule._offsets_changed(after)
+    assert due_ids(schedule, users, after) == []
+    assert rebuilds == [after]
+    assert due_ids(schedule, users, utc(25, "07:05")) == ["1"]
+    assert len(rebuilds) == 1
+
+
+def test_double_cron_tick_does_not_resend(app_module, schedule, users, telegram):
+    now = utc(20, "06:05")
+    for tick in (now, utc(20, "06:06")):
+        due = schedule.due(users, "checkin", tick)
+        app_module.broadcast("checkin", [(p, d, "утро") for p, d in due])
+
+    assert [m["chat_id"] for m in telegram.methods("sendMessage")] == ["1"]
+    assert app_module.reminder_schedule.claim("checkin", "1", "2026-10-20") is False
+    # Следующий локальный день — снова к отправке
+    assert due_ids(schedule, users, utc(21, "06:05")) == ["1"]
+
+
+def test_overlapping_ticks_claim_once(app_module, schedule, users, telegram):
+    now = utc(20, "06:05")
+    first = schedule.due(users, "checkin", now)
+    second = schedule.due(users, "checkin", now)
+
+    reports = [app_module.broadcast("checkin", [(p, d, "утро") for p, d in due]) for due in (first, second)]
+
+    assert reports[0]["results"]["1"]["status"] == "sent"
+    assert reports[1]["results"]["1"] == {"status": "skipped", "reason": "already sent"}
+    assert len(telegram.methods("sendMessage")) == 1
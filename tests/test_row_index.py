@@ -0,0 +1,39 @@
+"""RowIndex daily_log: найденная по индексу строка сверяется с листом."""
+DAY = "2026-10-05"
+
+
+def daily_row(user_id, kcal="0"):
+    return [DAY, user_id, "", "", "", "", "", "", kcal, "", "", "", "", ""]
+
+
+def test_shifted_rows_rebuild_the_index(app_module, fake_sheets):
+    tab = fake_sheets.add("daily_log_2026_10", [daily_row("1", "100"), daily_row("2", "200")])
+    ws = app_module.SheetsTable("daily_log_2026_10")
+    assert ws.find_daily_row(DAY, "2") == 3
+
+    # Строку пользователя 1 удалили руками: пользователь 2 уехал на строку 2
+    del tab.rows[1]
+    assert ws.find_daily_row(DAY, "2") == 2
+
+    app_module.add_meal_kcal(ws, "2", DAY, 50)
+    assert tab.rows[1][8] == "250"
+
+
+def test_deleted_row_is_recreated(app_module, fake_sheets):
+    tab = fake_sheets.add("daily_log_2026_10", [daily_row("1", "100")])
+    ws = app_module.SheetsTable("daily_log_2026_10")
+    assert ws.find_daily_row(DAY, "1") == 2
+
+    tab.rows[1] = daily_row("3")
+    assert ws.find_daily_row(DAY, "1") is None
+
+
+def test_verification_read_is_reused(app_module, fake_sheets):
+    tab = fake_sheets.add("daily_log_2026_10", [daily_row("1", "100")])
+    ws = app_module.SheetsTable("daily_log_2026_10")
+    ws.find_daily_row(DAY, "1")
+
+    reads = tab.reads
+    row = ws.find_daily_row(DAY, "1")
+    assert app_module.get_daily_row_values(ws, row)[8] == "100"
+    assert tab.reads == reads + 1
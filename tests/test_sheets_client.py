@@ -0,0 +1,56 @@
+"""sheets_call: одинаковые чтения склеиваются только вне локов."""
+import threading
+
+
+def slow_read(started, release, version):
+    def read():
+        seen = version[0]
+        started.set()
+        release.wait(5)
+        return [["kcal", str(seen)]]
+    return read
+
+
+def background_read(app_module, fn, results):
+    t = threading.Thread(target=lambda: results.append(
+        app_module.sheets_call("daily_log", "get_all_values", fn)))
+    t.start()
+    return t
+
+
+def test_reads_outside_locks_share_one_request(app_module):
+    started, release, version = threading.Event(), threading.Event(), [1]
+    calls = []
+    results = []
+    leader = background_read(app_module, slow_read(started, release, version), results)
+    started.wait(5)
+
+    follower = background_read(app_module, lambda: calls.append(1) or [["kcal", "2"]], results)
+    threading.Timer(0.2, release.set).start()
+    leader.join(5)
+    follower.join(5)
+
+    assert calls == []
+    assert results == [[["kcal", "1"]], [["kcal", "1"]]]
+
+
+def test_read_under_user_lock_is_not_coalesced(app_module):
+    started, release, version = threading.Event(), threading.Event(), [1]
+    results = []
+    leader = background_read(app_module, slow_read(started, release, version), results)
+    started.wait(5)
+
+    # Запись прошла после того, как чужое чтение ушло: под локом нужна свежая строка
+    version[0] = 2
+    timer = threading.Timer(2, release.set)
+    timer.start()
+    try:
+        with app_module.user_lock("42"):
+            fresh = app_module.sheets_call("daily_log", "get_all_values",
+                                           lambda: [["kcal", str(version[0])]])
+        assert fresh == [["kcal", "2"]]
+        assert not release.is_set()
+    finally:
+        release.set()
+        timer.cancel()
+        leader.join(5)
@@ -0,0 +1,60 @@
+import types
+
+import pytest
+
+
+class FakeWorksheet:
+    def __init__(self, rows):
+        self.rows = [list(r) for r in rows]
+        self.cleared = False
+
+    def get_all_values(self):
+        return [list(r) for r in self.rows]
+
+    def clear(self):
+        self.cleared = True
+        self.rows = []
+
+    def resize(self, rows=None, cols=None):
+        pass
+
+    def update(self, range_name, values, **kwargs):
+        self.rows = [list(r) for r in values]
+
+
+@pytest.fixture
+def sheets(app_module, tmp_path, monkeypatch):
+    """Свежая SQLite-база и «таблица Google» из FakeWorksheet"""
+    monkeypatch.setattr(app_module, "_storage", app_module.SqliteStorage(str(tmp_path / "storage.db")))
+    monkeypatch.setattr(app_module, "SHEET_ID", "sheet")
+    monkeypatch.setattr(app_module, "GOOGLE_CREDS_JSON", "{}")
+    header = app_module.SHEET_HEADERS["users"]
+    book = {"users": FakeWorksheet([header, ["1", "Ivan"], ["2", "Petr"]])}
+    monkeypatch.setattr(app_module, "get_gspread_worksheet",
+                        lambda name: book.setdefault(name, FakeWorksheet([app_module.SHEET_HEADERS[
+                            app_module.base_table_name(name)]])))
+    monkeypatch.setattr(app_module, "sheet_handles", types.SimpleNamespace(titles=lambda: list(book)))
+    return book
+
+
+def test_export_refuses_to_wipe_a_fuller_sheet(app_module, sheets):
+    with pytest.raises(ValueError, match="users"):
+        app_module.export_to_sheets()
+
+    assert not sheets["users"].cleared
+    assert len(sheets["users"].rows) == 3
+
+
+def test_import_then_export_round_trips(app_module, sheets):
+    assert app_module.import_from_sheets() == {"users": 2}
+    assert app_module.import_from_sheets() == {}  # непустые таблицы не трогаем
+
+    app_module.export_to_sheets()
+
+    assert [r[:2] for r in sheets["users"].rows[1:]] == [["1", "Ivan"], ["2", "Petr"]]
+
+
+def test_forced_export_overwrites(app_module, sheets):
+    app_module.export_to_sheets(force=True)
+
+    assert sheets["users"].rows == [list(app_module.SHEET_HEADERS["users"])]
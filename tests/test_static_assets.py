@@ -0,0 +1,38 @@
+import pytest
+
+
+@pytest.mark.parametrize("accept, expected", [
+    ("gzip, deflate, br", "br"),
+    ("gzip", "gzip"),
+    ("br;q=0, gzip", "gzip"),
+    ("gzip;q=0.5, br;q=0.4", "gzip"),
+    ("gzip;q=0, br;q=0", None),
+    ("identity", None),
+    ("", None),
+    ("*", "br"),
+    ("x-brotli-nope", None),
+])
+def test_content_encoding_follows_q_values(app_module, accept, expected):
+    if expected == "br" and app_module.brotli is None:
+        pytest.skip("Brotli is not installed")
+    r = app_module.app.test_client().get("/web/index.html", headers={"Accept-Encoding": accept})
+
+    assert r.status_code == 200
+    assert r.headers.get("Content-Encoding") == expected
+    assert r.headers["Vary"] == "Accept-Encoding"
+
+
+def test_index_drops_references_to_unbuilt_media(app_module, tmp_path):
+    (tmp_path / "index.html").write_text(
+        '<video poster="./gipsy.poster.jpg">\n'
+        '  <source src="./gipsy.low.mp4" type="video/mp4" />\n'
+        '  <source src="./gipsy.mp4" type="video/mp4" />\n'
+        '</video>', encoding="utf-8")
+    (tmp_path / "gipsy.mp4").write_bytes(b"video")
+    assets = app_module.StaticAssets(str(tmp_path))
+    assets.load()
+
+    html = assets.blobs["index.html"]["identity"].decode("utf-8")
+
+    assert "poster" not in html and "gipsy.low" not in html
+    assert f'src="./{assets.urls["gipsy.mp4"]}"' in html
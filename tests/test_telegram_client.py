@@ -0,0 +1,76 @@
+import time
+
+
+def make_client(app_module, fake, **kwargs):
+    options = dict(global_rate=1000, chat_rate=1000, chat_burst=1000, max_retries=3,
+                   backoff=0.01, max_retry_after=5)
+    options.update(kwargs)
+    return app_module.TelegramClient(fake.url, **options)
+
+
+def scripted(*responses):
+    """responder, отдающий ответы по очереди (последний — дальше бесконечно)"""
+    queue = list(responses)
+
+    def responder(method, payload):
+        return queue.pop(0) if len(queue) > 1 else queue[0]
+    return responder
+
+
+def too_many(retry_after):
+    return 429, {"ok": False, "error_code": 429, "parameters": {"retry_after": retry_after}}
+
+
+OK = (200, {"ok": True, "result": {}})
+
+
+def test_waits_retry_after_then_succeeds(app_module, fake_bot_api):
+    fake_bot_api.responder = scripted(too_many(0.3), OK)
+    client = make_client(app_module, fake_bot_api)
+
+    started = time.monotonic()
+    r = client.request("sendMessage", {"chat_id": 1, "text": "hi"})
+
+    assert r.status_code == 200
+    assert len(fake_bot_api.methods("sendMessage")) == 2
+    assert time.monotonic() - started >= 0.3
+
+
+def test_too_long_retry_after_is_returned_without_retry(app_module, fake_bot_api):
+    fake_bot_api.responder = scripted(too_many(60), OK)
+    client = make_client(app_module, fake_bot_api, max_retry_after=5)
+
+    started = time.monotonic()
+    r = client.request("sendMessage", {"chat_id": 1, "text": "hi"})
+
+    assert r.status_code == 429
+    assert len(fake_bot_api.calls) == 1
+    assert time.monotonic() - started < 1
+
+
+def test_429_gives_up_after_max_retries(app_module, fake_bot_api):
+    fake_bot_api.responder = scripted(too_many(0.01))
+    client = make_client(app_module, fake_bot_api, max_retries=2)
+
+    r = client.request("sendMessage", {"chat_id": 1, "text": "hi"})
+
+    assert r.status_code == 429
+    assert len(fake_bot_api.calls) == 3
+
+
+def test_server_errors_are_retried(app_module, fake_bot_api):
+    fake_bot_api.responder = scripted((502, {"ok": False}), (500, {"ok": False}), OK)
+    client = make_client(app_module, fake_bot_api)
+
+    r = client.request("sendMessage", {"chat_id": 1, "text": "hi"})
+
+    assert r.status_code == 200
+    assert len(fake_bot_api.calls) == 3
+
+
+def test_client_errors_are_not_retried(app_module, fake_bot_api):
+    fake_bot_api.responder = scripted((400, {"ok": False, "description": "Bad Request"}), OK)
+    client = make_client(app_module, fake_bot_api)
+
+    assert client.request("sendMessage", {"chat_id": 1, "text": "hi"}).status_code == 400
+    assert len(fake_bot_api.calls) == 1
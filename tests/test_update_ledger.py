@@ -0,0 +1,96 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def ledger_path(tmp_path):
+    return str(tmp_path / "update_ledger.db")
+
+
+def test_second_claim_is_a_duplicate(app_module, ledger_path):
+    ledger = app_module.UpdateLedger(ledger_path)
+
+    assert ledger.claim(1) is True
+    assert ledger.claim(1) is False
+    assert ledger.claim(2) is True
+
+
+def test_failed_update_is_released_for_redelivery(app_module, ledger_path):
+    ledger = app_module.UpdateLedger(ledger_path)
+    ledger.claim(1)
+
+    ledger.finish(1, ok=False)
+
+    assert ledger.claim(1) is True
+
+
+def test_done_survives_restart(app_module, ledger_path):
+    ledger = app_module.UpdateLedger(ledger_path)
+    ledger.claim(1)
+    ledger.finish(1, ok=True)
+
+    assert app_module.UpdateLedger(ledger_path).claim(1) is False
+
+
+def test_inflight_in_another_worker_is_a_duplicate_until_it_times_out(app_module, ledger_path):
+    app_module.UpdateLedger(ledger_path).claim(1)
+
+    assert app_module.UpdateLedger(ledger_path, inflight_timeout=60).claim(1) is False
+    time.sleep(0.05)
+    assert app_module.UpdateLedger(ledger_path, inflight_timeout=0.01).claim(1) is True
+
+
+def test_updates_without_id_are_always_processed(app_module, ledger_path):
+    ledger = app_module.UpdateLedger(ledger_path)
+
+    assert ledger.claim(None) is True
+    assert ledger.claim(None) is True
+
+
+def test_webhook_dedups_success_and_retries_failure(app_module, ledger_path, monkeypatch):
+    monkeypatch.setattr(app_module, "_update_ledger", app_module.UpdateLedger(ledger_path))
+    handled = []
+    results = [("Error", 500), ("OK", 200)]
+
+    def handle_update(update):
+        handled.append(update["update_id"])
+        return results.pop(0)
+    monkeypatch.setattr(app_module, "handle_update", handle_update)
+    client = app_module.app.test_client()
+    update = {"update_id": 77, "message": {"chat": {"id": 1}, "from": {"id": 1}, "text": "x"}}
+
+    assert client.post("/webhook", json=update).status_code == 500
+    assert client.post("/webhook", json=update).status_code == 200
+    assert client.post("/webhook", json=update).status_code == 200
+    assert handled == [77, 77]
+
+
+@pytest.mark.parametrize("body", ["[]", '"x"', "null", "5"])
+def test_webhook_ignores_non_object_bodies(app_module, body):
+    r = app_module.app.test_client().post("/webhook", data=body, content_type="application/json")
+
+    assert r.status_code == 200
+
+
+def test_two_workers_redelivery_after_the_owner_fails(app_module, ledger_path):
+    owner = app_module.UpdateLedger(ledger_path)
+    other = app_module.UpdateLedger(ledger_path)
+    assert owner.claim(1) is True
+    assert other.claim(1) is False
+
+    owner.finish(1, ok=False)
+
+    assert other.claim(1) is True
+
+
+def test_two_workers_done_update_stays_a_duplicate(app_module, ledger_path):
+    owner = app_module.UpdateLedger(ledger_path)
+    other = app_module.UpdateLedger(ledger_path)
+    owner.claim(1)
+    assert other.claim(1) is False
+
+    owner.finish(1, ok=True)
+
+    assert other.claim(1) is False
+    assert other.recent[1] == "done"
@@ -0,0 +1,29 @@
+"""UserDirectory: строка из кэша перед перезаписью сверяется с листом."""
+
+
+def user_row(user_id, name):
+    return [user_id, name, "Europe/Moscow", "2026-10-01T00:00:00", "180", "30", "90", "80",
+            "", "medium", "2100", "08:05", "22:30"]
+
+
+def test_upsert_after_rows_shift_keeps_other_users(app_module, fake_sheets):
+    tab = fake_sheets.add("users", [user_row("1", "Аня"), user_row("2", "Борис")])
+    ws = app_module.SheetsTable("users")
+    assert app_module.get_user_profile(ws, "2")["kcal_target"] == 2100
+
+    # Строку Ани удалили руками: на строке 3, куда смотрит кэш, теперь пусто
+    del tab.rows[1]
+    tab.rows.append(user_row("3", "Вера"))
+    app_module.upsert_user(ws, "2", "Борис", {"kcal_target": 1800})
+
+    assert [r[:2] for r in tab.rows[1:]] == [["2", "Борис"], ["3", "Вера"]]
+    assert tab.rows[1][10] == "1800"
+    assert app_module.get_user_profile(ws, "2")["kcal_target"] == 1800
+
+
+def test_upsert_of_unknown_user_appends(app_module, fake_sheets):
+    tab = fake_sheets.add("users", [user_row("1", "Аня")])
+    ws = app_module.SheetsTable("users")
+    app_module.upsert_user(ws, "5", "Гена", {})
+
+    assert [r[0] for r in tab.rows[1:]] == ["1", "5"]
@@ -0,0 +1,45 @@
+import pytest
+
+
+@pytest.fixture
+def client(app_module, tmp_path, monkeypatch, telegram):
+    monkeypatch.setattr(app_module, "_update_ledger", app_module.UpdateLedger(str(tmp_path / "ledger.db")))
+    return app_module.app.test_client()
+
+
+def meal_update(update_id, user_id):
+    return {"update_id": update_id, "message": {
+        "message_id": 1, "chat": {"id": user_id}, "from": {"id": user_id}, "text": "2 яйца"}}
+
+
+def meal_rows(app_module, user_id):
+    return app_module.get_worksheet("meals").rows_for_user(user_id)
+
+
+def test_reply_is_sent_after_the_write(app_module, client, telegram, monkeypatch):
+    order = []
+    write_cells = app_module.write_cells
+    monkeypatch.setattr(app_module, "write_cells",
+                        lambda ws, cells: (order.append("write"), write_cells(ws, cells)))
+    respond = telegram.responder
+    telegram.responder = lambda method, payload: (order.append(method), respond(method, payload))[1]
+    app_module.state_set("901", "meal")
+
+    assert client.post("/webhook", json=meal_update(3101, 901)).status_code == 200
+
+    assert order[-1] == "sendMessage" and "write" in order
+    assert telegram.methods("sendMessage")[-1]["text"].startswith("Записал ✅")
+
+
+def test_failed_flush_is_reported_and_not_redelivered(app_module, client, telegram, monkeypatch):
+    def failing(ws, cells):
+        raise RuntimeError("quota exceeded")
+    monkeypatch.setattr(app_module, "write_cells", failing)
+    app_module.state_set("902", "meal")
+
+    assert client.post("/webhook", json=meal_update(3102, 902)).status_code == 200
+    assert client.post("/webhook", json=meal_update(3102, 902)).status_code == 200
+
+    texts = [m["text"] for m in telegram.methods("sendMessage")]
+    assert len(texts) == 1 and texts[0].startswith("⚠️")
+    assert len(meal_rows(app_module, "902")) == 1
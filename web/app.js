@@ -29,18 +29,25 @@ function valOrPlaceholder(id) {
   return (el.placeholder || "").trim();
 }
 
-async function checkUserExists() {
+function renderToday(t) {
+  eatenEl.textContent = `${t.kcal_eaten} ккал`;
+  leftEl.textContent = `${t.kcal_left} ккал`;
+  stepsEl.textContent = `${t.steps}`;
+}
+
+async function bootstrap() {
   const id = uid();
-  if (!id) return false;
-  
+  if (!id) return null;
+
   try {
-    const res = await fetch(`/api/today?user_id=${encodeURIComponent(id)}`);
+    // Один запрос: есть ли профиль + цифры на сегодня
+    const res = await fetch(`/api/bootstrap?user_id=${encodeURIComponent(id)}`);
     const j = await res.json();
-    // Если получили данные (даже с 0 калориями) — пользователь существует
-    return j.ok === true;
+    console.log("bootstrap response:", j);
+    return j.ok ? j : null;
   } catch (e) {
-    console.error("checkUserExists error:", e);
-    return false;
+    console.error("bootstrap error:", e);
+    return null;
   }
 }
 
@@ -55,9 +62,7 @@ async function refreshToday() {
     const j = await res.json();
     console.log("refreshToday response:", j);
     if (!j.ok) return;
-    eatenEl.textContent = `${j.kcal_eaten} ккал`;
-    leftEl.textContent = `${j.kcal_left} ккал`;
-    stepsEl.textContent = `${j.steps}`;
+    renderToday(j);
   } catch (e) {
     console.error("refreshToday error:", e);
   }
@@ -65,15 +70,15 @@ async function refreshToday() {
 
 // Инициализация при загрузке
 async function init() {
-  const exists = await checkUserExists();
+  const boot = await bootstrap();
   
-  if (exists) {
+  if (boot && boot.exists) {
     // Пользователь уже есть — показываем дашборд
     console.log("User exists, showing dashboard");
     s0.classList.add("hidden");
     s1.classList.add("hidden");
     s2.classList.remove("hidden");
-    await refreshToday();
+    renderToday(boot.today);
   } else {
     // Новый пользователь — показываем приветствие
     console.log("New user, showing welcome screen");